@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""
+CrewAI Chat Passthrough Agent - ASGI entry point
+Multiplexes /chat/send SSE streams on one asyncio event loop; every other
+route is served by the Flask app through a WSGI adapter
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import httpx
+import uvicorn
+from urllib.parse import parse_qs
+from asgiref.wsgi import WsgiToAsgi
+
+import main
+from main import API_PORT, SSE_HEADERS, HTTP_CONNECT_TIMEOUT, HTTP_MAX_RETRIES, begin_turn, complete_turn, chat_errors_total
+from streaming import RESUME_ERRORS, sse_event
+
+ASGI_UPSTREAM_CONNECTIONS = int(os.environ.get('ASGI_UPSTREAM_CONNECTIONS', 1000))
+ASGI_UPSTREAM_TIMEOUT = float(os.environ.get('ASGI_UPSTREAM_TIMEOUT', 60))
+
+CORS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS',
+    'Access-Control-Allow-Headers': 'Content-Type, Authorization'
+}
+
+
+class ChatASGI:
+    """ASGI application with a native async /chat/send"""
+    def __init__(self, flask_app):
+        self.wsgi = WsgiToAsgi(flask_app)
+        self.client = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http' and scope['path'] == '/chat/send' and scope['method'] == 'POST':
+            await self.send_message(receive, send)
+        elif scope['type'] == 'http' and scope['path'].startswith('/chat/stream/') and scope['method'] == 'GET':
+            await self.resume_stream(scope, receive, send)
+        else:
+            await self.wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                limits = httpx.Limits(max_connections=ASGI_UPSTREAM_CONNECTIONS,
+                                      max_keepalive_connections=ASGI_UPSTREAM_CONNECTIONS)
+                self.client = httpx.AsyncClient(
+                    transport=httpx.AsyncHTTPTransport(limits=limits, retries=HTTP_MAX_RETRIES),  # Connect errors only
+                    timeout=httpx.Timeout(ASGI_UPSTREAM_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)
+                )
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.client.aclose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def respond_json(self, send, status, payload):
+        body = json.dumps(payload).encode('utf-8')
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': encode_headers({**CORS_HEADERS, 'Content-Type': 'application/json'})})
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def send_message(self, receive, send):
+        """Send a message and get streaming response - pure passthrough"""
+        body = b''
+        more_body = True
+        while more_body:
+            message = await receive()
+            body += message.get('body', b'')
+            more_body = message.get('more_body', False)
+
+        try:
+            data = json.loads(body) if body else None
+        except ValueError:
+            data = None
+
+        if not isinstance(data, dict) or 'message' not in data:
+            await self.respond_json(send, 400, {'error': 'message required'})
+            return
+
+        # Session creation and history misses touch SQLite; keep them off the event loop
+        session_id, user_id, message, history, summary = await asyncio.to_thread(begin_turn, data)
+
+        start_time = time.time()
+        # One upstream stream per distinct request; identical in-flight requests share it.
+        # The producer saves the answer when it finishes, even if this client has gone.
+        loop = asyncio.get_running_loop()
+        broadcast, coalesced = main.hub.open_async(
+            main.llm, self.client, message, session_id, history, summary, data.get('cache', True) is not False,
+            user_id, on_complete=lambda response, usage: complete_in_thread(
+                loop, session_id, user_id, response, start_time, usage)
+        )
+
+        # Model indicator; stream_id is what a dropped client reconnects to
+        first = sse_event({'model': 'Claude Sonnet 4', 'session_id': session_id, 'stream_id': broadcast.stream_id})
+        await self.stream_events(receive, send, broadcast.iter_events_async(), first)
+
+    async def resume_stream(self, scope, receive, send):
+        """Reattach to an assistant stream, replaying buffered events after Last-Event-ID"""
+        stream_id = scope['path'][len('/chat/stream/'):]
+        headers = dict(scope.get('headers') or [])
+        last_event_id = headers.get(b'last-event-id', b'').decode('latin-1')
+        if not last_event_id:
+            last_event_id = parse_qs(scope.get('query_string', b'').decode('latin-1')).get('last_event_id', [None])[0]
+
+        broadcast, start, result = main.hub.attach(stream_id, last_event_id)
+        if result in RESUME_ERRORS:
+            status, error = RESUME_ERRORS[result]
+            await self.respond_json(send, status, {'error': error, 'stream_id': stream_id, 'restart_turn': True})
+        else:
+            await self.stream_events(receive, send, broadcast.iter_events_async(start))
+
+    async def stream_events(self, receive, send, stream, first=None):
+        """Send an SSE response from a broadcast reader until it ends or the client disconnects"""
+        disconnected = asyncio.Event()
+
+        async def watch_disconnect():
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+            disconnected.set()
+
+        async def emit(chunk):
+            await send({'type': 'http.response.body', 'body': chunk.encode('utf-8'), 'more_body': True})
+
+        watcher = asyncio.create_task(watch_disconnect())
+
+        try:
+            await send({'type': 'http.response.start', 'status': 200,
+                        'headers': encode_headers({**CORS_HEADERS, **SSE_HEADERS,
+                                                   'Content-Type': 'text/event-stream; charset=utf-8'})})
+            if first:
+                await emit(first)
+
+            async for chunk in stream:
+                if disconnected.is_set():
+                    break
+                await emit(chunk)
+
+        except Exception as e:
+            chat_errors_total.labels(type='streaming_error').inc()
+            await emit(sse_event({'error': str(e)}))
+        finally:
+            # Releases this reader, even if it never started; the producer keeps going for STREAM_DETACH_GRACE
+            await stream.aclose()
+            watcher.cancel()
+
+        await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+
+
+def complete_in_thread(loop, *args):
+    """Run complete_turn off the event loop: the writer call can block while the write-behind queue is full"""
+    def report(future):
+        if not future.cancelled() and future.exception():
+            chat_errors_total.labels(type='stream_completion_error').inc()
+            print(f"ERROR: Turn completion failed: {future.exception()}")
+
+    try:
+        on_loop = asyncio.get_running_loop() is loop
+    except RuntimeError:
+        on_loop = False
+    if not on_loop:
+        complete_turn(*args)  # Joined a stream produced by a thread; already off the loop
+        return
+    loop.run_in_executor(None, complete_turn, *args).add_done_callback(report)
+
+
+def encode_headers(headers):
+    return [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers.items()]
+
+
+app = ChatASGI(main.app)
+
+if __name__ == '__main__':
+    main.write_pidfile()
+
+    try:
+        main.init_services()
+    except ValueError as e:
+        print(f"ERROR: Could not initialize Claude: {e}")
+        sys.exit(1)
+
+    main.start_metrics_server()
+
+    print(f"Starting CrewAI Chat PT Air Agent (ASGI) on port {API_PORT}")
+    print(f"Mode: Pure passthrough to Claude Sonnet 4")
+
+    # uvicorn handles SIGTERM gracefully; atexit then flushes the write-behind queue
+    uvicorn.run(app, host='0.0.0.0', port=API_PORT, log_level='warning', backlog=4096)
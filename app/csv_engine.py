@@ -0,0 +1,413 @@
+#!/usr/bin/env python3
+"""
+Columnar CSV analytics engine
+Builds dictionary-encoded, typed columns from a single streaming pass over a
+CSV file so dataset questions can be answered with exact numbers locally
+"""
+
+import os
+import csv
+import mmap
+import hashlib
+from array import array
+from collections import Counter
+from datetime import datetime
+
+FILTER_OPS = ('eq', 'ne', 'in', 'not_in', 'gt', 'gte', 'lt', 'lte', 'contains', 'startswith')
+AGGREGATES = ('count', 'sum', 'mean', 'min', 'max')
+
+# Smallest array typecode able to hold each dictionary size
+_TYPECODES = (('B', 0xFF), ('H', 0xFFFF), ('I', 0xFFFFFFFF))
+
+
+def parse_number(value):
+    """Parse a numeric cell; returns int/float or None"""
+    value = value.strip()
+    if not value:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    try:
+        number = float(value)
+    except ValueError:
+        return None
+    return number if number == number else None  # Reject NaN
+
+
+def parse_datetime(value):
+    """Parse 'M/D/YYYY H:MM[:SS]' (the KMMU export format) or ISO timestamps; returns datetime or None"""
+    value = value.strip()
+    if not value:
+        return None
+    try:
+        if '/' in value:
+            date_part, _, time_part = value.partition(' ')
+            month, day, year = date_part.split('/')
+            hms = [int(p) for p in time_part.split(':')] if time_part else []
+            hms += [0] * (3 - len(hms))
+            return datetime(int(year), int(month), int(day), hms[0], hms[1], hms[2])
+        return datetime.fromisoformat(value)
+    except (ValueError, TypeError, IndexError):
+        return None
+
+
+def count_lines(path, chunk=1 << 24):
+    """Count newline-terminated records (plus a trailing partial line) over an mmap of the file.
+
+    Quoted fields containing newlines are counted as extra lines, so this is an
+    upper bound for such files; the columnar index reports the exact count.
+    """
+    with open(path, 'rb') as f:
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            return 0  # Empty file
+        with mm:
+            size = len(mm)
+            lines = sum(mm[i:i + chunk].count(b'\n') for i in range(0, size, chunk))
+            if size and mm[size - 1:size] != b'\n':
+                lines += 1
+    return lines
+
+
+def head_digest(path, length):
+    """SHA-256 of the first `length` bytes of a file"""
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read(length)).hexdigest()
+
+
+def file_fingerprint(path, sample=1 << 16):
+    """Cheap identity for a data file: size, mtime and hashes of its first and last `sample` bytes.
+
+    A file that only grew keeps the same head hash when re-hashed over
+    `head_bytes`, which is what lets callers ingest just the appended rows.
+    """
+    stat = os.stat(path)
+    head_bytes = min(stat.st_size, sample)
+    with open(path, 'rb') as f:
+        head = hashlib.sha256(f.read(head_bytes)).hexdigest()
+        f.seek(max(0, stat.st_size - sample))
+        tail = hashlib.sha256(f.read(sample)).hexdigest()
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'head_bytes': head_bytes, 'head': head, 'tail': tail}
+
+
+class Column:
+    """Dictionary-encoded column: one small-integer code per row plus a table of distinct values"""
+    __slots__ = ('name', 'index', 'values', 'codes', 'counts', 'kind', '_numbers', '_datetimes')
+
+    def __init__(self, name):
+        self.name = name
+        self.index = {}           # raw value -> code (insertion ordered, so codes are dense)
+        self.values = []          # code -> raw value
+        self.codes = array('B')   # row -> code, widened as the dictionary grows
+        self.counts = []          # code -> row count
+        self.kind = 'empty'
+        self._numbers = None
+        self._datetimes = None
+
+    def extend(self, cells):
+        setdefault = self.index.setdefault
+        index = self.index
+        codes = [setdefault(v, len(index)) for v in cells]
+        self._widen(len(index) - 1)
+        self.codes.extend(codes)
+
+    def _widen(self, max_code):
+        for typecode, limit in _TYPECODES:
+            if max_code <= limit:
+                break
+        if typecode != self.codes.typecode and self.codes.itemsize < array(typecode).itemsize:
+            self.codes = array(typecode, self.codes)
+
+    def finalize(self):
+        """Refresh the value table, per-value counts and inferred type"""
+        self.values = list(self.index)
+        counter = Counter(self.codes)
+        self.counts = [counter.get(code, 0) for code in range(len(self.values))]
+        self._numbers = None
+        self._datetimes = None
+
+        kind = 'empty'
+        for value in self.values:
+            if not value.strip():
+                continue
+            number = parse_number(value)
+            if number is None:
+                kind = 'str'
+                break
+            if isinstance(number, float):
+                kind = 'float'
+            elif kind == 'empty':
+                kind = 'int'
+        if kind == 'str' and self.is_datetime():
+            kind = 'datetime'
+        self.kind = kind
+
+    def is_datetime(self):
+        sample = [v for v in self.values[:50] if v.strip()]
+        return bool(sample) and all(parse_datetime(v) for v in sample)
+
+    def numbers(self):
+        """Numeric value per code (None for blanks), parsed once on demand"""
+        if self._numbers is None:
+            self._numbers = [parse_number(v) for v in self.values]
+        return self._numbers
+
+    def datetimes(self):
+        """datetime per code (None for blanks), parsed once on demand"""
+        if self._datetimes is None:
+            self._datetimes = [parse_datetime(v) for v in self.values]
+        return self._datetimes
+
+    def memory_bytes(self):
+        return self.codes.itemsize * len(self.codes) + sum(len(v) + 49 for v in self.values)
+
+
+class ColumnarTable:
+    """In-memory columnar copy of a CSV file with a small query API"""
+    def __init__(self, columns=None):
+        self.columns = {}
+        self.names = []
+        self.rows = 0
+        self.bytes_read = 0
+        if columns:
+            self._set_header(columns)
+
+    def _set_header(self, names):
+        self.names = list(names)
+        self.columns = {name: Column(name) for name in self.names}
+
+    @classmethod
+    def from_csv(cls, path, batch_rows=20000):
+        table = cls()
+        table.ingest(path, 0, batch_rows)
+        return table
+
+    def ingest(self, path, offset=0, batch_rows=20000, tail=None):
+        """Stream rows from `path` starting at byte `offset` (0 = header first); returns bytes consumed.
+
+        When tailing (default: offset > 0) only complete, newline-terminated
+        lines are consumed, so a file that is still being appended to can be
+        resumed from `self.bytes_read` later. A full load also reads a last
+        line without a trailing newline.
+        """
+        if tail is None:
+            tail = offset > 0
+        consumed = 0
+        with open(path, 'rb') as f:
+            f.seek(offset)
+
+            def lines():
+                nonlocal consumed
+                for raw in f:
+                    if tail and not raw.endswith(b'\n'):
+                        return  # Partial trailing line; picked up by the next ingest
+                    consumed += len(raw)
+                    yield raw.decode('utf-8', 'replace')
+
+            reader = csv.reader(lines())
+            if offset == 0:
+                header = next(reader, None)
+                if header is None:
+                    return 0
+                if header:
+                    header[0] = header[0].lstrip('\ufeff')  # Excel byte-order mark
+                if not self.names:
+                    self._set_header(header)
+
+            width = len(self.names)
+            batch = []
+            for row in reader:
+                if not row:
+                    continue  # Blank line, e.g. the newline that completes a last line read without one
+                if len(row) != width:
+                    row = (row + [''] * width)[:width]
+                batch.append(row)
+                if len(batch) >= batch_rows:
+                    self._append(batch)
+                    batch = []
+            if batch:
+                self._append(batch)
+
+        self.bytes_read = offset + consumed
+        self.finalize()
+        return consumed
+
+    def _append(self, batch):
+        for name, cells in zip(self.names, zip(*batch)):
+            self.columns[name].extend(cells)
+        self.rows += len(batch)
+
+    def finalize(self):
+        for column in self.columns.values():
+            column.finalize()
+
+    def copy(self):
+        """Independent copy (codes are memcpy'd) for copy-on-write incremental appends"""
+        clone = ColumnarTable()
+        clone.names = list(self.names)
+        clone.rows = self.rows
+        clone.bytes_read = self.bytes_read
+        for name, column in self.columns.items():
+            other = Column(name)
+            other.index = dict(column.index)
+            other.values = list(column.values)
+            other.codes = array(column.codes.typecode, column.codes)
+            other.counts = list(column.counts)
+            other.kind = column.kind
+            clone.columns[name] = other
+        return clone
+
+    def memory_bytes(self):
+        return sum(column.memory_bytes() for column in self.columns.values())
+
+    # Query API
+
+    def column(self, name):
+        try:
+            return self.columns[name]
+        except KeyError:
+            raise ValueError(f"Unknown column: {name}")
+
+    def row(self, i):
+        return [self.columns[name].values[self.columns[name].codes[i]] for name in self.names]
+
+    def schema(self):
+        return [{'name': name, 'type': self.columns[name].kind, 'distinct': len(self.columns[name].values)}
+                for name in self.names]
+
+    def _code_predicate(self, column, op, value):
+        """Evaluate a filter once per distinct value; returns a bytearray indexed by code"""
+        if op not in FILTER_OPS:
+            raise ValueError(f"Unsupported filter op: {op}")
+
+        if op in ('in', 'not_in'):
+            wanted = {str(v) for v in (value if isinstance(value, (list, tuple)) else [value])}
+            hit = [v.strip() in wanted for v in column.values]
+            return bytearray(h != (op == 'not_in') for h in hit)
+        if op == 'contains':
+            needle = str(value).lower()
+            return bytearray(needle in v.lower() for v in column.values)
+        if op == 'startswith':
+            prefix = str(value).lower()
+            return bytearray(v.lower().startswith(prefix) for v in column.values)
+
+        if column.kind in ('int', 'float'):
+            keys, target = column.numbers(), parse_number(str(value))
+        elif column.kind == 'datetime':
+            keys, target = column.datetimes(), parse_datetime(str(value))
+        else:
+            keys, target = [v.strip() for v in column.values], str(value).strip()
+        if target is None:
+            raise ValueError(f"Cannot compare {column.name} ({column.kind}) with {value!r}")
+
+        compare = {
+            'eq': lambda k: k == target,
+            'ne': lambda k: k != target,
+            'gt': lambda k: k > target,
+            'gte': lambda k: k >= target,
+            'lt': lambda k: k < target,
+            'lte': lambda k: k <= target
+        }[op]
+        return bytearray(k is not None and compare(k) for k in keys)
+
+    def select(self, filters=None):
+        """Row indices matching every filter ({'column', 'op', 'value'}); None means all rows"""
+        rows = None
+        for f in filters or []:
+            column = self.column(f['column'])
+            ok = self._code_predicate(column, f.get('op', 'eq'), f.get('value'))
+            codes = column.codes
+            if rows is None:
+                rows = [i for i, code in enumerate(codes) if ok[code]]
+            else:
+                rows = [i for i in rows if ok[codes[i]]]
+        return rows
+
+    def _code_counts(self, column, rows):
+        if rows is None:
+            return column.counts
+        counter = Counter(column.codes[i] for i in rows)
+        return [counter.get(code, 0) for code in range(len(column.values))]
+
+    def count(self, filters=None):
+        rows = self.select(filters)
+        return self.rows if rows is None else len(rows)
+
+    def value_counts(self, name, filters=None, limit=None):
+        """[(value, rows)] for a column, most frequent first"""
+        column = self.column(name)
+        return self._ranked_counts(column, self.select(filters), limit)
+
+    def _ranked_counts(self, column, rows, limit):
+        counts = self._code_counts(column, rows)
+        pairs = sorted(((column.values[c], n) for c, n in enumerate(counts) if n), key=lambda p: -p[1])
+        return pairs[:limit] if limit else pairs
+
+    def aggregate(self, name, fn='count', filters=None):
+        """count/sum/mean/min/max of a column over matching rows (blanks ignored)"""
+        if fn not in AGGREGATES:
+            raise ValueError(f"Unsupported aggregate: {fn}")
+        column = self.column(name)
+        counts = self._code_counts(column, self.select(filters))
+
+        if column.kind == 'datetime' and fn in ('min', 'max', 'count'):
+            keys = column.datetimes()
+        elif column.kind in ('int', 'float', 'empty'):
+            keys = column.numbers()
+        elif fn == 'count':
+            keys = [v if v.strip() else None for v in column.values]
+        else:
+            raise ValueError(f"Cannot compute {fn} of {column.kind} column {name}")
+
+        present = [(keys[c], n) for c, n in enumerate(counts) if n and keys[c] is not None]
+        rows = sum(n for _, n in present)
+        if fn == 'count':
+            return rows
+        if not present:
+            return None
+        if fn == 'min':
+            result = min(k for k, _ in present)
+        elif fn == 'max':
+            result = max(k for k, _ in present)
+        else:
+            total = sum(k * n for k, n in present)
+            result = total if fn == 'sum' else total / rows
+        return result.isoformat(sep=' ') if isinstance(result, datetime) else result
+
+    def group_by(self, name, fn='count', value_column=None, filters=None, limit=None):
+        """[(group value, aggregate)] ordered by aggregate descending"""
+        if fn not in AGGREGATES:
+            raise ValueError(f"Unsupported aggregate: {fn}")
+        group = self.column(name)
+        rows = self.select(filters)
+        if fn == 'count':
+            return self._ranked_counts(group, rows, limit)
+
+        target = self.column(value_column)
+        if target.kind not in ('int', 'float'):
+            raise ValueError(f"Cannot compute {fn} of {target.kind} column {value_column}")
+        numbers = target.numbers()
+        buckets = {}
+        for i in (range(self.rows) if rows is None else rows):
+            number = numbers[target.codes[i]]
+            if number is not None:
+                buckets.setdefault(group.codes[i], []).append(number)
+        reducer = {'sum': sum, 'min': min, 'max': max, 'mean': lambda xs: sum(xs) / len(xs)}[fn]
+        pairs = sorted(((group.values[c], reducer(xs)) for c, xs in buckets.items()), key=lambda p: -p[1])
+        return pairs[:limit] if limit else pairs
+
+    def describe(self, name):
+        """Summary statistics for one column"""
+        column = self.column(name)
+        summary = {'column': name, 'type': column.kind, 'distinct': len(column.values), 'rows': self.rows}
+        if column.kind in ('int', 'float', 'datetime'):
+            for fn in ('count', 'min', 'max') + (('mean', 'sum') if column.kind != 'datetime' else ()):
+                summary[fn] = self.aggregate(name, fn)
+        else:
+            summary['count'] = self.aggregate(name, 'count')
+            summary['top'] = self.value_counts(name, limit=10)
+        return summary
+
@@ -0,0 +1,76 @@
+"""
+CrewAI Chat Passthrough Agent - gunicorn settings for SERVER_MODE=workers
+Runs WORKERS processes behind API_PORT: gunicorn -c app/gunicorn.conf.py
+
+WORKER_CLASS=gthread serves the Flask app with WORKER_THREADS threads per
+process; WORKER_CLASS=asgi serves app/asgi.py with uvicorn workers. Workers
+share chat.db (or the STORAGE_URL server) and write their metrics to
+PROMETHEUS_MULTIPROC_DIR; the master serves their sum on METRICS_PORT and
+/metrics on any worker returns the same.
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+WORKERS = int(os.environ.get('WORKERS', len(os.sched_getaffinity(0))))
+WORKER_CLASS = os.environ.get('WORKER_CLASS', 'gthread')
+WORKER_THREADS = int(os.environ.get('WORKER_THREADS', 64))
+
+# Set before a worker imports prometheus_client
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', os.path.join(tempfile.gettempdir(), 'crewai-chat-metrics'))
+if WORKERS > 1:
+    os.environ.setdefault('STORAGE_SHARED', '1')  # Sibling workers write to the same chat.db
+
+pythonpath = APP_DIR
+bind = f"0.0.0.0:{os.environ.get('API_PORT', 8080)}"
+backlog = 4096
+workers = WORKERS
+graceful_timeout = 30  # Lets each worker flush its write-behind queue on shutdown
+
+if WORKER_CLASS == 'asgi':
+    wsgi_app = 'asgi:app'
+    worker_class = 'uvicorn.workers.UvicornWorker'
+else:
+    wsgi_app = 'main:app'
+    worker_class = 'gthread'
+    threads = WORKER_THREADS  # One per in-flight SSE stream, as with the threaded Flask server
+    os.environ['WORKER_THREADS'] = str(WORKER_THREADS)  # Workers report busy / WORKER_THREADS saturation
+
+
+def on_starting(server):
+    """Start from an empty metrics directory; a previous master's files would be added in"""
+    path = os.environ['PROMETHEUS_MULTIPROC_DIR']
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path, exist_ok=True)
+
+
+def when_ready(server):
+    """Serve the summed metrics of all workers on METRICS_PORT from the master, which outlives worker restarts"""
+    port = int(os.environ.get('METRICS_PORT', 9090))
+    if not port:
+        return
+    from prometheus_client import CollectorRegistry, multiprocess, start_http_server
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    try:
+        start_http_server(port, registry=registry)
+        print(f"✓ Metrics server listening on port {port}")
+    except OSError as e:
+        print(f"WARNING: Metrics server could not bind port {port}: {e}; /metrics stays on the API port")
+
+
+def post_worker_init(worker):
+    import main
+    try:
+        main.init_services()
+    except ValueError as e:
+        print(f"ERROR: Could not initialize Claude: {e}")
+        sys.exit(3)  # Worker boot error: gunicorn stops instead of respawning
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -8,34 +8,192 @@ import os
 import sys
 import time
 import json
-import sqlite3
 import requests
 import csv
-from datetime import datetime
+import queue
+import signal
+import threading
+import fnmatch
+import hashlib
+import math
+import random
+import re
+import zlib
+import gzip
+import socket
+import gc
+from collections import OrderedDict, deque
+from contextlib import closing
+from datetime import datetime, timezone, timedelta
+from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib3.exceptions import InvalidHeader
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
 from flask import Flask, request, jsonify, Response, stream_with_context, send_from_directory
-from prometheus_client import Counter, Histogram, Gauge, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client import CollectorRegistry, REGISTRY, multiprocess, start_http_server, generate_latest, CONTENT_TYPE_LATEST
+from werkzeug.wsgi import ClosingIterator
 import uuid
+import asyncio
+
+from csv_engine import ColumnarTable, FILTER_OPS, AGGREGATES, count_lines, file_fingerprint, head_digest
+from metrics import (
+    chat_messages_total, chat_sessions_active, chat_response_time, chat_tokens_total, chat_errors_total,
+    admission_queue_depth, admission_inflight, admission_wait_time, admission_rejected_total,
+    export_rows_total, search_time, search_backfill_remaining, db_size_bytes,
+    maintenance_rows_total, maintenance_pause_time, maintenance_runs_total,
+    batch_items_total, batch_item_time, batch_jobs_active, batch_queue_depth,
+    response_cache_requests_total, response_cache_saved_seconds, response_cache_entries, response_cache_evictions_total,
+    llm_connect_time, llm_ttft, llm_inter_token_time, llm_stream_time, llm_requests_total,
+    csv_load_time, csv_index_bytes, csv_ready, csv_snapshot_total, csv_reload_time, csv_rows_ingested_total, csv_query_time,
+    tool_calls_total, tool_call_time, tool_result_bytes,
+    http_requests_sent_total, http_connections_opened_total, http_connect_time, http_retries_total, c2_requests_total,
+    context_tokens, context_messages, context_summarized_total,
+    process_resident_memory, process_cpu_seconds, process_threads, process_open_fds, gc_pause_time, gc_collected_total,
+    thread_pool_busy, thread_pool_size
+)
+from storage import (
+    ChatDatabase, RemoteChatDatabase, MessageWriter, STORAGE_URL, HISTORY_CACHE_SESSIONS, SESSIONS_PAGE_SIZE,
+    SEARCH_PAGE_SIZE, SEARCH_BACKFILL_BATCH, encode_cursor, decode_cursor, add_usage, estimate_tokens
+)
+from streaming import StreamHub, RESUME_ERRORS, sse_event, normalize_text, resolve_future
 
 # Environment variables
 API_PORT = int(os.environ.get('API_PORT', 8080))
-METRICS_PORT = int(os.environ.get('METRICS_PORT', 9090))
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 9090))  # Dedicated /metrics listener (0 = API port only)
 C2_REGISTRY_URL = os.environ.get('C2_REGISTRY_URL', 'http://crewai-c2-dc1-prod-001-v1-0-0:8080')
+INSTANCE_ID = os.environ.get('INSTANCE_ID', '002')
+ENVIRONMENT = os.environ.get('ENVIRONMENT', 'prod')
 DATA_DIR = os.environ.get('DATA_DIR', './data')
 OUTPUT_DIR = os.environ.get('OUTPUT_DIR', './output')
 INPUT_DIR = os.environ.get('INPUT_DIR', './input')
 PIDFILE = os.environ.get('PIDFILE', '/var/run/crewai-chat-pt-air.pid')
 CSV_FILE = os.environ.get('CSV_FILE', 'KMMU_OPS_Data_10-24-25.csv')
-
-# Prometheus metrics
-chat_messages_total = Counter('crewai_chat_messages_total', 'Total chat messages', ['direction', 'user'])
-chat_sessions_active = Gauge('crewai_chat_sessions_active', 'Active chat sessions')
-chat_response_time = Histogram('crewai_chat_response_time_seconds', 'Chat response time')
-chat_tokens_total = Counter('crewai_chat_tokens_total', 'Total tokens processed', ['type'])
-llm_requests_total = Counter('crewai_chat_llm_requests_total', 'Total LLM requests', ['status'])
-chat_errors_total = Counter('crewai_chat_errors_total', 'Total chat errors', ['type'])
+ANTHROPIC_API_URL = os.environ.get('ANTHROPIC_API_URL', 'https://api.anthropic.com/v1/messages')
+PROMPT_CACHE = os.environ.get('PROMPT_CACHE', '1') == '1'
+
+# CSV analytics
+CSV_ANALYTICS = os.environ.get('CSV_ANALYTICS', '1') == '1'
+CSV_FACT_COLUMNS = [c for c in os.environ.get(
+    'CSV_FACT_COLUMNS', 'Operation_Type,Rwy_Used,AC_Mfr_Name,Registrant_State,Type_Aircraft,AP_Wx_Category'
+).split(',') if c]
+CSV_DATE_COLUMN = os.environ.get('CSV_DATE_COLUMN', 'Operation_Date_Time')
+CSV_QUERY_MAX_GROUPS = int(os.environ.get('CSV_QUERY_MAX_GROUPS', 50))
+CSV_BACKGROUND_LOAD = os.environ.get('CSV_BACKGROUND_LOAD', '1') == '1'
+CSV_SNAPSHOT = os.environ.get('CSV_SNAPSHOT', '1') == '1'
+
+# Input directory watching (glob; the newest matching file is served)
+INPUT_WATCH = os.environ.get('INPUT_WATCH', '1') == '1'
+INPUT_WATCH_INTERVAL = float(os.environ.get('INPUT_WATCH_INTERVAL', 10))
+INPUT_WATCH_PATTERN = os.environ.get('INPUT_WATCH_PATTERN', CSV_FILE)
+
+# Model tool use
+CSV_TOOLS = os.environ.get('CSV_TOOLS', '1') == '1'
+TOOL_MAX_ROUNDS = int(os.environ.get('TOOL_MAX_ROUNDS', 4))
+TOOL_RESULT_MAX_BYTES = int(os.environ.get('TOOL_RESULT_MAX_BYTES', 4096))
+
+# Upstream HTTP connection pool
+HTTP_POOL_CONNECTIONS = int(os.environ.get('HTTP_POOL_CONNECTIONS', 4))
+HTTP_POOL_MAXSIZE = int(os.environ.get('HTTP_POOL_MAXSIZE', 64))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', 10))
+HTTP_READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', 60))
+HTTP_MAX_RETRIES = int(os.environ.get('HTTP_MAX_RETRIES', 3))
+HTTP_BACKOFF_FACTOR = float(os.environ.get('HTTP_BACKOFF_FACTOR', 0.5))
+HTTP_BACKOFF_JITTER = float(os.environ.get('HTTP_BACKOFF_JITTER', 0.5))
+
+# Storage backend and multi-worker coordination
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'sqlite')  # sqlite (DATA_DIR/chat.db) or http (STORAGE_URL)
+HEARTBEAT_INTERVAL = float(os.environ.get('HEARTBEAT_INTERVAL', 30))
+LEASE_TTL = float(os.environ.get('LEASE_TTL', 90))  # Seconds a dead worker's leases block others
+PROMETHEUS_MULTIPROC_DIR = os.environ.get('PROMETHEUS_MULTIPROC_DIR', '')
+WORKER_THREADS = int(os.environ.get('WORKER_THREADS', 0))  # Request threads per gunicorn gthread worker (0 = one per request)
+
+# Metrics labels and runtime sampling
+METRICS_USER_BUCKETS = int(os.environ.get('METRICS_USER_BUCKETS', 16))  # Hashed `user` label values (0 = a single 'other')
+METRICS_USERS = {u for u in os.environ.get('METRICS_USERS', '').split(',') if u}  # user_ids that keep their own label
+RUNTIME_METRICS_INTERVAL = float(os.environ.get('RUNTIME_METRICS_INTERVAL', 5))  # Process/GC/thread-pool sampling (0 = off)
+STATUS_CACHE_TTL = float(os.environ.get('STATUS_CACHE_TTL', 5))  # Seconds /status reuses the active session count
+
+# Largest page any listing route returns (page sizes live in storage.py)
+PAGE_MAX = int(os.environ.get('PAGE_MAX', 500))
+
+# Retention, archival and compaction of chat.db
+MAINTENANCE_INTERVAL = float(os.environ.get('MAINTENANCE_INTERVAL', 3600))  # Seconds between runs, 0 = off
+RETENTION_DAYS = float(os.environ.get('RETENTION_DAYS', 0))  # Idle days before a session is archived, 0 = keep forever
+RETENTION_POLICIES = os.environ.get('RETENTION_POLICIES', '')  # Per-user overrides: "alice=365,load-*=1"
+ARCHIVE = os.environ.get('ARCHIVE', '1') == '1'  # 0 = delete expired sessions without archiving
+ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR', os.path.join(OUTPUT_DIR, 'archive'))
+MAINTENANCE_BATCH_SIZE = int(os.environ.get('MAINTENANCE_BATCH_SIZE', 100))  # Sessions per archive file and delete
+VACUUM_STEP_PAGES = int(os.environ.get('VACUUM_STEP_PAGES', 1024))
+VACUUM_FULL_THRESHOLD = float(os.environ.get('VACUUM_FULL_THRESHOLD', 0.25))  # Free-page fraction for a one-off full VACUUM
+MAINTENANCE_STEP_DELAY = float(os.environ.get('MAINTENANCE_STEP_DELAY', 0.05))  # Pause between write-locking steps
+
+# Upstream admission control
+LLM_MAX_CONCURRENCY = int(os.environ.get('LLM_MAX_CONCURRENCY', 32))
+LLM_MAX_PER_USER = int(os.environ.get('LLM_MAX_PER_USER', 4))
+LLM_TOKEN_RATE = int(os.environ.get('LLM_TOKEN_RATE', 0))  # Estimated input tokens per minute, 0 = unlimited
+LLM_USER_TOKEN_RATE = int(os.environ.get('LLM_USER_TOKEN_RATE', 0))  # Same, per user_id
+LLM_QUEUE_TIMEOUT = float(os.environ.get('LLM_QUEUE_TIMEOUT', 60))
+LLM_COALESCE = os.environ.get('LLM_COALESCE', '1') == '1'
+
+# Offline batch jobs (/batch)
+BATCH_WORKERS = int(os.environ.get('BATCH_WORKERS', 4))
+BATCH_MAX_ITEMS = int(os.environ.get('BATCH_MAX_ITEMS', 10000))
+BATCH_RETRIES = int(os.environ.get('BATCH_RETRIES', 2))
+BATCH_RETRY_BACKOFF = float(os.environ.get('BATCH_RETRY_BACKOFF', 2))
+
+# Response cache (opt-in)
+RESPONSE_CACHE = os.environ.get('RESPONSE_CACHE', '0') == '1'
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', 1000))
+RESPONSE_CACHE_TTL = float(os.environ.get('RESPONSE_CACHE_TTL', 3600))
+RESPONSE_CACHE_SIMILARITY = float(os.environ.get('RESPONSE_CACHE_SIMILARITY', 0))  # Cosine threshold; 0 = exact tier only
+RESPONSE_CACHE_REPLAY_DELAY = float(os.environ.get('RESPONSE_CACHE_REPLAY_DELAY', 0))  # Seconds between replayed tokens
+
+# Conversation context window
+CONTEXT_TOKEN_BUDGET = int(os.environ.get('CONTEXT_TOKEN_BUDGET', 8000))
+CONTEXT_MAX_MESSAGES = int(os.environ.get('CONTEXT_MAX_MESSAGES', 50))
+CONTEXT_SUMMARY = os.environ.get('CONTEXT_SUMMARY', '1') == '1'
+CONTEXT_SUMMARY_TOKENS = int(os.environ.get('CONTEXT_SUMMARY_TOKENS', 400))
+
+def user_label(user_id):
+    """Bounded `user` label: METRICS_USERS by name, everyone else in one of METRICS_USER_BUCKETS hashed buckets"""
+    user_id = str(user_id)
+    if user_id in METRICS_USERS:
+        return user_id
+    if METRICS_USER_BUCKETS <= 0:
+        return 'other'
+    # crc32 rather than hash(): every worker and restart puts a user in the same bucket
+    return f'bucket-{zlib.crc32(user_id.encode("utf-8")) % METRICS_USER_BUCKETS:02d}'
+
+def metrics_registry():
+    """Registry to expose: every live worker's series under PROMETHEUS_MULTIPROC_DIR, else this process's"""
+    if PROMETHEUS_MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    return REGISTRY
 
 app = Flask(__name__)
 
+class InflightRequests:
+    """WSGI middleware counting requests whose response is still being sent, i.e. busy request threads"""
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+        self.busy = thread_pool_busy.labels(pool='requests')
+
+    def __call__(self, environ, start_response):
+        self.busy.inc()
+        try:
+            body = self.wsgi_app(environ, start_response)
+        except BaseException:
+            self.busy.dec()
+            raise
+        # SSE responses hold their thread until the stream ends and the server closes the body
+        return ClosingIterator(body, self.busy.dec)
+
+app.wsgi_app = InflightRequests(app.wsgi_app)
+
 # CORS configuration
 @app.after_request
 def add_cors_headers(response):
@@ -44,186 +202,292 @@ def add_cors_headers(response):
     response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization'
     return response
 
-# Database setup
-class ChatDatabase:
-    def __init__(self, db_path):
-        self.db_path = db_path
-        self.init_db()
-
-    def init_db(self):
-        """Initialize database schema"""
-        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
-
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-
-            # Users/Sessions table
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS sessions (
-                    session_id TEXT PRIMARY KEY,
-                    user_id TEXT NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    last_active TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    metadata TEXT
-                )
-            ''')
-
-            # Messages table
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS messages (
-                    message_id TEXT PRIMARY KEY,
-                    session_id TEXT NOT NULL,
-                    role TEXT NOT NULL,
-                    content TEXT NOT NULL,
-                    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    tokens INTEGER,
-                    response_time REAL,
-                    FOREIGN KEY (session_id) REFERENCES sessions(session_id)
-                )
-            ''')
-
-            # Create indexes
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_session_id ON messages(session_id)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_user_id ON sessions(user_id)')
-
-            conn.commit()
-
-    def create_session(self, user_id, metadata=None):
-        """Create a new chat session"""
-        session_id = str(uuid.uuid4())
-
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT INTO sessions (session_id, user_id, metadata)
-                VALUES (?, ?, ?)
-            ''', (session_id, user_id, json.dumps(metadata or {})))
-            conn.commit()
-
-        chat_sessions_active.inc()
-        return session_id
-
-    def save_message(self, session_id, role, content, tokens=None, response_time=None):
-        """Save a message to the database"""
-        message_id = str(uuid.uuid4())
-
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT INTO messages (message_id, session_id, role, content, tokens, response_time)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', (message_id, session_id, role, content, tokens, response_time))
-
-            # Update session last_active
-            cursor.execute('''
-                UPDATE sessions SET last_active = CURRENT_TIMESTAMP
-                WHERE session_id = ?
-            ''', (session_id,))
-
-            conn.commit()
-
-        return message_id
-
-    def get_history(self, session_id, limit=50):
-        """Get chat history for a session"""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT message_id, role, content, timestamp, tokens, response_time
-                FROM messages
-                WHERE session_id = ?
-                ORDER BY timestamp DESC
-                LIMIT ?
-            ''', (session_id, limit))
-
-            messages = []
-            for row in cursor.fetchall():
-                messages.append({
-                    'message_id': row[0],
-                    'role': row[1],
-                    'content': row[2],
-                    'timestamp': row[3],
-                    'tokens': row[4],
-                    'response_time': row[5]
-                })
-
-            return list(reversed(messages))
-
-    def get_user_sessions(self, user_id):
-        """Get all sessions for a user"""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT session_id, created_at, last_active, metadata
-                FROM sessions
-                WHERE user_id = ?
-                ORDER BY last_active DESC
-            ''', (user_id,))
-
-            sessions = []
-            for row in cursor.fetchall():
-                sessions.append({
-                    'session_id': row[0],
-                    'created_at': row[1],
-                    'last_active': row[2],
-                    'metadata': json.loads(row[3]) if row[3] else {}
-                })
-
-            return sessions
-
-    def get_active_session_count(self):
-        """Get count of active sessions (last 1 hour)"""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT COUNT(*) FROM sessions
-                WHERE last_active >= datetime('now', '-1 hour')
-            ''')
-            return cursor.fetchone()[0]
+
+def open_storage():
+    """The storage backend selected by STORAGE_BACKEND"""
+    if STORAGE_BACKEND == 'http':
+        print(f"✓ Chat storage: {STORAGE_URL}")
+        return RemoteChatDatabase(connect_timeout=HTTP_CONNECT_TIMEOUT, retries=HTTP_MAX_RETRIES,
+                                  backoff_factor=HTTP_BACKOFF_FACTOR, pool_maxsize=HTTP_POOL_MAXSIZE)
+    if STORAGE_BACKEND != 'sqlite':
+        raise ValueError(f"unknown STORAGE_BACKEND {STORAGE_BACKEND!r} (expected sqlite or http)")
+    return ChatDatabase(os.path.join(DATA_DIR, 'chat.db'))
+
+def worker_id():
+    """Lease holder name of this process: instance, host and pid"""
+    return f'{INSTANCE_ID}@{socket.gethostname()}:{os.getpid()}'
+
+
+def page_limit(value, default):
+    """A ?limit= value clamped to [1, PAGE_MAX]; raises ValueError if it is not an integer"""
+    if value is None or value == '':
+        return default
+    try:
+        limit = int(value)
+    except ValueError:
+        raise ValueError('limit must be an integer')
+    return max(1, min(limit, PAGE_MAX))
+
+
+def message_tokens(message):
+    """Token count for a history message, estimated once and cached on the dict"""
+    if message.get('tokens') is None:
+        message['tokens'] = estimate_tokens(message.get('content'))
+    return message['tokens']
+
+class ContextBuilder:
+    """Packs conversation history into a token budget, newest turns first.
+
+    Turns that no longer fit, or that have left the CONTEXT_MAX_MESSAGES
+    window, are folded into an extractive per-session summary
+    (sessions.summary) so long conversations keep their gist without resending
+    every message. Each message is summarized once, in order.
+    """
+    def __init__(self, database, budget=CONTEXT_TOKEN_BUDGET, summary_tokens=CONTEXT_SUMMARY_TOKENS,
+                 summarize=CONTEXT_SUMMARY):
+        self.db = database
+        self.budget = budget
+        self.summary_tokens = summary_tokens
+        self.summarize = summarize
+        self._summaries = OrderedDict()   # session_id -> (summary, through message_id)
+        self._lock = threading.Lock()
+
+    def build(self, session_id, history, prompt):
+        """Returns (history that fits the budget, summary text of older turns)"""
+        remaining = self.budget - estimate_tokens(prompt)
+        packed = []
+        for message in reversed(history):
+            tokens = message_tokens(message)
+            if tokens > remaining:
+                break
+            packed.append(message)
+            remaining -= tokens
+        packed.reverse()
+
+        summary = ""
+        if self.summarize:
+            dropped = history[:len(history) - len(packed)]
+            # A full window means older turns exist on disk that a stored summary may cover
+            if dropped or len(history) >= CONTEXT_MAX_MESSAGES:
+                summary = self.update_summary(session_id, history, dropped)
+
+        context_messages.observe(len(packed))
+        return packed, summary
+
+    def _cached_summary(self, session_id):
+        with self._lock:
+            # Another worker may have extended a shared store's summary since
+            if session_id in self._summaries and not self.db.shared:
+                self._summaries.move_to_end(session_id)
+                return self._summaries[session_id]
+        state = self.db.get_summary(session_id)
+        self._remember(session_id, state)
+        return state
+
+    def _remember(self, session_id, state):
+        with self._lock:
+            self._summaries[session_id] = state
+            self._summaries.move_to_end(session_id)
+            while len(self._summaries) > HISTORY_CACHE_SESSIONS:
+                self._summaries.popitem(last=False)
+
+    def update_summary(self, session_id, history, dropped):
+        """Append lines for turns after the summary's last message, keeping the newest lines within summary_tokens.
+
+        `dropped` is the oldest part of `history` that did not fit the budget.
+        Messages between the summary's last message and the start of a full
+        window are read from storage.
+        """
+        summary, through = self._cached_summary(session_id)
+        ids = [m.get('message_id') for m in history]
+        if through in ids:
+            # Order, not membership in this turn's dropped list: a turn that drops fewer messages adds nothing
+            fresh = dropped[ids.index(through) + 1:]
+        elif len(history) >= CONTEXT_MAX_MESSAGES:
+            # Older lines than summary_tokens would be trimmed below, so that many messages is enough
+            fresh = self.db.get_history_before(session_id, ids[0], self.summary_tokens, after=through) + dropped
+        else:
+            fresh = dropped
+        if not fresh:
+            return summary
+
+        lines = summary.split('\n') if summary else []
+        lines.extend(summary_line(m) for m in fresh)
+        while len(lines) > 1 and estimate_tokens('\n'.join(lines)) > self.summary_tokens:
+            lines.pop(0)
+        summary = '\n'.join(lines)
+
+        through = fresh[-1].get('message_id')
+        self.db.save_summary(session_id, summary, through)
+        self._remember(session_id, (summary, through))
+        context_summarized_total.inc(len(fresh))
+        return summary
+
+def summary_line(message, max_chars=160):
+    """First sentence of a message, trimmed, prefixed with its role"""
+    text = ' '.join((message.get('content') or '').split())
+    for end in ('. ', '? ', '! '):
+        cut = text.find(end)
+        if 0 < cut < max_chars:
+            text = text[:cut + 1]
+            break
+    if len(text) > max_chars:
+        text = text[:max_chars - 3] + '...'
+    return f"- {message.get('role')}: {text}"
 
 # Initialize database
-db = ChatDatabase(os.path.join(DATA_DIR, 'chat.db'))
+db = open_storage()
+writer = MessageWriter(db)
+context_builder = ContextBuilder(db)
 
 # CSV Data Loader
 class CSVDataLoader:
     """Load and provide metadata about CSV dataset"""
-    def __init__(self, csv_path):
+    SNAPSHOT_VERSION = 2
+
+    def __init__(self, csv_path, background=False, table=None):
         self.csv_path = csv_path
         self.columns = []
         self.row_count = 0
         self.sample_data = []
-        self.load_metadata()
+        self.table = None
+        self.system_prompt_context = ""
+        self.state = 'pending'      # pending -> metadata -> ready, or failed
+        self.source = None          # 'snapshot' or 'scan'
+        self.error = None
+        self.loaded = threading.Event()
+        self.fingerprint = None
+        self._facts = ""
+        if table is not None:
+            # Incremental reload: the caller already extended a copy of the previous index
+            self.fingerprint = file_fingerprint(csv_path)
+            self.source = 'incremental'
+            self.adopt_table(table)
+            self.state = 'ready'
+            self.loaded.set()
+        elif background:
+            threading.Thread(target=self.load_metadata, name='csv-loader', daemon=True).start()
+        else:
+            self.load_metadata()
 
     def load_metadata(self):
         """Load CSV metadata - columns, row count, and sample rows"""
+        start = time.time()
         try:
-            with open(self.csv_path, 'r', encoding='utf-8-sig') as f:
-                reader = csv.reader(f)
-                self.columns = next(reader)  # First row is header
-
-                # Get first 3 sample rows
-                for i, row in enumerate(reader):
-                    if i < 3:
-                        self.sample_data.append(row)
-                    self.row_count = i + 1
-
-            print(f"✓ Loaded CSV: {self.row_count} rows, {len(self.columns)} columns")
+            self.fingerprint = file_fingerprint(self.csv_path)
+
+            # Header, samples and row count first (snapshot or mmap newline count) so the
+            # prompt is usable before the columnar index finishes building
+            if not self.load_snapshot():
+                self.scan_metadata()
+                self.save_snapshot()
+            self.state = 'metadata'
+            csv_ready.set(1)
+            self._rendered()
+            print(f"✓ CSV metadata ({self.source}): {self.row_count} rows, {len(self.columns)} columns")
+
+            if CSV_ANALYTICS:
+                # One streaming pass builds the columnar index; exact counts and facts come from it
+                self.adopt_table(ColumnarTable.from_csv(self.csv_path))
+                print(f"✓ Loaded CSV: {self.row_count} rows, {len(self.columns)} columns (columnar index built)")
+                csv_ready.set(2)
+
+            csv_load_time.observe(time.time() - start)
+            self.state = 'ready'
         except Exception as e:
+            self.state, self.error = 'failed', str(e)
             print(f"WARNING: Could not load CSV metadata: {e}")
+        finally:
+            self.loaded.set()
+
+    def adopt_table(self, table):
+        """Take metadata and exact facts from a built columnar index"""
+        csv_index_bytes.set(table.memory_bytes())
+        self.columns = table.names
+        self.row_count = table.rows
+        self.sample_data = [table.row(i) for i in range(min(3, table.rows))]
+        self.table = table
+        self._facts = self.render_dataset_facts()
+        self._rendered()
+        self.save_snapshot()
+
+    def scan_metadata(self):
+        """Header and sample rows from the top of the file; row count from an mmap newline count"""
+        with open(self.csv_path, 'r', encoding='utf-8-sig', newline='') as f:
+            reader = csv.reader(f)
+            self.columns = next(reader)  # First row is header
+            self.sample_data = [row for _, row in zip(range(3), reader)]
+        self.row_count = max(0, count_lines(self.csv_path) - 1)
+        self.source = 'scan'
+
+    def snapshot_path(self):
+        return os.path.join(DATA_DIR, f"csv_snapshot_{os.path.basename(self.csv_path)}.json")
+
+    def snapshot_key(self):
+        """Identity of the file plus the settings that shape the rendered facts"""
+        return {'version': self.SNAPSHOT_VERSION, 'file': self.fingerprint,
+                'fact_columns': CSV_FACT_COLUMNS, 'date_column': CSV_DATE_COLUMN}
+
+    def load_snapshot(self):
+        """Restore schema, row count, samples and facts if the file is unchanged since the last run"""
+        if not CSV_SNAPSHOT:
+            return False
+        try:
+            with open(self.snapshot_path()) as f:
+                snapshot = json.load(f)
+            if snapshot.get('key') != self.snapshot_key():
+                csv_snapshot_total.labels(result='stale').inc()
+                return False
+        except (OSError, ValueError):
+            csv_snapshot_total.labels(result='miss').inc()
+            return False
+
+        csv_snapshot_total.labels(result='hit').inc()
+        self.columns = snapshot['columns']
+        self.row_count = snapshot['row_count']
+        self.sample_data = snapshot['sample_data']
+        self._facts = snapshot.get('facts', "")
+        self.source = 'snapshot'
+        return True
+
+    def save_snapshot(self):
+        if not CSV_SNAPSHOT:
+            return
+        snapshot = {'key': self.snapshot_key(), 'columns': self.columns, 'row_count': self.row_count,
+                    'sample_data': self.sample_data, 'facts': self._facts}
+        path = self.snapshot_path()
+        try:
+            with open(path + '.tmp', 'w') as f:
+                json.dump(snapshot, f)
+            os.replace(path + '.tmp', path)  # Atomic: a crash never leaves a torn snapshot
+        except OSError as e:
+            print(f"WARNING: Could not write CSV snapshot: {e}")
+
+    def status(self):
+        return {'file': os.path.basename(self.csv_path), 'state': self.state, 'source': self.source,
+                'rows': self.row_count, 'columns': len(self.columns), 'indexed': self.table is not None,
+                'error': self.error}
+
+    def _rendered(self):
+        # Rendered once per load; every request reuses the same string
+        self.system_prompt_context = self.render_system_prompt_context()
 
     def get_system_prompt_context(self):
+        """System prompt context about the dataset (cached at load time)"""
+        return self.system_prompt_context
+
+    def render_system_prompt_context(self):
         """Generate system prompt context about the dataset"""
         if not self.columns:
             return ""
 
         context = f"""
 
-You have access to an aviation operations dataset: KMMU_OPS_Data_10-24-25.csv
+You have access to an aviation operations dataset: {os.path.basename(self.csv_path)}
 
 Dataset Details:
 - Total Records: {self.row_count:,}
 - Location: Morristown Municipal Airport (KMMU)
-- Data Period: Through October 24, 2025
 
 ALL {len(self.columns)} COLUMNS (complete list):
 {', '.join(self.columns)}
@@ -243,7 +507,419 @@ Column Categories:
 
 When users ask about this dataset, you can discuss ANY of these {len(self.columns)} columns and their data."""
 
-        return context
+        return context + self._facts
+
+    def render_dataset_facts(self):
+        """Exact aggregates from the columnar index, so headline numbers are not guessed"""
+        if not self.table or not self.table.rows:
+            return ""
+
+        lines = [f"\n\nExact Dataset Facts (computed locally over all {self.table.rows:,} rows):"]
+        if CSV_DATE_COLUMN in self.table.columns:
+            first = self.table.aggregate(CSV_DATE_COLUMN, 'min')
+            last = self.table.aggregate(CSV_DATE_COLUMN, 'max')
+            if first and last:
+                lines.append(f"- {CSV_DATE_COLUMN} range: {first} to {last}")
+        for name in CSV_FACT_COLUMNS:
+            if name not in self.table.columns:
+                continue
+            top = self.table.value_counts(name, limit=10)
+            distinct = len(self.table.columns[name].values)
+            values = '; '.join(f"{value or '(blank)'}: {count:,}" for value, count in top)
+            suffix = f" (top 10 of {distinct:,})" if distinct > 10 else ""
+            lines.append(f"- {name}{suffix}: {values}")
+        return '\n'.join(lines)
+
+    def query(self, spec):
+        """Run a dataset query against the columnar index.
+
+        spec: {'filters': [{'column', 'op', 'value'}], 'group_by': column,
+               'aggregate': count|sum|mean|min|max, 'column': value column, 'limit': n}
+        """
+        if not self.table:
+            raise ValueError("Dataset index not loaded")
+
+        filters = spec.get('filters') or []
+        fn = spec.get('aggregate', 'count')
+        column = spec.get('column')
+        group_by = spec.get('group_by')
+        limit = min(int(spec.get('limit') or CSV_QUERY_MAX_GROUPS), CSV_QUERY_MAX_GROUPS)
+
+        start = time.time()
+        if group_by:
+            kind = 'group_by'
+            groups = self.table.group_by(group_by, fn, column, filters=filters, limit=limit)
+            result = {'groups': [{'value': value, fn: agg} for value, agg in groups]}
+        elif fn == 'count' and not column:
+            kind = 'count'
+            result = {'count': self.table.count(filters)}
+        else:
+            kind = 'aggregate'
+            result = {fn: self.table.aggregate(column, fn, filters=filters)}
+        csv_query_time.labels(kind=kind).observe(time.time() - start)
+
+        result['matched_rows'] = self.table.count(filters) if filters else self.table.rows
+        return result
+
+class InputWatcher:
+    """Polls INPUT_DIR and swaps in a reloaded CSVDataLoader when the served CSV changes"""
+    def __init__(self, llm, input_dir=INPUT_DIR, pattern=INPUT_WATCH_PATTERN, interval=INPUT_WATCH_INTERVAL):
+        self.llm = llm
+        self.input_dir = input_dir
+        self.pattern = pattern
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread:
+            return
+        self._thread = threading.Thread(target=self._run, name='input-watcher', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.check()
+            except Exception as e:
+                chat_errors_total.labels(type='csv_reload').inc()
+                print(f"WARNING: Input CSV reload failed: {e}")
+
+    def current_file(self):
+        """Newest CSV in the input directory matching the watch pattern"""
+        try:
+            names = [n for n in os.listdir(self.input_dir) if fnmatch.fnmatch(n, self.pattern)]
+        except OSError:
+            return None
+        paths = [os.path.join(self.input_dir, n) for n in names]
+        return max(paths, key=lambda p: (os.path.getmtime(p), p)) if paths else None
+
+    def check(self):
+        """Reload if a different or modified file should be served; returns the reload mode or None"""
+        path = self.current_file()
+        loader = self.llm.csv_loader
+        if path is None or (loader and not loader.loaded.is_set()):
+            return None  # Nothing to serve yet, or the current load is still running
+
+        stat = os.stat(path)
+        previous = loader.fingerprint if loader and loader.csv_path == path else None
+        if previous and (stat.st_size, stat.st_mtime_ns) == (previous['size'], previous['mtime_ns']):
+            return None
+
+        start = time.time()
+        old_rows = loader.row_count if previous else 0
+        if (previous and loader.table is not None and stat.st_size > previous['size']
+                and head_digest(path, previous['head_bytes']) == previous['head']):
+            # Appended rows only: extend a copy of the live index so in-flight readers keep a consistent view
+            mode = 'incremental'
+            table = loader.table.copy()
+            table.ingest(path, table.bytes_read)
+            fresh = CSVDataLoader(path, table=table)
+        else:
+            mode = 'full'
+            old_rows = 0
+            fresh = CSVDataLoader(path)
+            if fresh.state == 'failed':
+                raise ValueError(fresh.error)
+
+        # Single reference swap; streams that already built their payload are unaffected
+        self.llm.csv_loader = fresh
+        csv_reload_time.labels(mode=mode).observe(time.time() - start)
+        csv_rows_ingested_total.labels(mode=mode).inc(max(0, fresh.row_count - old_rows))
+        print(f"✓ Reloaded CSV ({mode}): {os.path.basename(path)}, {fresh.row_count} rows "
+              f"(+{fresh.row_count - old_rows}) in {time.time() - start:.2f}s")
+        return mode
+
+
+# Tools the model may call; executed locally against the columnar CSV index
+DATASET_TOOL = {
+    'name': 'query_dataset',
+    'description': (
+        "Run an exact query over the full aviation operations dataset. Returns a row count, "
+        "an aggregate, or grouped aggregates (largest first) for rows matching all filters. "
+        "Use this instead of estimating whenever a question needs counts, rankings, sums, "
+        "averages or date ranges. Dates compare as M/D/YYYY [H:MM] or ISO."
+    ),
+    'input_schema': {
+        'type': 'object',
+        'properties': {
+            'filters': {
+                'type': 'array',
+                'description': 'Row filters, all of which must match',
+                'items': {
+                    'type': 'object',
+                    'properties': {
+                        'column': {'type': 'string'},
+                        'op': {'type': 'string', 'enum': list(FILTER_OPS)},
+                        'value': {'description': 'Comparison value; a list for in/not_in'}
+                    },
+                    'required': ['column', 'op', 'value']
+                }
+            },
+            'group_by': {'type': 'string', 'description': 'Column to group matching rows by'},
+            'aggregate': {'type': 'string', 'enum': list(AGGREGATES), 'description': 'Defaults to count'},
+            'column': {'type': 'string', 'description': 'Value column for sum/mean/min/max'},
+            'limit': {'type': 'integer', 'description': f'Maximum groups returned (max {CSV_QUERY_MAX_GROUPS})'}
+        }
+    }
+}
+
+
+class StreamTurn:
+    """Accumulates one upstream Messages API stream: text, tool_use blocks, usage and stop reason.
+
+    Also records the latency breakdown of the request (time to headers, time to
+    first token, inter-token gaps, total duration) per model.
+    """
+    def __init__(self, model, started):
+        self.model = model
+        self.started = started  # time.perf_counter() when the request was sent
+        self.blocks = {}        # content block index -> {'type': 'text'|'tool_use', ...}
+        self.tool_json = {}     # tool_use block index -> partial JSON fragments
+        self.text_parts = {}    # text block index -> streamed deltas, joined once in assistant_content
+        self.usage = {}
+        self.stop_reason = None
+        self.error = None       # error event payload; upstream ends the stream after it
+        self.finished = False
+        self._last_token = None
+
+    def headers_received(self):
+        llm_connect_time.labels(model=self.model).observe(time.perf_counter() - self.started)
+
+    def _token_received(self):
+        now = time.perf_counter()
+        if self._last_token is None:
+            llm_ttft.labels(model=self.model).observe(now - self.started)
+        else:
+            llm_inter_token_time.labels(model=self.model).observe(now - self._last_token)
+        self._last_token = now
+
+    def close(self):
+        """Record stream duration and token usage once the upstream body is consumed"""
+        llm_stream_time.labels(model=self.model).observe(time.perf_counter() - self.started)
+        chat_tokens_total.labels(type='input').inc(self.usage.get('input_tokens') or 0)
+        chat_tokens_total.labels(type='output').inc(self.usage.get('output_tokens') or 0)
+        chat_tokens_total.labels(type='cache_read').inc(self.usage.get('cache_read_input_tokens') or 0)
+        chat_tokens_total.labels(type='cache_creation').inc(self.usage.get('cache_creation_input_tokens') or 0)
+
+    def feed(self, line):
+        """Consume one SSE line; returns a text delta to forward to the client, or None"""
+        if not line.startswith('data: '):
+            return None
+        data_str = line[6:]
+        if data_str == '[DONE]':
+            self.finished = True
+            return None
+        try:
+            data = json.loads(data_str)
+        except json.JSONDecodeError:
+            return None
+
+        event_type = data.get('type')
+        if event_type == 'content_block_delta':
+            delta = data.get('delta', {})
+            index = data.get('index', 0)
+            self.blocks.setdefault(index, {'type': 'text', 'text': ''})
+            if delta.get('type') == 'text_delta':
+                text = delta.get('text', '')
+                self.text_parts.setdefault(index, []).append(text)
+                self._token_received()
+                return text
+            if delta.get('type') == 'input_json_delta':
+                self.tool_json.setdefault(index, []).append(delta.get('partial_json', ''))
+        elif event_type == 'content_block_start':
+            block = dict(data.get('content_block', {}))
+            if block.get('type') == 'tool_use':
+                block['input'] = {}
+            self.blocks[data.get('index', 0)] = block
+        elif event_type == 'message_start':
+            # Input and cache token counts; output_tokens here is only a placeholder
+            self.usage.update(data.get('message', {}).get('usage') or {})
+        elif event_type == 'message_delta':
+            self.stop_reason = data.get('delta', {}).get('stop_reason') or self.stop_reason
+            # Cumulative output token count for the whole message
+            self.usage.update(data.get('usage') or {})
+        elif event_type == 'error':
+            # Mid-stream failure (e.g. overloaded_error) after a 200 response
+            self.error = data.get('error') or {}
+        return None
+
+    def tool_uses(self):
+        """tool_use blocks with their streamed JSON input decoded"""
+        uses = []
+        for index, block in sorted(self.blocks.items()):
+            if block.get('type') != 'tool_use':
+                continue
+            raw = ''.join(self.tool_json.get(index, []))
+            try:
+                block['input'] = json.loads(raw) if raw else {}
+            except json.JSONDecodeError:
+                block['input'] = {'_invalid_json': raw[:200]}
+            uses.append(block)
+        return uses
+
+    def assistant_content(self):
+        """Content blocks to echo back as the assistant turn before tool results"""
+        content = []
+        for index, block in sorted(self.blocks.items()):
+            text = block.get('text', '') + ''.join(self.text_parts.get(index, ()))
+            if block.get('type') == 'text' and text:
+                content.append({'type': 'text', 'text': text})
+            elif block.get('type') == 'tool_use':
+                content.append({'type': 'tool_use', 'id': block['id'], 'name': block['name'], 'input': block['input']})
+        return content
+
+
+def text_vector(text, n=3, dims=1024):
+    """L2-normalized hashed character n-gram vector (a dependency-free local embedding)"""
+    padded = f" {normalize_text(text)} "
+    counts = {}
+    for i in range(max(1, len(padded) - n + 1)):
+        slot = zlib.crc32(padded[i:i + n].encode('utf-8')) % dims  # Stable across processes, unlike hash()
+        counts[slot] = counts.get(slot, 0) + 1
+    norm = math.sqrt(sum(v * v for v in counts.values())) or 1.0
+    return {slot: v / norm for slot, v in counts.items()}
+
+def cosine(a, b):
+    if len(a) > len(b):
+        a, b = b, a
+    return sum(v * b.get(slot, 0.0) for slot, v in a.items())
+
+_NUMBER = re.compile(r'\d+(?:\.\d+)?')
+
+class ResponseCache:
+    """Cache of complete answers keyed on (model, system prompt, normalized history, prompt).
+
+    The exact tier matches the normalized prompt. The optional similarity tier
+    matches prompts in the same context whose n-gram vectors are within
+    `similarity` cosine and that mention exactly the same numbers, so "runway 5"
+    never answers "runway 23". Entries are appended to a JSON lines file in
+    DATA_DIR and compacted on load.
+    """
+    def __init__(self, path, max_entries=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL,
+                 similarity=RESPONSE_CACHE_SIMILARITY):
+        self.path = path
+        self.max_entries = max(1, max_entries)
+        self.ttl = ttl
+        self.similarity = similarity
+        self._entries = OrderedDict()   # key -> entry
+        self._by_context = {}           # context hash -> {keys}
+        self._lock = threading.Lock()
+        self._appended = 0
+        self.load()
+
+    @staticmethod
+    def keys(payload, prompt):
+        """(context hash, exact key) for a request payload built by ClaudeLLM.build_payload"""
+        history = [(m['role'], normalize_text(m['content']) if isinstance(m['content'], str) else m['content'])
+                   for m in payload['messages'][:-1]]
+        system = [block.get('text') for block in payload.get('system') or []]
+        context = hashlib.sha256(json.dumps([payload['model'], system, history]).encode('utf-8')).hexdigest()
+        key = hashlib.sha256(f"{context}:{normalize_text(prompt)}".encode('utf-8')).hexdigest()
+        return context, key
+
+    def lookup(self, context, key, prompt):
+        """Returns (entry, 'exact' | 'similar') or (None, None)"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            tier = 'exact' if entry else None
+            if entry is None and self.similarity > 0:
+                vector, numbers = text_vector(prompt), _NUMBER.findall(prompt)
+                best = 0.0
+                for candidate_key in self._by_context.get(context, ()):
+                    candidate = self._entries[candidate_key]
+                    if candidate['numbers'] != numbers:
+                        continue
+                    score = cosine(vector, candidate['vector'])
+                    if score >= self.similarity and score > best:
+                        entry, tier, best = candidate, 'similar', score
+            if entry and now - entry['created'] > self.ttl:
+                self._remove(entry['key'], 'ttl')
+                entry = tier = None
+            if entry:
+                self._entries.move_to_end(entry['key'])
+        response_cache_requests_total.labels(result=f"hit_{tier}" if entry else 'miss').inc()
+        if entry:
+            response_cache_saved_seconds.inc(entry['seconds'])
+        return entry, tier
+
+    def store(self, context, key, prompt, response, seconds):
+        entry = {'key': key, 'context': context, 'prompt': prompt, 'response': response,
+                 'seconds': round(seconds, 3), 'created': time.time()}
+        with self._lock:
+            self._add(entry)
+            self._append(entry)
+
+    def _add(self, entry):
+        entry['vector'] = text_vector(entry['prompt'])
+        entry['numbers'] = _NUMBER.findall(entry['prompt'])
+        if entry['key'] in self._entries:
+            self._remove(entry['key'], None)
+        self._entries[entry['key']] = entry
+        self._by_context.setdefault(entry['context'], set()).add(entry['key'])
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)), 'lru')
+        response_cache_entries.set(len(self._entries))
+
+    def _remove(self, key, reason):
+        entry = self._entries.pop(key)
+        keys = self._by_context.get(entry['context'])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_context[entry['context']]
+        if reason:
+            response_cache_evictions_total.labels(reason=reason).inc()
+        response_cache_entries.set(len(self._entries))
+
+    @staticmethod
+    def _record(entry):
+        return json.dumps({k: entry[k] for k in ('key', 'context', 'prompt', 'response', 'seconds', 'created')})
+
+    def _append(self, entry):
+        try:
+            with open(self.path, 'a') as f:
+                f.write(self._record(entry) + '\n')
+            self._appended += 1
+            if self._appended > 2 * self.max_entries:
+                self._compact()
+        except OSError as e:
+            print(f"WARNING: Could not persist response cache entry: {e}")
+
+    def _compact(self):
+        """Rewrite the file with only the live entries"""
+        with open(self.path + '.tmp', 'w') as f:
+            for entry in self._entries.values():
+                f.write(self._record(entry) + '\n')
+        os.replace(self.path + '.tmp', self.path)
+        self._appended = len(self._entries)
+
+    def load(self):
+        """Restore unexpired entries from the persisted file (last write wins)"""
+        if not os.path.exists(self.path):
+            return
+        now = time.time()
+        with self._lock:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # Torn final line after a crash
+                    if now - entry.get('created', 0) <= self.ttl:
+                        self._add(entry)
+            self._compact()
+        print(f"✓ Response cache: {len(self._entries)} entries restored")
+
+
+def replay_tokens(text):
+    """Split a cached answer into word-sized pieces for a simulated token stream"""
+    return re.findall(r'\S+\s*|\s+', text)
+
 
 # Claude LLM with CSV Context
 class ClaudeLLM:
@@ -273,135 +949,1301 @@ class ClaudeLLM:
         if not self.api_key:
             raise ValueError("No Anthropic API key found. Set ANTHROPIC_API_KEY or create ~/.anthropic/api_key")
 
-        self.api_url = "https://api.anthropic.com/v1/messages"
+        self.api_url = ANTHROPIC_API_URL
+        self.model = "claude-sonnet-4-20250514"
         self.csv_loader = csv_loader
+        self.http = build_http_session()
+        self._system_context = None
+        self._system_blocks = None
+        self._system_tokens = 0
+        self.response_cache = ResponseCache(os.path.join(DATA_DIR, 'response_cache.jsonl')) if RESPONSE_CACHE else None
+
+    def system_blocks(self):
+        """System prompt as a cache_control-marked block, rebuilt only when the CSV context changes"""
+        # Base system prompt with CSV dataset context
+        context = self.csv_loader.get_system_prompt_context() if self.csv_loader else ""
+        if self._system_blocks is None or context is not self._system_context:
+            block = {'type': 'text', 'text': "You are Claude, a helpful AI assistant." + context}
+            if PROMPT_CACHE:
+                # Identical prefix every turn: let Anthropic serve it from the prompt cache
+                block['cache_control'] = {'type': 'ephemeral'}
+            self._system_context = context
+            self._system_blocks = [block]
+            self._system_tokens = estimate_tokens(block['text'])
+        return self._system_blocks
+
+    def build_payload(self, prompt, conversation_history=None, summary=None):
+        """Build the Messages API request body"""
+        # Build conversation messages from history if provided (already packed to the token budget)
+        messages = []
+        history_tokens = 0
+        if conversation_history:
+            for msg in conversation_history:
+                if msg['role'] in ['user', 'assistant']:
+                    messages.append({
+                        'role': msg['role'],
+                        'content': msg['content']
+                    })
+                    history_tokens += message_tokens(msg)
+
+        # Add current user message
+        messages.append({
+            'role': 'user',
+            'content': prompt
+        })
+
+        system = self.system_blocks()
+        if summary:
+            # After the cached block so the prompt-cache prefix is unchanged
+            system = system + [{'type': 'text', 'text': "Summary of earlier turns in this conversation:\n" + summary}]
+
+        prompt_tokens = estimate_tokens(prompt)
+        summary_tokens = estimate_tokens(summary)
+        context_tokens.labels(part='system').observe(self._system_tokens)
+        context_tokens.labels(part='history').observe(history_tokens)
+        context_tokens.labels(part='summary').observe(summary_tokens)
+        context_tokens.labels(part='prompt').observe(prompt_tokens)
+        context_tokens.labels(part='total').observe(self._system_tokens + history_tokens + summary_tokens + prompt_tokens)
+
+        payload = {
+            "model": self.model,
+            "max_tokens": 8192,  # Large limit for passthrough
+            "temperature": 1.0,   # Default temperature
+            "system": system,
+            "messages": messages,
+            "stream": True
+        }
+        if self.tools_enabled():
+            payload['tools'] = [DATASET_TOOL]
+        return payload
+
+    def tools_enabled(self):
+        return CSV_TOOLS and self.csv_loader is not None and self.csv_loader.table is not None
+
+    def request_headers(self):
+        return {
+            'Content-Type': 'application/json',
+            'x-api-key': self.api_key,
+            'anthropic-version': '2023-06-01'
+        }
 
-    def generate_stream(self, prompt, session_id, conversation_history=None):
-        """Generate streaming response from Claude with CSV context"""
+    def run_tool(self, name, tool_input):
+        """Execute one tool call locally; returns (result text, is_error)"""
+        start = time.time()
         try:
-            # Base system prompt with CSV dataset context
-            system_message = "You are Claude, a helpful AI assistant."
-
-            # Add CSV context if available
-            if self.csv_loader:
-                system_message += self.csv_loader.get_system_prompt_context()
-
-            # Build conversation messages from history if provided
-            messages = []
-            if conversation_history:
-                for msg in conversation_history[-10:]:  # Last 10 messages for context
-                    if msg['role'] in ['user', 'assistant']:
-                        messages.append({
-                            'role': msg['role'],
-                            'content': msg['content']
-                        })
-
-            # Add current user message
-            messages.append({
-                'role': 'user',
-                'content': prompt
-            })
-
-            payload = {
-                "model": "claude-sonnet-4-20250514",
-                "max_tokens": 8192,  # Large limit for passthrough
-                "temperature": 1.0,   # Default temperature
-                "system": system_message,
-                "messages": messages,
-                "stream": True
-            }
+            if name != DATASET_TOOL['name']:
+                raise ValueError(f"Unknown tool: {name}")
+            result = self.csv_loader.query(tool_input if isinstance(tool_input, dict) else {})
+            text, truncated = cap_tool_result(result)
+            status, is_error = ('truncated' if truncated else 'ok'), False
+        except (ValueError, KeyError, TypeError) as e:
+            text, status, is_error = json.dumps({'error': str(e)}), 'error', True
+        tool_call_time.labels(tool=name).observe(time.time() - start)
+        tool_calls_total.labels(tool=name, status=status).inc()
+        tool_result_bytes.labels(tool=name).observe(len(text))
+        return text, is_error
+
+    def continue_with_tools(self, payload, turn, rounds_left):
+        """Append the assistant tool_use turn and local tool results to payload.
+
+        Returns client events describing each call. On the last allowed round
+        tool_choice is set to none so the model has to answer from what it has.
+        """
+        results, events = [], []
+        for use in turn.tool_uses():
+            start = time.time()
+            text, is_error = self.run_tool(use['name'], use['input'])
+            results.append({'type': 'tool_result', 'tool_use_id': use['id'], 'content': text, 'is_error': is_error})
+            events.append({'tool': use['name'], 'input': use['input'], 'error': is_error,
+                           'seconds': round(time.time() - start, 4)})
+        payload['messages'] = payload['messages'] + [
+            {'role': 'assistant', 'content': turn.assistant_content()},
+            {'role': 'user', 'content': results}
+        ]
+        if rounds_left <= 1:
+            payload['tool_choice'] = {'type': 'none'}
+        return events
+
+    def cache_lookup(self, payload, prompt, use_cache):
+        """Returns (cache keys or None, cached entry, tier)"""
+        if not (self.response_cache and use_cache):
+            return None, None, None
+        keys = ResponseCache.keys(payload, prompt)
+        entry, tier = self.response_cache.lookup(*keys, prompt)
+        return keys, entry, tier
+
+    def cache_store(self, keys, prompt, response, stop_reason, started):
+        # Only complete, final answers; truncated or errored streams are not reused
+        if keys and response and stop_reason == 'end_turn':
+            self.response_cache.store(*keys, prompt, response, time.perf_counter() - started)
+
+    def request_tokens(self, prompt, conversation_history=None, summary=None):
+        """Estimated input tokens of a request, for the admission token-rate limit"""
+        history = sum(message_tokens(m) for m in conversation_history or [])
+        return self._system_tokens + history + estimate_tokens(summary) + estimate_tokens(prompt)
+
+    def generate_stream(self, prompt, session_id, conversation_history=None, summary=None, use_cache=True,
+                        user_id='anonymous'):
+        """Stream a Claude response with CSV context as event dicts.
+
+        Events: {'token'}, {'tool'}, {'queued'}, then {'done', 'usage'} or {'error'}.
+        They are serialized once, at the edge (see sse_event).
+        """
+        try:
+            started = time.perf_counter()
+            payload = self.build_payload(prompt, conversation_history, summary)
+            cache_keys, cached, tier = self.cache_lookup(payload, prompt, use_cache)
+            if cached:
+                # Same event shape as a live stream so clients cannot tell the difference
+                for piece in replay_tokens(cached['response']):
+                    if RESPONSE_CACHE_REPLAY_DELAY:
+                        time.sleep(RESPONSE_CACHE_REPLAY_DELAY)
+                    yield {'token': piece}
+                yield {'done': True, 'usage': {}, 'cached': tier}
+                return
 
-            llm_requests_total.labels(status='initiated').inc()
-
-            response = requests.post(
-                self.api_url,
-                json=payload,
-                timeout=60,
-                headers={
-                    'Content-Type': 'application/json',
-                    'x-api-key': self.api_key,
-                    'anthropic-version': '2023-06-01'
-                },
-                stream=True
-            )
+            # Admission: global/per-user concurrency and token-rate limits with fair queuing
+            ticket = admission.enter(user_id, self.request_tokens(prompt, conversation_history, summary))
+            try:
+                if not ticket.granted:
+                    yield {'queued': admission.position(ticket)}
+                    if not admission.wait(ticket):
+                        admission_rejected_total.labels(reason='timeout').inc()
+                        yield {'error': 'Upstream queue timeout; please retry'}
+                        return
+
+                response_parts = []
+                usage = {}
+
+                # One upstream request per round; tool_use stops continue with local results
+                for round_number in range(TOOL_MAX_ROUNDS + 1):
+                    llm_requests_total.labels(status='initiated').inc()
+
+                    turn = StreamTurn(self.model, time.perf_counter())
+                    response = self.http.post(
+                        self.api_url,
+                        json=payload,
+                        timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT),
+                        headers=self.request_headers(),
+                        stream=True
+                    )
+
+                    # Closing releases the connection back to the pool once the body is drained
+                    with response:
+                        if response.status_code != 200:
+                            llm_requests_total.labels(status='error').inc()
+                            error_msg = f'Claude API error: {response.status_code} - {response.text[:200]}'
+                            yield {'error': error_msg}
+                            return
+
+                        llm_requests_total.labels(status='success').inc()
+                        turn.headers_received()
+
+                        # Parse SSE stream from Claude
+                        for line in response.iter_lines():
+                            if line:
+                                text = turn.feed(line.decode('utf-8'))
+                                if turn.finished:
+                                    break
+                                if text is not None:
+                                    response_parts.append(text)
+                                    yield {'token': text}
+                        turn.close()
+                        add_usage(usage, turn.usage)
+
+                        if turn.error:
+                            # Partial answer: report it, never cache it
+                            llm_requests_total.labels(status='stream_error').inc()
+                            error_msg = f"Claude API error: {turn.error.get('type')} - {turn.error.get('message')}"
+                            yield {'error': error_msg}
+                            return
+
+                    if turn.stop_reason != 'tool_use' or not self.tools_enabled():
+                        break
+                    for event in self.continue_with_tools(payload, turn, TOOL_MAX_ROUNDS - round_number):
+                        yield event
+
+                self.cache_store(cache_keys, prompt, ''.join(response_parts), turn.stop_reason, started)
+
+                # Send completion signal with the turn's summed upstream usage
+                yield {'done': True, 'usage': usage}
+            finally:
+                admission.leave(ticket)
 
-            if response.status_code != 200:
-                llm_requests_total.labels(status='error').inc()
-                error_msg = f'Claude API error: {response.status_code} - {response.text[:200]}'
-                yield f"data: {json.dumps({'error': error_msg})}\n\n"
+        except Exception as e:
+            chat_errors_total.labels(type='llm_error').inc()
+            yield {'error': str(e)}
+
+    async def open_stream_async(self, client, payload):
+        """POST a streaming request, retrying 429/5xx responses with the backoff the threaded path gets from MeteredRetry.
+
+        Connect errors are retried by the client's transport; a response
+        that has started streaming is never replayed.
+        """
+        host = urlparse(self.api_url).hostname
+        retries = 0
+        while True:
+            request = client.build_request('POST', self.api_url, json=payload, headers=self.request_headers())
+            response = await client.send(request, stream=True)
+            if response.status_code not in RETRY_STATUSES or retries >= HTTP_MAX_RETRIES:
+                return response
+            retries += 1
+            await response.aclose()
+            http_retries_total.labels(host=host, reason=str(response.status_code)).inc()
+            await asyncio.sleep(retry_backoff(retries, response.headers.get('retry-after')))
+
+    async def generate_stream_async(self, client, prompt, session_id, conversation_history=None, summary=None,
+                                    use_cache=True, user_id='anonymous'):
+        """Asyncio variant of generate_stream over a shared httpx.AsyncClient"""
+        try:
+            started = time.perf_counter()
+            payload = self.build_payload(prompt, conversation_history, summary)
+            cache_keys, cached, tier = self.cache_lookup(payload, prompt, use_cache)
+            if cached:
+                for piece in replay_tokens(cached['response']):
+                    if RESPONSE_CACHE_REPLAY_DELAY:
+                        await asyncio.sleep(RESPONSE_CACHE_REPLAY_DELAY)
+                    yield {'token': piece}
+                yield {'done': True, 'usage': {}, 'cached': tier}
                 return
 
-            llm_requests_total.labels(status='success').inc()
-
-            # Parse SSE stream from Claude
-            full_response = ""
-            for line in response.iter_lines():
-                if line:
-                    line = line.decode('utf-8')
-                    if line.startswith('data: '):
-                        data_str = line[6:]
-                        if data_str == '[DONE]':
-                            break
-                        try:
-                            data = json.loads(data_str)
-                            if data.get('type') == 'content_block_delta':
-                                delta = data.get('delta', {})
-                                if delta.get('type') == 'text_delta':
-                                    text = delta.get('text', '')
-                                    full_response += text
-                                    yield f"data: {json.dumps({'token': text})}\n\n"
-                                    chat_tokens_total.labels(type='generated').inc()
-                        except json.JSONDecodeError:
-                            continue
-
-            # Send completion signal
-            yield f"data: {json.dumps({'done': True})}\n\n"
-            return full_response
+            # Admission: global/per-user concurrency and token-rate limits with fair queuing
+            ticket = admission.enter(user_id, self.request_tokens(prompt, conversation_history, summary))
+            try:
+                if not ticket.granted:
+                    yield {'queued': admission.position(ticket)}
+                    if not await admission.wait_async(ticket):
+                        admission_rejected_total.labels(reason='timeout').inc()
+                        yield {'error': 'Upstream queue timeout; please retry'}
+                        return
+
+                response_parts = []
+                usage = {}
+
+                for round_number in range(TOOL_MAX_ROUNDS + 1):
+                    llm_requests_total.labels(status='initiated').inc()
+
+                    turn = StreamTurn(self.model, time.perf_counter())
+                    response = await self.open_stream_async(client, payload)
+                    try:
+                        if response.status_code != 200:
+                            llm_requests_total.labels(status='error').inc()
+                            body = (await response.aread()).decode('utf-8', 'replace')
+                            error_msg = f'Claude API error: {response.status_code} - {body[:200]}'
+                            yield {'error': error_msg}
+                            return
+
+                        llm_requests_total.labels(status='success').inc()
+                        turn.headers_received()
+
+                        async for line in response.aiter_lines():
+                            if line:
+                                text = turn.feed(line)
+                                if turn.finished:
+                                    break
+                                if text is not None:
+                                    response_parts.append(text)
+                                    yield {'token': text}
+                        turn.close()
+                        add_usage(usage, turn.usage)
+
+                        if turn.error:
+                            # Partial answer: report it, never cache it
+                            llm_requests_total.labels(status='stream_error').inc()
+                            error_msg = f"Claude API error: {turn.error.get('type')} - {turn.error.get('message')}"
+                            yield {'error': error_msg}
+                            return
+                    finally:
+                        await response.aclose()
+
+                    if turn.stop_reason != 'tool_use' or not self.tools_enabled():
+                        break
+                    # Tool queries scan the columnar index; keep them off the event loop
+                    events = await asyncio.to_thread(self.continue_with_tools, payload, turn, TOOL_MAX_ROUNDS - round_number)
+                    for event in events:
+                        yield event
+
+                self.cache_store(cache_keys, prompt, ''.join(response_parts), turn.stop_reason, started)
+
+                # Send completion signal with the turn's summed upstream usage
+                yield {'done': True, 'usage': usage}
+            finally:
+                admission.leave(ticket)
 
         except Exception as e:
             chat_errors_total.labels(type='llm_error').inc()
-            yield f"data: {json.dumps({'error': str(e)})}\n\n"
+            yield {'error': str(e)}
+
+
+class AdmissionTicket:
+    """One request's place in the admission queue"""
+    __slots__ = ('user', 'tokens', 'granted', 'released', 'enqueued', '_event', '_waiters')
+
+    def __init__(self, user, tokens):
+        self.user = user
+        self.tokens = tokens
+        self.granted = False
+        self.released = False
+        self.enqueued = time.time()
+        self._event = threading.Event()
+        self._waiters = []      # (loop, future) for asyncio waiters
+
+class AdmissionController:
+    """Global and per-user upstream concurrency plus global and per-user input token-rate budgets.
+
+    Waiting requests are kept in one FIFO per user and granted round-robin
+    across users, so one user's burst cannot starve everyone else. A user
+    whose own token bucket is empty is skipped until it refills, so large
+    prompts only hold back their sender. Works for both threads (wait) and
+    asyncio tasks (wait_async).
+    """
+    def __init__(self, max_concurrency=LLM_MAX_CONCURRENCY, per_user=LLM_MAX_PER_USER,
+                 token_rate=LLM_TOKEN_RATE, timeout=LLM_QUEUE_TIMEOUT, user_token_rate=LLM_USER_TOKEN_RATE):
+        self.max_concurrency = max(1, max_concurrency)
+        self.per_user = max(1, per_user)
+        self.token_rate = token_rate
+        self.user_token_rate = user_token_rate
+        self.timeout = timeout
+        self.active = 0
+        self._queues = OrderedDict()    # user -> deque of tickets; key order is the round-robin rotation
+        self._active = {}               # user -> granted tickets
+        self._tokens = float(token_rate)
+        self._refilled = time.monotonic()
+        self._user_tokens = {}          # user -> (tokens, refilled); absent = full bucket
+        self._swept = self._refilled
+        self._timer = None
+        self._timer_due = None
+        self._lock = threading.Lock()
+
+    def enter(self, user, tokens):
+        """Queue a request; the returned ticket is already granted when capacity is free"""
+        # Capped at each bucket's size so a huge prompt still gets through once a bucket is full
+        for rate in (self.token_rate, self.user_token_rate):
+            if rate:
+                tokens = min(tokens, rate)
+        ticket = AdmissionTicket(user, tokens)
+        with self._lock:
+            self._queues.setdefault(user, deque()).append(ticket)
+            self._dispatch()
+            self._update_gauges()
+        return ticket
+
+    def position(self, ticket):
+        """Queue position details for the SSE "queued" event"""
+        with self._lock:
+            queue_ = self._queues.get(ticket.user, ())
+            return {
+                'position': queue_.index(ticket) + 1 if ticket in queue_ else 0,
+                'depth': sum(len(q) for q in self._queues.values()),
+                'active': self.active
+            }
+
+    def wait(self, ticket, timeout=None):
+        """Block until granted; returns False (and leaves the queue) on timeout"""
+        if ticket._event.wait(timeout or self.timeout):
+            admission_wait_time.observe(time.time() - ticket.enqueued)
+            return True
+        return self._abandon(ticket)
+
+    async def wait_async(self, ticket, timeout=None):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self._lock:
+            if ticket.granted:
+                future.set_result(None)
+            else:
+                ticket._waiters.append((loop, future))
+        try:
+            await asyncio.wait_for(future, timeout or self.timeout)
+        except asyncio.TimeoutError:
+            return self._abandon(ticket)
+        admission_wait_time.observe(time.time() - ticket.enqueued)
+        return True
+
+    def leave(self, ticket):
+        """Release a granted slot, or drop a ticket that is still queued"""
+        with self._lock:
+            if ticket.released:
+                return
+            ticket.released = True
+            if ticket.granted:
+                self.active -= 1
+                self._active[ticket.user] -= 1
+                if not self._active[ticket.user]:
+                    del self._active[ticket.user]
+            else:
+                self._dequeue(ticket)
+            self._dispatch()
+            self._update_gauges()
+
+    def _abandon(self, ticket):
+        with self._lock:
+            if ticket.granted:
+                return True     # Granted right at the deadline
+            self._dequeue(ticket)
+            ticket.released = True
+            self._update_gauges()
+        return False
+
+    def _dequeue(self, ticket):
+        queue_ = self._queues.get(ticket.user)
+        if queue_ and ticket in queue_:
+            queue_.remove(ticket)
+            if not queue_:
+                del self._queues[ticket.user]
+
+    def _dispatch(self):
+        """Grant queued tickets while capacity allows (caller holds the lock)"""
+        if self.token_rate:
+            now = time.monotonic()
+            self._tokens = min(self.token_rate, self._tokens + (now - self._refilled) * self.token_rate / 60)
+            self._refilled = now
+
+        now = time.monotonic()
+        if self.user_token_rate and now - self._swept > 60:
+            # A bucket untouched for a minute has refilled completely
+            self._user_tokens = {u: b for u, b in self._user_tokens.items() if now - b[1] < 60}
+            self._swept = now
+
+        while self.active < self.max_concurrency:
+            # First user in rotation order under the per-user limit with enough tokens of their own
+            refill = None
+            for user, queue_ in self._queues.items():
+                if self._active.get(user, 0) >= self.per_user:
+                    continue
+                if self.user_token_rate:
+                    short = queue_[0].tokens - self._user_available(user, now)
+                    if short > 0:
+                        delay = short * 60 / self.user_token_rate
+                        refill = delay if refill is None else min(refill, delay)
+                        continue
+                break
+            else:
+                if refill is not None:
+                    self._schedule(refill)
+                return
+
+            ticket = queue_[0]
+            if self.token_rate:
+                if ticket.tokens > self._tokens:
+                    self._schedule((ticket.tokens - self._tokens) * 60 / self.token_rate)
+                    return
+                self._tokens -= ticket.tokens
+            if self.user_token_rate:
+                self._user_tokens[user] = (self._user_available(user, now) - ticket.tokens, now)
+
+            queue_.popleft()
+            if queue_:
+                self._queues.move_to_end(user)  # Served: go to the back of the rotation
+            else:
+                del self._queues[user]
+
+            ticket.granted = True
+            self.active += 1
+            self._active[user] = self._active.get(user, 0) + 1
+            ticket._event.set()
+            for loop, future in ticket._waiters:
+                loop.call_soon_threadsafe(resolve_future, future)
+
+    def _user_available(self, user, now):
+        """Tokens in a user's bucket (caller holds the lock)"""
+        bucket = self._user_tokens.get(user)
+        if bucket is None:
+            return self.user_token_rate
+        tokens, refilled = bucket
+        return min(self.user_token_rate, tokens + (now - refilled) * self.user_token_rate / 60)
+
+    def _schedule(self, delay):
+        """Re-run dispatch once a token bucket has refilled enough"""
+        due = time.monotonic() + delay
+        if self._timer is not None:
+            if self._timer_due <= due:
+                return
+            self._timer.cancel()
+        self._timer = threading.Timer(delay, self._on_timer)
+        self._timer.daemon = True
+        self._timer_due = due
+        self._timer.start()
+
+    def _on_timer(self):
+        with self._lock:
+            self._timer = None
+            self._dispatch()
+            self._update_gauges()
+
+    def _update_gauges(self):
+        admission_queue_depth.set(sum(len(q) for q in self._queues.values()))
+        admission_inflight.set(self.active)
+
+
+admission = AdmissionController()
+hub = StreamHub(coalesce=LLM_COALESCE)
+
+
+def cap_tool_result(result):
+    """Serialize a query result within TOOL_RESULT_MAX_BYTES; returns (text, truncated)"""
+    text = json.dumps(result, default=str)
+    if len(text) <= TOOL_RESULT_MAX_BYTES:
+        return text, False
+    groups = list(result.get('groups') or [])
+    while groups and len(text) > TOOL_RESULT_MAX_BYTES:
+        # Groups are ranked, so dropping from the tail keeps the most significant ones
+        groups = groups[:len(groups) // 2]
+        text = json.dumps({**result, 'groups': groups, 'truncated': True}, default=str)
+    if len(text) > TOOL_RESULT_MAX_BYTES:
+        text = json.dumps({'truncated': True, 'partial': text[:TOOL_RESULT_MAX_BYTES // 2]})
+    return text, True
+
+
+# Pooled upstream HTTP
+class TimedHTTPConnection(HTTPConnection):
+    """Records connect latency for each new (non-reused) connection"""
+    def connect(self):
+        start = time.time()
+        super().connect()
+        http_connect_time.labels(host=self.host).observe(time.time() - start)
+        http_connections_opened_total.labels(host=self.host).inc()
+
+class TimedHTTPSConnection(HTTPSConnection):
+    """Records connect + TLS handshake latency for each new connection"""
+    def connect(self):
+        start = time.time()
+        super().connect()
+        http_connect_time.labels(host=self.host).observe(time.time() - start)
+        http_connections_opened_total.labels(host=self.host).inc()
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+# Upstream statuses worth retrying (529 = Anthropic overloaded), on both the threaded and the asyncio path
+RETRY_STATUSES = (429, 500, 502, 503, 504, 529)
+
+def retry_backoff(retries, retry_after=None):
+    """Seconds before upstream retry number `retries`; the same schedule urllib3 follows for MeteredRetry"""
+    if retry_after:
+        try:
+            return Retry().parse_retry_after(retry_after)
+        except InvalidHeader:
+            pass  # Unparseable Retry-After: fall back to exponential backoff
+    if retries <= 1:
+        return 0.0
+    delay = HTTP_BACKOFF_FACTOR * 2 ** (retries - 1) + random.random() * HTTP_BACKOFF_JITTER
+    return min(delay, Retry.DEFAULT_BACKOFF_MAX)
+
+class MeteredRetry(Retry):
+    """urllib3 Retry that counts each retry by host and cause"""
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        reason = str(response.status) if response is not None else type(error).__name__
+        http_retries_total.labels(host=_pool.host if _pool else 'unknown', reason=reason).inc()
+        return super().increment(method, url, response, error, _pool, _stacktrace)
+
+class PooledHTTPAdapter(HTTPAdapter):
+    """Keep-alive connection pool with instrumented connections"""
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': TimedHTTPConnectionPool,
+            'https': TimedHTTPSConnectionPool
+        }
+
+    def send(self, request, **kwargs):
+        http_requests_sent_total.labels(host=urlparse(request.url).hostname).inc()
+        return super().send(request, **kwargs)
+
+def build_http_session():
+    """Shared requests.Session with keep-alive pooling and jittered retries on 429/5xx/connect errors"""
+    retry = MeteredRetry(
+        total=HTTP_MAX_RETRIES,
+        connect=HTTP_MAX_RETRIES,
+        read=0,  # Never replay a request whose response was already streaming
+        status=HTTP_MAX_RETRIES,
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=frozenset({'GET', 'POST'}),
+        backoff_factor=HTTP_BACKOFF_FACTOR,
+        backoff_jitter=HTTP_BACKOFF_JITTER,
+        respect_retry_after_header=True,
+        raise_on_status=False  # Hand the final error response back to the caller
+    )
+    adapter = PooledHTTPAdapter(
+        pool_connections=HTTP_POOL_CONNECTIONS,
+        pool_maxsize=HTTP_POOL_MAXSIZE,
+        max_retries=retry
+    )
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+# Offline batch processing
+def batch_item(entry, index, where):
+    """(custom_id, prompt) from a string, {"prompt"|"message": ...} or a Message Batches request object"""
+    if isinstance(entry, str):
+        prompt, custom_id = entry, index
+    elif isinstance(entry, dict):
+        prompt, custom_id = entry.get('prompt') or entry.get('message'), entry.get('custom_id', index)
+        params = entry.get('params')
+        if prompt is None and isinstance(params, dict) and params.get('messages'):
+            prompt = params['messages'][-1].get('content')  # Message Batches shape: the last user turn
+    else:
+        prompt = None
+    if not isinstance(prompt, str) or not prompt.strip():
+        raise ValueError(f'{where}: expected a prompt string or an object with "prompt"')
+    return str(custom_id), prompt
+
+def parse_batch_lines(lines):
+    """Batch items from JSONL lines; blank lines are skipped"""
+    items = []
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            raise ValueError(f'line {number}: invalid JSON')
+        items.append(batch_item(entry, len(items), f'line {number}'))
+    return items
+
+class BatchJobState:
+    """Bookkeeping for a job whose items are queued in this process"""
+    def __init__(self, job, remaining):
+        self.job_id = job['job_id']
+        self.user_id = job['user_id']
+        self.use_cache = job['options'].get('cache', True) is not False
+        self.output = open(job['output_path'], 'a', encoding='utf-8')
+        self.remaining = remaining
+        self.cancelled = False
+        self.lock = threading.Lock()
+
+class BatchRunner:
+    """Bounded worker pool for /batch jobs.
+
+    Items are stored in chat.db before they are queued, and each result is
+    appended to OUTPUT_DIR/batch-<job_id>.jsonl as soon as it finishes.
+    Unfinished jobs resume from their pending items after a restart. The
+    worker running a job holds its batch:<job_id> lease; when a worker dies,
+    another adopts its jobs once the lease expires. A job that stops with
+    items still pending releases its lease so the next heartbeat retries it.
+    """
+    def __init__(self, database, workers=BATCH_WORKERS, output_dir=OUTPUT_DIR):
+        self.db = database
+        self.workers = max(1, workers)
+        self.output_dir = output_dir
+        self._queue = queue.Queue()
+        self._jobs = {}         # job_id -> BatchJobState
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start the workers and resume jobs a previous process left unfinished"""
+        if self._threads:
+            return
+        os.makedirs(self.output_dir, exist_ok=True)
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f'batch-worker-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        thread_pool_size.labels(pool='batch').set(self.workers)
+
+        self.resume(startup=True)
+
+    def resume(self, held=(), startup=False):
+        """Adopt unfinished jobs nobody holds a lease on and stop local jobs cancelled through another worker.
+
+        At startup this also takes back jobs whose lease still names this
+        worker from before a restart. `held` are the lease names this worker
+        renewed; leases of jobs that are no longer unfinished are released.
+        """
+        unfinished = self.db.get_unfinished_batch_jobs()
+        with self._lock:
+            for job_id, state in self._jobs.items():
+                if job_id not in unfinished:
+                    state.cancelled = True
+            orphans = [job_id for job_id in unfinished if job_id not in self._jobs]
+
+        for name in held:
+            if name.startswith('batch:') and name[6:] not in unfinished:
+                self.db.release_lease(name, worker_id())
+
+        for job_id in orphans:
+            holder = self.db.lease_holder(f'batch:{job_id}')
+            if holder is None or (startup and holder == worker_id()):
+                if self.db.acquire_lease(f'batch:{job_id}', worker_id(), LEASE_TTL):
+                    print(f"Resuming batch job {job_id}")
+                    self._schedule(job_id)
+
+    def submit(self, items, user_id='batch', source='request', options=None):
+        """Persist a job and queue its items; returns the job_id"""
+        job_id = str(uuid.uuid4())
+        output_path = os.path.join(self.output_dir, f'batch-{job_id}.jsonl')
+        self.db.acquire_lease(f'batch:{job_id}', worker_id(), LEASE_TTL)  # Ours before other workers can see it
+        self.db.create_batch_job(job_id, user_id, source, output_path, items, options)
+        if self._threads:
+            self._schedule(job_id)
+        return job_id
+
+    def cancel(self, job_id):
+        """Stop a job; items not yet started stay pending and are not resumed"""
+        job = self.db.get_batch_job(job_id)
+        if job and job['status'] in ('queued', 'running'):
+            with self._lock:
+                if job_id in self._jobs:
+                    self._jobs[job_id].cancelled = True
+            self.db.set_batch_job_status(job_id, 'cancelled', finished_at=time.time())
+        return self.status(job_id)
+
+    def status(self, job_id):
+        """Progress, throughput and ETA for /job"""
+        job = self.db.get_batch_job(job_id)
+        if not job:
+            return None
+
+        items = job['items']
+        total = sum(items.values())
+        processed = items['done'] + items['failed']
+        elapsed = ((job['finished_at'] or time.time()) - job['started_at']) if job['started_at'] else 0
+        rate = processed / elapsed if elapsed > 0 else 0
+
+        def iso(ts):
+            return datetime.fromtimestamp(ts, timezone.utc).isoformat() if ts else None
+
+        return {
+            'job_id': job_id,
+            'status': job['status'],
+            'user_id': job['user_id'],
+            'source': job['source'],
+            'output_file': job['output_path'],
+            'total': total,
+            'items': items,
+            'progress': round(processed / total, 4) if total else 1.0,
+            'tokens': job['tokens'],
+            'created_at': job['created_at'],
+            'started_at': iso(job['started_at']),
+            'finished_at': iso(job['finished_at']),
+            'elapsed_seconds': round(elapsed, 3),
+            'items_per_second': round(rate, 3),
+            'eta_seconds': round(items['pending'] / rate, 1) if rate and job['status'] == 'running' else None
+        }
 
+    def _schedule(self, job_id):
+        job = self.db.get_batch_job(job_id)
+        self._reconcile(job)
+        pending = self.db.get_pending_batch_items(job_id)
+        now = time.time()
+        if not pending:
+            self.db.set_batch_job_status(job_id, 'completed', started_at=now, finished_at=now)
+            self.db.release_lease(f'batch:{job_id}', worker_id())
+            return
+
+        state = BatchJobState(job, len(pending))
+        with self._lock:
+            self._jobs[job_id] = state
+            batch_jobs_active.set(len(self._jobs))
+        self.db.set_batch_job_status(job_id, 'running', started_at=now)
+        for item in pending:
+            self._queue.put((state, item))
+        batch_queue_depth.set(self._queue.qsize())
+
+    def _reconcile(self, job):
+        """Adopt results written just before a crash and drop a torn final line"""
+        path = job['output_path']
+        if not os.path.exists(path):
+            return
+        with open(path, 'rb+') as f:
+            data = f.read()
+            end = data.rfind(b'\n') + 1
+            if end < len(data):
+                f.truncate(end)
+
+        pending = {item['index'] for item in self.db.get_pending_batch_items(job['job_id'])}
+        for line in data[:end].splitlines():
+            try:
+                result = json.loads(line)
+            except ValueError:
+                continue
+            if result.get('index') in pending:
+                self.db.finish_batch_item(job['job_id'], result)
+
+    def _run(self):
+        while True:
+            state, item = self._queue.get()
+            batch_queue_depth.set(self._queue.qsize())
+            thread_pool_busy.labels(pool='batch').inc()
+            try:
+                if not state.cancelled:
+                    result = self._process(state, item)
+                    # Output first: a crash before the row update is repaired by _reconcile
+                    with state.lock:
+                        state.output.write(json.dumps(result, ensure_ascii=False) + '\n')
+                        state.output.flush()
+                    self.db.finish_batch_item(state.job_id, result)
+                    batch_items_total.labels(status=result['status']).inc()
+            except Exception as e:
+                chat_errors_total.labels(type='batch_error').inc()
+                print(f"ERROR: Batch job {state.job_id} item {item['index']}: {e}")
+            finally:
+                thread_pool_busy.labels(pool='batch').dec()
+                self._item_finished(state)
+
+    def _process(self, state, item):
+        """Run one prompt without conversation history, retrying failed streams with backoff"""
+        started = time.time()
+        attempts = item['attempts']
+        while True:
+            attempts += 1
+            parts, usage, error = [], {}, None
+            for event in llm.generate_stream(item['prompt'], f'batch-{state.job_id}', use_cache=state.use_cache,
+                                             user_id=state.user_id):
+                if 'token' in event:
+                    parts.append(event['token'])
+                elif 'error' in event:
+                    error = event['error']
+                elif 'usage' in event:
+                    usage = event['usage']
+
+            retries = attempts - item['attempts']
+            if error is None or retries > BATCH_RETRIES or state.cancelled:
+                break
+            time.sleep(BATCH_RETRY_BACKOFF * 2 ** (retries - 1))
+
+        elapsed = time.time() - started
+        batch_item_time.observe(elapsed)
+        return {
+            'index': item['index'],
+            'custom_id': item['custom_id'],
+            'status': 'failed' if error else 'done',
+            'response': None if error else ''.join(parts),
+            'error': error,
+            'usage': usage,
+            'attempts': attempts,
+            'response_time': round(elapsed, 3)
+        }
+
+    def _item_finished(self, state):
+        with self._lock:
+            state.remaining -= 1
+            if state.remaining:
+                return
+            del self._jobs[state.job_id]
+            batch_jobs_active.set(len(self._jobs))
+        state.output.close()
+
+        if not state.cancelled:
+            pending = self.db.get_batch_job(state.job_id)['items']['pending']
+            if pending:
+                # Without the lease, the next heartbeat's resume() on any worker, this one included, retries them
+                print(f"WARNING: Batch job {state.job_id} stopped with {pending} pending items; releasing it for a retry")
+            else:
+                self.db.set_batch_job_status(state.job_id, 'completed', finished_at=time.time())
+        self.db.release_lease(f'batch:{state.job_id}', worker_id())
+
+batch_runner = BatchRunner(db)
+
+
+def parse_retention_policies(text):
+    """'pattern=days,...' -> [(user_id glob, days)]; the first matching pattern wins.
+
+    Malformed entries are skipped with a warning, so a typo never stops the agent from starting.
+    """
+    policies = []
+    for part in text.split(','):
+        if not part.strip():
+            continue
+        pattern, sep, days = part.rpartition('=')
+        try:
+            days = float(days)
+        except ValueError:
+            days = None
+        if not sep or not pattern.strip() or days is None or not math.isfinite(days) or days < 0:
+            print(f"WARNING: Ignoring retention policy {part.strip()!r} (expected user=days)")
+            continue
+        policies.append((pattern.strip(), days))
+    return policies
+
+class MaintenanceScheduler:
+    """Background retention, archival and compaction of chat.db.
+
+    Each run archives sessions idle longer than their user's retention to
+    gzipped NDJSON under ARCHIVE_DIR (same lines as /chat/export) and deletes
+    them, returns free pages with incremental vacuum, refreshes planner
+    statistics and checkpoints the WAL. Every step is a short transaction
+    followed by MAINTENANCE_STEP_DELAY so request traffic keeps the write lock.
+    Of the workers sharing chat.db, the holder of the maintenance lease runs
+    the schedule; the maintenance-run lease keeps runs from overlapping.
+    """
+    def __init__(self, database, message_writer, interval=MAINTENANCE_INTERVAL, retention_days=RETENTION_DAYS,
+                 policies=RETENTION_POLICIES, archive_dir=ARCHIVE_DIR if ARCHIVE else None):
+        self.db = database
+        self.writer = message_writer
+        self.interval = interval
+        self.retention_days = retention_days
+        self.policies = parse_retention_policies(policies)
+        self.archive_dir = archive_dir
+        self.last_run = None
+        self._run_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread or self.interval <= 0:
+            return
+        self._thread = threading.Thread(target=self._run, name='db-maintenance', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                if self.db.acquire_lease('maintenance', worker_id(), LEASE_TTL):
+                    self.run_once()
+            except Exception as e:
+                chat_errors_total.labels(type='db_maintenance').inc()
+                print(f"WARNING: Database maintenance skipped: {e}")
+
+    @property
+    def running(self):
+        return self._run_lock.locked() or self.db.lease_holder('maintenance-run') is not None
+
+    def status(self):
+        return {
+            'running': self.running,
+            'leader': self.db.lease_holder('maintenance'),
+            'interval': self.interval,
+            'retention_days': self.retention_days,
+            'policies': [{'user': pattern, 'days': days} for pattern, days in self.policies],
+            'archive_dir': self.archive_dir,
+            'storage': self.db.storage_stats(),
+            'last_run': self.last_run
+        }
+
+    def retention_for(self, user_id):
+        """Days a user's idle sessions are kept; 0 keeps them forever"""
+        for pattern, days in self.policies:
+            if fnmatch.fnmatchcase(user_id, pattern):
+                return days
+        return self.retention_days
+
+    def run_once(self):
+        """One maintenance pass; returns its report, or None if a pass is already running"""
+        if not self._run_lock.acquire(blocking=False):
+            return None
+        if not self.db.acquire_lease('maintenance-run', worker_id(), LEASE_TTL):
+            self._run_lock.release()
+            return None  # Running in another worker
+        start = time.time()
+        report = {'started_at': start, 'sessions': 0, 'messages': 0, 'archives': [], 'vacuumed_pages': 0}
+        try:
+            self.writer.flush()  # Queued messages bump last_active; let them land first
+            self._expire(report)
+            self._compact(report)
+            report['storage'] = self._update_size()
+            maintenance_runs_total.labels(status='success').inc()
+        except Exception as e:
+            report['error'] = str(e)
+            maintenance_runs_total.labels(status='error').inc()
+            chat_errors_total.labels(type='db_maintenance').inc()
+            print(f"WARNING: Database maintenance failed: {e}")
+        finally:
+            report['seconds'] = round(time.time() - start, 3)
+            self.last_run = report
+            try:
+                self.db.release_lease('maintenance-run', worker_id())
+            finally:
+                self._run_lock.release()
+
+        if report['sessions'] or report['vacuumed_pages']:
+            print(f"✓ Database maintenance: {report['sessions']} sessions / {report['messages']} messages archived, "
+                  f"{report['vacuumed_pages']} pages freed in {report['seconds']:.2f}s")
+        return report
+
+    def _timed(self, task, fn, *args):
+        start = time.time()
+        try:
+            return fn(*args)
+        finally:
+            maintenance_pause_time.labels(task=task).observe(time.time() - start)
+            self._stop.wait(MAINTENANCE_STEP_DELAY)
+
+    def _expire(self, report):
+        if not self.retention_days and not any(days for _, days in self.policies):
+            return
+        now = datetime.now(timezone.utc)
+        for user_id in self.db.get_user_ids():
+            days = self.retention_for(user_id)
+            if not days:
+                continue
+            cutoff = (now - timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
+            while not self._stop.is_set():
+                sessions = self.db.get_expired_sessions(user_id, cutoff, MAINTENANCE_BATCH_SIZE)
+                if not sessions:
+                    break
+                if self.archive_dir:
+                    report['archives'].append(self._archive(sessions))
+                deleted, messages = self._timed('retention', self.db.delete_sessions,
+                                                [s['session_id'] for s in sessions], cutoff)
+                maintenance_rows_total.labels(table='sessions').inc(deleted)
+                maintenance_rows_total.labels(table='messages').inc(messages)
+                report['sessions'] += deleted
+                report['messages'] += messages
+                if len(sessions) < MAINTENANCE_BATCH_SIZE:
+                    break
+
+    def _archive(self, sessions):
+        """Write sessions and their messages to a new .ndjson.gz, durable before anything is deleted"""
+        os.makedirs(self.archive_dir, exist_ok=True)
+        stamp = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S')
+        path = os.path.join(self.archive_dir, f'sessions-{stamp}-{uuid.uuid4().hex[:8]}.ndjson.gz')
+        with open(path + '.tmp', 'wb') as raw:
+            with gzip.GzipFile(fileobj=raw, mode='wb') as f:
+                for session in sessions:
+                    f.write((json.dumps({'type': 'session', **session}) + '\n').encode('utf-8'))
+                    for message in self.db.iter_messages(session['session_id']):
+                        f.write((json.dumps({'type': 'message', 'session_id': session['session_id'],
+                                             **message}) + '\n').encode('utf-8'))
+            raw.flush()
+            os.fsync(raw.fileno())
+        os.replace(path + '.tmp', path)
+        return os.path.basename(path)
+
+    def _compact(self, report):
+        stats = self.db.storage_stats()
+        if stats['auto_vacuum'] == 'incremental':
+            free = stats['free_pages']
+            while free > 0 and not self._stop.is_set():
+                self._timed('incremental_vacuum', self.db.incremental_vacuum, VACUUM_STEP_PAGES)
+                remaining = self.db.storage_stats()['free_pages']
+                report['vacuumed_pages'] += free - remaining
+                if remaining >= free:
+                    break
+                free = remaining
+        elif stats['page_count'] and stats['free_pages'] / stats['page_count'] > VACUUM_FULL_THRESHOLD:
+            # Databases created before incremental auto_vacuum: one full rebuild converts them
+            self._timed('full_vacuum', self.db.vacuum)
+            report['vacuumed_pages'] += stats['free_pages']
+        self._timed('optimize', self.db.optimize)
+        self._timed('checkpoint', self.db.checkpoint)
+
+    def _update_size(self):
+        stats = self.db.storage_stats()
+        db_size_bytes.labels(kind='file').set(stats['file_bytes'])
+        db_size_bytes.labels(kind='free').set(stats['free_bytes'])
+        db_size_bytes.labels(kind='wal').set(stats['wal_bytes'])
+        return stats
+
+maintenance = MaintenanceScheduler(db, writer)
+
+
+def backfill_search_index(database, batch=SEARCH_BACKFILL_BATCH):
+    """Index messages written before the search index existed, one short transaction at a time"""
+    start = time.time()
+    remaining = total = database.backfill_search(0)
+    while remaining:
+        step = time.time()
+        remaining = database.backfill_search(batch)
+        maintenance_pause_time.labels(task='search_backfill').observe(time.time() - step)
+        search_backfill_remaining.set(remaining)
+        time.sleep(MAINTENANCE_STEP_DELAY)
+    search_backfill_remaining.set(0)
+    if total:
+        print(f"✓ Search index backfilled ({total} message rowids) in {time.time() - start:.2f}s")
 
 # Service Registration with C2
-def register_with_c2():
+def service_registration():
+    """Registry entry for this instance; every worker of an INSTANCE_ID registers the same id"""
+    hostname = socket.gethostname()
+    return {
+        'id': f'crewai-chat-pt-air-{INSTANCE_ID}',
+        'name': 'crewai-chat-pt-air',
+        'type': 'chat',
+        'address': socket.gethostbyname(hostname),
+        'port': API_PORT,
+        'capabilities': ['chat', 'claude-passthrough', 'streaming'],
+        'tags': ['production', 'chat-interface', 'passthrough'],
+        'datacenter': 'dc1',
+        'environment': ENVIRONMENT,
+        'instance_id': INSTANCE_ID,
+        'heartbeat_interval': HEARTBEAT_INTERVAL,
+        'version': 'v1.0.0'
+    }
+
+def register_with_c2(http=None):
     """Register this agent with C2 service registry"""
     try:
-        import socket
-        hostname = socket.gethostname()
-        ip_address = socket.gethostbyname(hostname)
-
-        service_data = {
-            'id': 'crewai-chat-pt-air-002',
-            'name': 'crewai-chat-pt-air',
-            'type': 'chat',
-            'address': ip_address,
-            'port': API_PORT,
-            'capabilities': ['chat', 'claude-passthrough', 'streaming'],
-            'tags': ['production', 'chat-interface', 'passthrough'],
-            'datacenter': 'dc1',
-            'environment': 'prod',
-            'instance_id': '002',
-            'version': 'v1.0.0'
-        }
-
-        response = requests.post(
+        response = (http or requests).post(
             f"{C2_REGISTRY_URL}/registry/register",
-            json=service_data,
-            timeout=5
+            json=service_registration(),
+            timeout=(HTTP_CONNECT_TIMEOUT, 5)
         )
 
         if response.status_code == 200:
+            c2_requests_total.labels(call='register', status='ok').inc()
             print(f"Registered with C2 at {C2_REGISTRY_URL}")
             return True
         else:
+            c2_requests_total.labels(call='register', status='error').inc()
             print(f"Failed to register with C2: {response.status_code}")
             return False
 
     except Exception as e:
+        c2_requests_total.labels(call='register', status='error').inc()
         print(f"C2 registration error: {e}")
         return False
 
+def c2_heartbeat(http=None):
+    """Tell C2 this instance is alive; False when it must register again (unknown instance or unreachable)"""
+    try:
+        response = (http or requests).post(
+            f"{C2_REGISTRY_URL}/registry/heartbeat",
+            json={'id': f'crewai-chat-pt-air-{INSTANCE_ID}', 'instance_id': INSTANCE_ID, 'timestamp': time.time()},
+            timeout=(HTTP_CONNECT_TIMEOUT, 5)
+        )
+    except Exception as e:
+        c2_requests_total.labels(call='heartbeat', status='error').inc()
+        print(f"C2 heartbeat error: {e}")
+        return False
+    status = 'ok' if response.status_code == 200 else 'expired' if response.status_code in (404, 410) else 'error'
+    c2_requests_total.labels(call='heartbeat', status=status).inc()
+    return status == 'ok'
+
+class InstanceHeartbeat:
+    """Per-worker upkeep, once at start and then every HEARTBEAT_INTERVAL.
+
+    Renews the storage leases this worker holds (maintenance leadership,
+    batch jobs), adopts batch jobs whose worker stopped renewing, refreshes
+    chat_sessions_active from storage and keeps the instance registered with
+    C2. One worker per INSTANCE_ID, the holder of its c2 lease, talks to C2:
+    it heartbeats while registered and registers again whenever a heartbeat
+    is refused or fails.
+    """
+    def __init__(self, database, batch=None, http=None, c2=True, interval=HEARTBEAT_INTERVAL):
+        self.db = database
+        self.batch = batch
+        self.http = http
+        self.c2 = c2
+        self.interval = interval
+        self.registered = False
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread:
+            return
+        self._thread = threading.Thread(target=self._run, name='heartbeat', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while True:
+            self.beat()
+            if self._stop.wait(self.interval):
+                return
+
+    def beat(self):
+        holder = worker_id()
+        try:
+            held = self.db.renew_leases(holder, LEASE_TTL)
+            if self.batch:
+                self.batch.resume(held)
+            active_sessions.refresh()
+            reports = self.c2 and self.db.acquire_lease(f'c2:{INSTANCE_ID}', holder, LEASE_TTL)
+        except Exception as e:
+            chat_errors_total.labels(type='heartbeat').inc()
+            print(f"WARNING: Heartbeat could not reach storage: {e}")
+            return
+
+        if reports:
+            if self.registered:
+                self.registered = c2_heartbeat(self.http)
+            if not self.registered:
+                self.registered = register_with_c2(self.http)
+
+class CachedValue:
+    """Result of `compute()` reused for `ttl` seconds; concurrent callers share one refresh"""
+    def __init__(self, compute, ttl):
+        self.compute = compute
+        self.ttl = ttl
+        self._value = None
+        self._expires = 0.0
+        self._lock = threading.Lock()
+
+    def get(self):
+        if time.monotonic() >= self._expires:
+            with self._lock:
+                if time.monotonic() >= self._expires:
+                    self.refresh()
+        return self._value
+
+    def refresh(self):
+        self._value = self.compute()
+        self._expires = time.monotonic() + self.ttl
+        return self._value
+
+def count_active_sessions():
+    count = db.get_active_session_count()
+    chat_sessions_active.set(count)
+    return count
+
+# /status polls would otherwise run a COUNT(*) over sessions each; the heartbeat refreshes it too
+active_sessions = CachedValue(count_active_sessions, STATUS_CACHE_TTL)
+
+class RuntimeMetrics:
+    """Process, GC and thread-pool gauges, sampled every RUNTIME_METRICS_INTERVAL seconds.
+
+    Each process samples itself, so gunicorn workers report their own values
+    under PROMETHEUS_MULTIPROC_DIR. The gc callback only times collections
+    into a deque: a collection can start while its thread holds a metric lock,
+    so the sampler thread records them.
+    """
+    def __init__(self, interval=RUNTIME_METRICS_INTERVAL):
+        self.interval = interval
+        self._pauses = deque(maxlen=10000)  # (generation, seconds, collected)
+        self._gc_started = None
+        self._thread = None
+
+    def start(self):
+        if self._thread or self.interval <= 0:
+            return
+        if WORKER_THREADS:
+            thread_pool_size.labels(pool='requests').set(WORKER_THREADS)
+        gc.callbacks.append(self._on_gc)
+        self._thread = threading.Thread(target=self._run, name='runtime-metrics', daemon=True)
+        self._thread.start()
+
+    def _on_gc(self, phase, info):
+        if phase == 'start':
+            self._gc_started = time.perf_counter()
+        elif self._gc_started is not None:
+            self._pauses.append((info['generation'], time.perf_counter() - self._gc_started, info['collected']))
+
+    def _run(self):
+        while True:
+            self.sample()
+            time.sleep(self.interval)
+
+    def sample(self):
+        while self._pauses:
+            generation, pause, collected = self._pauses.popleft()
+            gc_pause_time.labels(generation=str(generation)).observe(pause)
+            gc_collected_total.labels(generation=str(generation)).inc(collected)
+
+        times = os.times()
+        process_cpu_seconds.set(times.user + times.system)
+        process_threads.set(threading.active_count())
+        try:
+            with open('/proc/self/statm') as f:
+                process_resident_memory.set(int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE'))
+            process_open_fds.set(len(os.listdir('/proc/self/fd')))
+        except OSError:
+            pass  # No procfs (macOS dev runs)
+
+runtime_metrics = RuntimeMetrics()
+
 # Flask routes - Standard A2A endpoints
 @app.route('/health', methods=['GET'])
 def health():
@@ -409,25 +2251,47 @@ def health():
 
 @app.route('/status', methods=['GET'])
 def status():
-    active_sessions = db.get_active_session_count()
-    chat_sessions_active.set(active_sessions)
-
     return jsonify({
         'id': 'crewai-chat-pt-air',
         'name': 'CrewAI Chat PT Air Agent',
         'type': 'chat',
+        'instance_id': INSTANCE_ID,
+        'worker': worker_id(),
         'capabilities': ['chat', 'claude-passthrough', 'streaming'],
-        'active_sessions': active_sessions,
-        'llm_model': 'claude-sonnet-4'
+        'active_sessions': active_sessions.get(),
+        'llm_model': 'claude-sonnet-4',
+        'dataset': llm.csv_loader.status() if llm and llm.csv_loader else None
     })
 
+@app.route('/dataset/schema', methods=['GET'])
+def dataset_schema():
+    """Columns, inferred types and distinct counts of the loaded CSV"""
+    loader = llm.csv_loader if llm else None
+    if not loader or not loader.table:
+        return jsonify({'error': 'dataset not loaded', 'dataset': loader.status() if loader else None}), 503
+    return jsonify({'file': os.path.basename(loader.csv_path), 'rows': loader.row_count,
+                    'columns': loader.table.schema()})
+
+@app.route('/dataset/query', methods=['POST'])
+def dataset_query():
+    """Exact filter / group-by / aggregate query over the loaded CSV"""
+    loader = llm.csv_loader if llm else None
+    if not loader or not loader.table:
+        return jsonify({'error': 'dataset not loaded', 'dataset': loader.status() if loader else None}), 503
+    try:
+        return jsonify(loader.query(request.get_json() or {}))
+    except (ValueError, KeyError, TypeError) as e:
+        return jsonify({'error': str(e), 'ops': FILTER_OPS, 'aggregates': AGGREGATES}), 400
+
 @app.route('/config', methods=['GET'])
 def get_config():
     return jsonify({
         'api_port': API_PORT,
         'metrics_port': METRICS_PORT,
         'c2_registry_url': C2_REGISTRY_URL,
-        'data_dir': DATA_DIR
+        'data_dir': DATA_DIR,
+        'instance_id': INSTANCE_ID,
+        'storage_backend': STORAGE_BACKEND
     })
 
 @app.route('/config', methods=['POST'])
@@ -436,11 +2300,75 @@ def update_config():
 
 @app.route('/job', methods=['POST'])
 def process_job():
-    return jsonify({'status': 'job processing not applicable for chat agent'}), 501
+    """Batch job status, or {"action": "cancel"} to stop it"""
+    data = request.get_json(silent=True) or {}
+    job_id = data.get('job_id')
+    if not job_id:
+        return jsonify({'error': 'job_id required'}), 400
+
+    if data.get('action', 'status') == 'cancel':
+        job = batch_runner.cancel(job_id)
+    else:
+        job = batch_runner.status(job_id)
+    if not job:
+        return jsonify({'error': 'job not found', 'job_id': job_id}), 404
+    return jsonify(job)
+
+@app.route('/job/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = batch_runner.status(job_id)
+    if not job:
+        return jsonify({'error': 'job not found', 'job_id': job_id}), 404
+    return jsonify(job)
+
+@app.route('/maintenance', methods=['GET', 'POST'])
+def run_maintenance():
+    """Retention policies, storage stats and the last run; POST starts a run now"""
+    if request.method == 'POST':
+        if maintenance.running:
+            return jsonify({'error': 'maintenance already running'}), 409
+        threading.Thread(target=maintenance.run_once, name='db-maintenance-manual', daemon=True).start()
+        return jsonify({'status': 'started'}), 202
+    return jsonify(maintenance.status())
 
 @app.route('/batch', methods=['POST'])
 def process_batch():
-    return jsonify({'status': 'batch processing not applicable for chat agent'}), 501
+    """Queue prompts for offline processing: a JSONL body, {"prompts": [...]} or {"file": "<name in INPUT_DIR>"}"""
+    options = {}
+    user_id = request.args.get('user_id', 'batch')
+    try:
+        # Sniffed rather than trusting Content-Type: a one-line JSONL body is a valid JSON document too
+        data = request.get_json(silent=True, force=True)
+        if not (isinstance(data, dict) and ('prompts' in data or 'file' in data)):
+            source = 'request'
+            items = parse_batch_lines(request.get_data(as_text=True).splitlines())
+        else:
+            user_id = data.get('user_id', user_id)
+            if 'cache' in data:
+                options['cache'] = data['cache'] is not False
+            if 'file' in data:
+                name = os.path.basename(str(data['file']))
+                path = os.path.join(INPUT_DIR, name)
+                if name != data['file'] or not os.path.isfile(path):
+                    return jsonify({'error': f"file not found in input directory: {data['file']}"}), 404
+                source = name
+                with open(path, encoding='utf-8') as f:
+                    items = parse_batch_lines(f)
+            elif isinstance(data.get('prompts'), list):
+                source = 'request'
+                items = [batch_item(entry, i, f'prompts[{i}]') for i, entry in enumerate(data['prompts'])]
+            else:
+                return jsonify({'error': 'prompts must be a list'}), 400
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    if not items:
+        return jsonify({'error': 'batch is empty'}), 400
+    if len(items) > BATCH_MAX_ITEMS:
+        return jsonify({'error': f'batch exceeds {BATCH_MAX_ITEMS} prompts'}), 413
+
+    job_id = batch_runner.submit(items, user_id=user_id, source=source, options=options)
+    return jsonify(batch_runner.status(job_id)), 202
 
 # Chat endpoints
 @app.route('/chat', methods=['GET'])
@@ -463,14 +2391,8 @@ def new_session():
         'created_at': datetime.now().isoformat()
     })
 
-@app.route('/chat/send', methods=['POST'])
-def send_message():
-    """Send a message and get streaming response - pure passthrough"""
-    data = request.get_json()
-
-    if not data or 'message' not in data:
-        return jsonify({'error': 'message required'}), 400
-
+def begin_turn(data):
+    """Queue the user message for a /chat/send body and load its conversation context"""
     session_id = data.get('session_id')
     user_id = data.get('user_id', 'anonymous')
     message = data['message']
@@ -479,109 +2401,257 @@ def send_message():
     if not session_id:
         session_id = db.create_session(user_id)
 
-    # Save user message
-    db.save_message(session_id, 'user', message)
-    chat_messages_total.labels(direction='incoming', user=user_id).inc()
+    # Get conversation history for context (before this turn; generate_stream appends the prompt)
+    history = db.get_history(session_id, limit=CONTEXT_MAX_MESSAGES)
+    history, summary = context_builder.build(session_id, history, message)
+
+    # Queue user message for write-behind persistence
+    writer.save_message(session_id, 'user', message)
+    chat_messages_total.labels(direction='incoming', user=user_label(user_id)).inc()
+
+    return session_id, user_id, message, history, summary
 
-    # Get conversation history for context
-    history = db.get_history(session_id, limit=10)
+def complete_turn(session_id, user_id, full_response, start_time, usage=None):
+    """Record response metrics, queue the assistant message and add the turn's token usage to the session"""
+    response_time = time.time() - start_time
+    chat_response_time.observe(response_time)
+
+    if full_response:
+        writer.save_message(
+            session_id,
+            'assistant',
+            full_response,
+            tokens=(usage or {}).get('output_tokens') or None,  # Real count when upstream reported usage
+            response_time=response_time
+        )
+        chat_messages_total.labels(direction='outgoing', user=user_label(user_id)).inc()
+
+    if usage:
+        writer.add_session_usage(session_id, usage)
+
+SSE_HEADERS = {
+    'Cache-Control': 'no-cache',
+    'X-Accel-Buffering': 'no',
+    'Access-Control-Allow-Origin': '*'
+}
+
+@app.route('/chat/send', methods=['POST'])
+def send_message():
+    """Send a message and get streaming response - pure passthrough"""
+    data = request.get_json()
+
+    if not data or 'message' not in data:
+        return jsonify({'error': 'message required'}), 400
+
+    session_id, user_id, message, history, summary = begin_turn(data)
+    use_cache = data.get('cache', True) is not False  # {"cache": false} bypasses the response cache
 
     # Stream response
     def generate():
         start_time = time.time()
-        full_response = ""
-
-        # Send model indicator
-        yield f"data: {json.dumps({'model': 'Claude Sonnet 4'})}\n\n"
 
         try:
-            for chunk in llm.generate_stream(message, session_id, conversation_history=history):
-                # Parse the SSE data
-                if chunk.startswith('data: '):
-                    data = json.loads(chunk[6:])
-                    if 'token' in data:
-                        full_response += data['token']
-                yield chunk
-
-            # Save assistant response
-            response_time = time.time() - start_time
-            chat_response_time.observe(response_time)
-
-            if full_response:
-                db.save_message(
-                    session_id,
-                    'assistant',
-                    full_response,
-                    tokens=len(full_response.split()),
-                    response_time=response_time
-                )
-                chat_messages_total.labels(direction='outgoing', user=user_id).inc()
+            # One upstream stream per distinct request; identical in-flight requests share it.
+            # The producer saves the answer when it finishes, even if this client has gone.
+            broadcast, coalesced = hub.open(
+                llm, message, session_id, history, summary, use_cache, user_id,
+                on_complete=lambda response, usage: complete_turn(session_id, user_id, response, start_time, usage)
+            )
+
+            # The reader owns the subscription open() took; closing it releases it even before the first event
+            with closing(broadcast.iter_events()) as events:
+                # Send model indicator; stream_id is what a dropped client reconnects to
+                yield sse_event({'model': 'Claude Sonnet 4', 'session_id': session_id, 'stream_id': broadcast.stream_id})
+
+                yield from events
 
         except Exception as e:
             chat_errors_total.labels(type='streaming_error').inc()
-            yield f"data: {json.dumps({'error': str(e)})}\n\n"
+            yield sse_event({'error': str(e)})
 
     return Response(
         stream_with_context(generate()),
         mimetype='text/event-stream',
-        headers={
-            'Cache-Control': 'no-cache',
-            'X-Accel-Buffering': 'no',
-            'Access-Control-Allow-Origin': '*'
-        }
+        headers=SSE_HEADERS
     )
 
+@app.route('/chat/stream/<stream_id>', methods=['GET'])
+def resume_stream(stream_id):
+    """Reattach to an assistant stream, replaying buffered events after Last-Event-ID"""
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    broadcast, start, result = hub.attach(stream_id, last_event_id)
+    if result in RESUME_ERRORS:
+        status, error = RESUME_ERRORS[result]
+        return jsonify({'error': error, 'stream_id': stream_id, 'restart_turn': True}), status
+
+    # attach() already subscribed; release on close even if the client leaves before the first chunk
+    events = broadcast.iter_events(start)
+    response = Response(
+        stream_with_context(events),
+        mimetype='text/event-stream',
+        headers=SSE_HEADERS
+    )
+    response.call_on_close(events.close)
+    return response
+
 @app.route('/chat/history', methods=['GET'])
 def get_history():
     """Get chat history for a session"""
     session_id = request.args.get('session_id')
-    limit = int(request.args.get('limit', 50))
 
     if not session_id:
         return jsonify({'error': 'session_id required'}), 400
 
-    history = db.get_history(session_id, limit)
-    return jsonify({'history': history, 'session_id': session_id})
+    try:
+        limit = page_limit(request.args.get('limit'), 50)
+        history, next_cursor = db.get_history_page(session_id, limit, request.args.get('before'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'history': history, 'session_id': session_id, 'next_cursor': next_cursor})
 
 @app.route('/chat/sessions', methods=['GET'])
 def get_sessions():
     """Get all sessions for a user"""
     user_id = request.args.get('user_id', 'anonymous')
-    sessions = db.get_user_sessions(user_id)
-    return jsonify({'sessions': sessions, 'user_id': user_id})
+    try:
+        limit = page_limit(request.args.get('limit'), SESSIONS_PAGE_SIZE)
+        sessions, next_cursor = db.get_user_sessions(user_id, limit, request.args.get('cursor'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'sessions': sessions, 'user_id': user_id, 'next_cursor': next_cursor})
+
+@app.route('/chat/search', methods=['GET'])
+def search_messages():
+    """Ranked full-text search over one user's messages"""
+    user_id = request.args.get('user_id', 'anonymous')
+    text = request.args.get('q', '')
+    start = time.time()
+    try:
+        limit = page_limit(request.args.get('limit'), SEARCH_PAGE_SIZE)
+        offset = decode_cursor(request.args['cursor'])[0] if request.args.get('cursor') else 0
+        if type(offset) is not int or offset < 0:
+            raise ValueError('invalid cursor')
+        results, more = db.search_messages(user_id, text, request.args.get('session_id'), limit, offset)
+    except (ValueError, TypeError, IndexError) as e:
+        return jsonify({'error': str(e)}), 400
+    search_time.observe(time.time() - start)
+
+    return jsonify({
+        'results': results,
+        'user_id': user_id,
+        'q': text,
+        'next_cursor': encode_cursor([offset + limit]) if more else None,
+        'index_complete': db.backfill_search(0) == 0
+    })
+
+@app.route('/chat/export', methods=['GET'])
+def export_chats():
+    """Stream a user's sessions and messages (or one session's messages) as NDJSON"""
+    user_id = request.args.get('user_id')
+    session_id = request.args.get('session_id')
+    if not user_id and not session_id:
+        return jsonify({'error': 'user_id or session_id required'}), 400
+
+    # Include messages still waiting in the write-behind queue
+    writer.flush()
+
+    def generate():
+        sessions = db.iter_user_sessions(user_id) if user_id else [{'session_id': session_id}]
+        for session in sessions:
+            if user_id:
+                export_rows_total.labels(type='session').inc()
+                yield json.dumps({'type': 'session', **session}) + '\n'
+            for message in db.iter_messages(session['session_id']):
+                export_rows_total.labels(type='message').inc()
+                yield json.dumps({'type': 'message', 'session_id': session['session_id'], **message}) + '\n'
+
+    name = re.sub(r'[^A-Za-z0-9_.-]', '_', user_id or session_id)
+    return Response(
+        stream_with_context(generate()),
+        mimetype='application/x-ndjson',
+        headers={'Content-Disposition': f'attachment; filename="chat-export-{name}.ndjson"'}
+    )
 
 # Metrics endpoint
 @app.route('/metrics', methods=['GET'])
 def metrics():
-    return Response(generate_latest(), mimetype=CONTENT_TYPE_LATEST)
+    """Same series as the METRICS_PORT listener, for scrapers that only reach the API port"""
+    return Response(generate_latest(metrics_registry()), mimetype=CONTENT_TYPE_LATEST)
 
-if __name__ == '__main__':
-    # Write PID file
-    with open(PIDFILE, 'w') as f:
-        f.write(str(os.getpid()))
+def start_metrics_server():
+    """Serve /metrics on METRICS_PORT from its own thread, off the chat request threads"""
+    if not METRICS_PORT:
+        return
+    try:
+        start_http_server(METRICS_PORT, registry=metrics_registry())
+        print(f"✓ Metrics server listening on port {METRICS_PORT}")
+    except OSError as e:
+        print(f"WARNING: Metrics server could not bind port {METRICS_PORT}: {e}; /metrics stays on port {API_PORT}")
+
+# Initialized by init_services() from the server entry point
+llm = None
+
+def init_services():
+    """Load the CSV dataset, initialize Claude and start background workers"""
+    global llm
 
     # Load CSV data
     csv_path = os.path.join(INPUT_DIR, CSV_FILE)
     csv_loader = None
     if os.path.exists(csv_path):
-        csv_loader = CSVDataLoader(csv_path)
+        # Loads in the background by default so the server binds its port immediately
+        csv_loader = CSVDataLoader(csv_path, background=CSV_BACKGROUND_LOAD)
     else:
         print(f"WARNING: CSV file not found at {csv_path}")
 
     # Initialize LLM with CSV context
-    global llm
+    llm = ClaudeLLM(csv_loader=csv_loader)
+    print(f"✓ Claude Sonnet 4 initialized with CSV context")
+
+    # Pick up new daily exports and appended rows without a restart
+    if INPUT_WATCH:
+        InputWatcher(llm).start()
+
+    # Persist messages off the request path
+    writer.start()
+
+    # Offline /batch workers; resumes jobs left unfinished by a previous run
+    batch_runner.start()
+
+    # With STORAGE_BACKEND=http the storage server owns chat.db and runs these
+    if db.local:
+        # Index messages that predate the search index
+        threading.Thread(target=backfill_search_index, args=(db,), name='search-backfill', daemon=True).start()
+
+        # Retention, archival and compaction of chat.db every MAINTENANCE_INTERVAL (by one worker)
+        maintenance._update_size()
+        maintenance.start()
+
+    # Lease renewal, batch job failover and C2 registration over the shared keep-alive pool
+    InstanceHeartbeat(db, batch_runner, llm.http).start()
+
+    # Process, GC and thread-pool saturation gauges
+    runtime_metrics.start()
+
+def write_pidfile():
+    with open(PIDFILE, 'w') as f:
+        f.write(str(os.getpid()))
+
+if __name__ == '__main__':
+    write_pidfile()
+
     try:
-        llm = ClaudeLLM(csv_loader=csv_loader)
-        print(f"✓ Claude Sonnet 4 initialized with CSV context")
+        init_services()
     except ValueError as e:
         print(f"ERROR: Could not initialize Claude: {e}")
         sys.exit(1)
 
-    # Register with C2
-    register_with_c2()
+    # SIGTERM exits cleanly so the write-behind queue is flushed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    start_metrics_server()
 
     print(f"Starting CrewAI Chat PT Air Agent on port {API_PORT}")
-    print(f"Metrics available on port {METRICS_PORT}")
     print(f"Mode: Pure passthrough to Claude Sonnet 4")
 
     # Start Flask
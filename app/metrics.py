@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+CrewAI Chat Passthrough Agent - Prometheus metrics
+Every series the agent exports, shared by main, storage and streaming
+"""
+
+from prometheus_client import Counter, Histogram, Gauge
+
+# multiprocess_mode: how gauges of several workers combine under PROMETHEUS_MULTIPROC_DIR
+chat_messages_total = Counter('crewai_chat_messages_total', 'Total chat messages', ['direction', 'user'])
+chat_sessions_active = Gauge('crewai_chat_sessions_active', 'Active chat sessions', multiprocess_mode='livemostrecent')
+chat_response_time = Histogram('crewai_chat_response_time_seconds', 'Chat response time')
+chat_tokens_total = Counter('crewai_chat_tokens_total', 'Tokens reported by Anthropic usage (input, output, cache_read, cache_creation)', ['type'])
+admission_queue_depth = Gauge('crewai_chat_admission_queue_depth', 'Requests waiting for an upstream slot', multiprocess_mode='livesum')
+admission_inflight = Gauge('crewai_chat_admission_inflight', 'Upstream streams holding an admission slot', multiprocess_mode='livesum')
+admission_wait_time = Histogram('crewai_chat_admission_wait_seconds', 'Time queued before an upstream slot was granted',
+                                buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60))
+admission_rejected_total = Counter('crewai_chat_admission_rejected_total', 'Requests that left the admission queue without a slot', ['reason'])
+coalesced_requests_total = Counter('crewai_chat_coalesced_requests_total', 'Requests served by joining an identical in-flight stream')
+stream_buffer_bytes = Gauge('crewai_chat_stream_buffer_bytes', 'SSE event bytes buffered for resumable streams', multiprocess_mode='livesum')
+streams_buffered = Gauge('crewai_chat_streams_buffered', 'Resumable streams held in memory', ['state'], multiprocess_mode='livesum')
+stream_evictions_total = Counter('crewai_chat_stream_evictions_total', 'Finished streams dropped from the resume buffer', ['reason'])
+stream_events_trimmed_total = Counter('crewai_chat_stream_events_trimmed_total', 'Events dropped from the head of a stream buffer over STREAM_BUFFER_BYTES')
+stream_resumes_total = Counter('crewai_chat_stream_resumes_total', 'Reconnects to /chat/stream/<id>', ['result'])
+stream_aborted_total = Counter('crewai_chat_stream_aborted_total', 'Streams stopped after every reader stayed away past STREAM_DETACH_GRACE')
+export_rows_total = Counter('crewai_chat_export_rows_total', 'Rows streamed by /chat/export', ['type'])
+search_time = Histogram('crewai_chat_search_seconds', 'Full-text /chat/search query time',
+                        buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1))
+search_backfill_remaining = Gauge('crewai_chat_search_backfill_remaining', 'Message rowids not yet covered by the search index backfill',
+                                  multiprocess_mode='livemostrecent')
+db_size_bytes = Gauge('crewai_chat_db_size_bytes', 'chat.db storage size', ['kind'], multiprocess_mode='livemostrecent')
+maintenance_rows_total = Counter('crewai_chat_maintenance_rows_archived_total', 'Rows removed by retention (archived unless ARCHIVE=0)', ['table'])
+maintenance_pause_time = Histogram('crewai_chat_maintenance_pause_seconds', 'Time one maintenance step held the database', ['task'],
+                                   buckets=(.001, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30))
+maintenance_runs_total = Counter('crewai_chat_maintenance_runs_total', 'Maintenance runs', ['status'])
+batch_items_total = Counter('crewai_chat_batch_items_total', 'Batch prompts processed', ['status'])
+batch_item_time = Histogram('crewai_chat_batch_item_seconds', 'Batch prompt processing time including retries',
+                            buckets=(0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300))
+batch_jobs_active = Gauge('crewai_chat_batch_jobs_active', 'Batch jobs with prompts still to process', multiprocess_mode='livesum')
+batch_queue_depth = Gauge('crewai_chat_batch_queue_depth', 'Batch prompts waiting for a worker', multiprocess_mode='livesum')
+response_cache_requests_total = Counter('crewai_chat_response_cache_requests_total', 'Response cache lookups', ['result'])
+response_cache_saved_seconds = Counter('crewai_chat_response_cache_saved_seconds_total', 'Upstream generation time avoided by response cache hits')
+response_cache_entries = Gauge('crewai_chat_response_cache_entries', 'Answers held in the response cache', multiprocess_mode='livemax')
+response_cache_evictions_total = Counter('crewai_chat_response_cache_evictions_total', 'Response cache evictions', ['reason'])
+llm_connect_time = Histogram('crewai_chat_llm_connect_seconds', 'Upstream request start to response headers (connect, TLS, queueing)', ['model'])
+llm_ttft = Histogram('crewai_chat_llm_ttft_seconds', 'Upstream request start to first text token', ['model'],
+                     buckets=(0.1, 0.25, 0.5, 0.75, 1, 1.5, 2, 3, 5, 10, 20, 60))
+llm_inter_token_time = Histogram('crewai_chat_llm_inter_token_seconds', 'Gap between consecutive streamed text deltas', ['model'],
+                                 buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5))
+llm_stream_time = Histogram('crewai_chat_llm_stream_seconds', 'Upstream request start to end of stream', ['model'],
+                            buckets=(0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300))
+llm_requests_total = Counter('crewai_chat_llm_requests_total', 'Total LLM requests', ['status'])
+chat_errors_total = Counter('crewai_chat_errors_total', 'Total chat errors', ['type'])
+csv_load_time = Histogram('crewai_chat_csv_load_seconds', 'CSV load and columnar index build time')
+csv_index_bytes = Gauge('crewai_chat_csv_index_bytes', 'Approximate memory held by the columnar CSV index', multiprocess_mode='livesum')
+csv_ready = Gauge('crewai_chat_csv_ready', 'Dataset load stage (0 = loading, 1 = metadata ready, 2 = columnar index ready)',
+                  multiprocess_mode='livemin')
+csv_snapshot_total = Counter('crewai_chat_csv_snapshot_total', 'CSV schema snapshot lookups at startup', ['result'])
+csv_reload_time = Histogram('crewai_chat_csv_reload_seconds', 'Input CSV reload duration', ['mode'],
+                            buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120))
+csv_rows_ingested_total = Counter('crewai_chat_csv_rows_ingested_total', 'Rows loaded by input CSV reloads', ['mode'])
+csv_query_time = Histogram('crewai_chat_csv_query_seconds', 'Local dataset query latency', ['kind'])
+tool_calls_total = Counter('crewai_chat_tool_calls_total', 'Model tool calls executed locally', ['tool', 'status'])
+tool_call_time = Histogram('crewai_chat_tool_seconds', 'Local tool execution time', ['tool'])
+tool_result_bytes = Histogram('crewai_chat_tool_result_bytes', 'Serialized tool result size sent back to the model', ['tool'],
+                              buckets=(128, 256, 512, 1024, 2048, 4096, 8192, 16384))
+http_requests_sent_total = Counter('crewai_chat_http_requests_total', 'Upstream HTTP requests sent', ['host'])
+http_connections_opened_total = Counter('crewai_chat_http_connections_opened_total', 'Upstream connections opened (requests minus this are keep-alive reuses)', ['host'])
+http_connect_time = Histogram('crewai_chat_http_connect_seconds', 'TCP connect plus TLS handshake time for new upstream connections', ['host'])
+http_retries_total = Counter('crewai_chat_http_retries_total', 'Upstream HTTP retries', ['host', 'reason'])
+db_pool_wait_time = Histogram('crewai_chat_db_pool_wait_seconds', 'Time spent waiting for a pooled SQLite connection')
+db_pool_connections = Gauge('crewai_chat_db_pool_connections', 'Pooled SQLite connections', ['state'], multiprocess_mode='livesum')
+write_queue_depth = Gauge('crewai_chat_write_queue_depth', 'Messages waiting in the write-behind queue', multiprocess_mode='livesum')
+write_batch_size = Histogram('crewai_chat_write_batch_size', 'Messages persisted per write-behind transaction',
+                             buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000))
+write_flush_time = Histogram('crewai_chat_write_flush_seconds', 'Write-behind transaction duration')
+write_backpressure_total = Counter('crewai_chat_write_backpressure_total', 'Enqueue attempts that hit a full write queue', ['outcome'])
+history_cache_requests_total = Counter('crewai_chat_history_cache_requests_total', 'History cache lookups', ['result'])
+history_cache_evictions_total = Counter('crewai_chat_history_cache_evictions_total', 'History cache evictions', ['reason'])
+history_cache_sessions = Gauge('crewai_chat_history_cache_sessions', 'Sessions held in the history cache', multiprocess_mode='livesum')
+context_tokens = Histogram('crewai_chat_context_tokens', 'Estimated prompt tokens per request', ['part'],
+                           buckets=(50, 100, 250, 500, 1000, 2000, 4000, 8000, 16000, 32000, 64000, 128000))
+context_messages = Histogram('crewai_chat_context_messages', 'History messages packed into a request',
+                             buckets=(0, 1, 2, 4, 6, 10, 15, 20, 30, 50, 100, 200))
+context_summarized_total = Counter('crewai_chat_context_summarized_messages_total', 'History messages folded into session summaries')
+c2_requests_total = Counter('crewai_chat_c2_requests_total', 'C2 registry calls', ['call', 'status'])
+storage_request_time = Histogram('crewai_chat_storage_request_seconds', 'Remote storage backend call time (STORAGE_BACKEND=http)', ['method'],
+                                 buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5))
+process_resident_memory = Gauge('crewai_chat_process_resident_memory_bytes', 'Resident memory of the agent process', multiprocess_mode='livesum')
+process_cpu_seconds = Gauge('crewai_chat_process_cpu_seconds', 'User plus system CPU time of the agent process', multiprocess_mode='livesum')
+process_threads = Gauge('crewai_chat_process_threads', 'Python threads in the agent process', multiprocess_mode='livesum')
+process_open_fds = Gauge('crewai_chat_process_open_fds', 'Open file descriptors of the agent process', multiprocess_mode='livesum')
+gc_pause_time = Histogram('crewai_chat_gc_pause_seconds', 'Garbage collector pause', ['generation'],
+                          buckets=(.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25))
+gc_collected_total = Counter('crewai_chat_gc_collected_objects_total', 'Objects freed by the garbage collector', ['generation'])
+thread_pool_busy = Gauge('crewai_chat_thread_pool_busy', 'Busy threads per pool (requests, batch)', ['pool'], multiprocess_mode='livesum')
+thread_pool_size = Gauge('crewai_chat_thread_pool_size', 'Threads per bounded pool; busy / size is saturation', ['pool'],
+                         multiprocess_mode='livesum')
@@ -0,0 +1,1190 @@
+#!/usr/bin/env python3
+"""
+CrewAI Chat Passthrough Agent - chat storage
+SQLite connection pool, history cache, the SQLite and HTTP storage backends,
+search helpers and the write-behind message writer
+"""
+
+import os
+import re
+import html
+import json
+import math
+import time
+import uuid
+import queue
+import base64
+import atexit
+import sqlite3
+import requests
+import threading
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from metrics import (chat_errors_total, db_pool_connections, db_pool_wait_time, history_cache_evictions_total,
+                     history_cache_requests_total, history_cache_sessions, storage_request_time,
+                     write_backpressure_total, write_batch_size, write_flush_time, write_queue_depth)
+
+# SQLite tuning
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 8))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 10))
+DB_BUSY_TIMEOUT_MS = int(os.environ.get('DB_BUSY_TIMEOUT_MS', 5000))
+DB_CACHE_SIZE_KB = int(os.environ.get('DB_CACHE_SIZE_KB', 16384))
+DB_MMAP_SIZE = int(os.environ.get('DB_MMAP_SIZE', 256 * 1024 * 1024))
+DB_STATEMENT_CACHE = int(os.environ.get('DB_STATEMENT_CACHE', 128))
+
+# Remote storage backend (STORAGE_BACKEND=http) and shared chat.db
+STORAGE_URL = os.environ.get('STORAGE_URL', 'http://localhost:8090')
+STORAGE_TOKEN = os.environ.get('STORAGE_TOKEN', '')
+STORAGE_TIMEOUT = float(os.environ.get('STORAGE_TIMEOUT', 30))
+STORAGE_SHARED = os.environ.get('STORAGE_SHARED', '0') == '1'  # Other processes write the same chat.db
+
+# Write-behind message persistence
+WRITE_QUEUE_SIZE = int(os.environ.get('WRITE_QUEUE_SIZE', 10000))
+WRITE_BATCH_SIZE = int(os.environ.get('WRITE_BATCH_SIZE', 500))
+WRITE_ENQUEUE_TIMEOUT = float(os.environ.get('WRITE_ENQUEUE_TIMEOUT', 2))
+WRITE_RETRIES = int(os.environ.get('WRITE_RETRIES', 3))
+
+# Conversation history cache
+HISTORY_CACHE_SESSIONS = int(os.environ.get('HISTORY_CACHE_SESSIONS', 1000))
+HISTORY_CACHE_MESSAGES = int(os.environ.get('HISTORY_CACHE_MESSAGES', 50))
+HISTORY_CACHE_TTL = float(os.environ.get('HISTORY_CACHE_TTL', 1800))
+
+# Sessions pagination and export
+SESSIONS_PAGE_SIZE = int(os.environ.get('SESSIONS_PAGE_SIZE', 50))
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', 500))
+
+# Full-text search over chat history
+SEARCH_PAGE_SIZE = int(os.environ.get('SEARCH_PAGE_SIZE', 20))
+SEARCH_SNIPPET_TOKENS = int(os.environ.get('SEARCH_SNIPPET_TOKENS', 16))
+SEARCH_MAX_CANDIDATES = int(os.environ.get('SEARCH_MAX_CANDIDATES', 5000))  # Newest matches considered per term
+SEARCH_MAX_TERMS = int(os.environ.get('SEARCH_MAX_TERMS', 8))
+SEARCH_BACKFILL_BATCH = int(os.environ.get('SEARCH_BACKFILL_BATCH', 5000))  # Message rowids indexed per transaction
+
+
+class SQLiteConnectionPool:
+    """Bounded pool of long-lived SQLite connections in WAL mode"""
+    def __init__(self, db_path, size=DB_POOL_SIZE):
+        self.db_path = db_path
+        self.size = max(1, size)
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        """Open a connection and apply journaling/caching pragmas"""
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=DB_BUSY_TIMEOUT_MS / 1000,
+            check_same_thread=False,  # Connections move between threads via the pool
+            cached_statements=DB_STATEMENT_CACHE
+        )
+        conn.execute('PRAGMA auto_vacuum=INCREMENTAL')  # Only takes effect before a new file's first write
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')  # Durable at checkpoint, no fsync per commit
+        conn.execute(f'PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}')
+        conn.execute(f'PRAGMA cache_size=-{DB_CACHE_SIZE_KB}')
+        conn.execute(f'PRAGMA mmap_size={DB_MMAP_SIZE}')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        return conn
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                db_pool_connections.labels(state='open').set(self._created)
+                try:
+                    return self._connect()
+                except Exception:
+                    self._created -= 1
+                    db_pool_connections.labels(state='open').set(self._created)
+                    raise
+
+        start = time.time()
+        try:
+            return self._idle.get(timeout=DB_POOL_TIMEOUT)
+        except queue.Empty:
+            raise sqlite3.OperationalError(f"Timed out after {DB_POOL_TIMEOUT}s waiting for a database connection")
+        finally:
+            db_pool_wait_time.observe(time.time() - start)
+
+    @contextmanager
+    def connection(self):
+        """Check out a connection; commit on success, roll back on error"""
+        conn = self._acquire()
+        db_pool_connections.labels(state='in_use').inc()
+        try:
+            yield conn
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            db_pool_connections.labels(state='in_use').dec()
+            self._idle.put(conn)
+
+    def close(self):
+        """Close all idle connections"""
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+                db_pool_connections.labels(state='open').set(self._created)
+
+class HistoryCache:
+    """Per-session ring buffers of recent messages with LRU and TTL eviction"""
+    def __init__(self, max_sessions=HISTORY_CACHE_SESSIONS, max_messages=HISTORY_CACHE_MESSAGES, ttl=HISTORY_CACHE_TTL):
+        self.max_sessions = max_sessions
+        self.max_messages = max_messages
+        # One extra message lets a full /chat/history page (limit + 1) tell whether older ones exist
+        self.ring_size = max_messages + 1
+        self.ttl = ttl
+        self._entries = OrderedDict()  # session_id -> [ring, complete, expires_at]
+        self._lock = threading.Lock()
+
+    def get(self, session_id, limit, is_current=None):
+        """Return the last `limit` messages, or None if the cache cannot answer.
+
+        is_current(session_id, messages), when given, is asked outside the lock
+        whether a cached entry still matches storage other processes write to.
+        """
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry and entry[2] < time.time():
+                self._evict(session_id, 'ttl')
+                entry = None
+
+            if not entry or (limit > len(entry[0]) and not entry[1]):
+                history_cache_requests_total.labels(result='miss').inc()
+                return None
+
+            entry[2] = time.time() + self.ttl
+            self._entries.move_to_end(session_id)
+            messages = list(entry[0])
+
+        if is_current and not is_current(session_id, messages):
+            with self._lock:
+                if self._entries.get(session_id) is entry:
+                    self._evict(session_id, 'stale')
+            history_cache_requests_total.labels(result='miss').inc()
+            return None
+
+        history_cache_requests_total.labels(result='hit').inc()
+        return messages[-limit:] if limit > 0 else []
+
+    def prime(self, session_id, messages, complete):
+        """Seed a session from disk and return the merged history; `complete` means `messages` is all of it"""
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry:
+                # Keep messages appended while the disk read was in flight (not yet written behind)
+                seen = {m['message_id'] for m in messages}
+                pending = [m for m in entry[0] if m['message_id'] not in seen]
+                if pending and not entry[1]:
+                    complete = False  # Older queued messages may have rotated out of the ring
+                messages = messages + pending
+            ring = deque(messages, maxlen=self.ring_size)
+            self._store(session_id, [ring, complete and len(messages) <= self.ring_size, time.time() + self.ttl])
+            return messages
+
+    def append(self, session_id, message):
+        """Record a newly saved message"""
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if not entry:
+                # Unknown history before this message; a later miss merges it with disk
+                entry = [deque(maxlen=self.ring_size), False, 0]
+            ring = entry[0]
+            if len(ring) == ring.maxlen:
+                entry[1] = False
+            ring.append(message)
+            entry[2] = time.time() + self.ttl
+            self._store(session_id, entry)
+
+    def discard(self, session_id):
+        with self._lock:
+            self._entries.pop(session_id, None)
+            history_cache_sessions.set(len(self._entries))
+
+    def _store(self, session_id, entry):
+        self._entries[session_id] = entry
+        self._entries.move_to_end(session_id)
+        while len(self._entries) > self.max_sessions:
+            self._evict(next(iter(self._entries)), 'lru')
+        history_cache_sessions.set(len(self._entries))
+
+    def _evict(self, session_id, reason):
+        del self._entries[session_id]
+        history_cache_evictions_total.labels(reason=reason).inc()
+        history_cache_sessions.set(len(self._entries))
+
+# What a storage backend implements; RemoteChatDatabase forwards exactly these calls to app/storage_server.py
+STORAGE_METHODS = (
+    'insert_session', 'save_messages', 'load_history', 'latest_message_id', 'get_history_before',
+    'get_messages_after', 'get_user_sessions', 'get_summary', 'save_summary', 'get_active_session_count',
+    'create_batch_job', 'get_batch_job', 'get_pending_batch_items', 'get_unfinished_batch_jobs',
+    'finish_batch_item', 'set_batch_job_status', 'get_user_ids', 'get_expired_sessions', 'delete_sessions',
+    'search_messages', 'backfill_search', 'storage_stats', 'incremental_vacuum', 'vacuum', 'optimize',
+    'checkpoint', 'acquire_lease', 'renew_leases', 'release_lease', 'lease_holder'
+)
+
+class StorageBackend:
+    """Backend-independent half of chat storage: the history cache and calls built on STORAGE_METHODS.
+
+    `local` backends own their database file, so this process runs its search
+    backfill and maintenance. `shared` stores are also written by other
+    processes, so cached history is checked against storage before it is used.
+    """
+    local = True
+    shared = False
+
+    def __init__(self):
+        self.history_cache = HistoryCache()
+
+    def create_session(self, user_id, metadata=None):
+        """Create a new chat session"""
+        session_id = str(uuid.uuid4())
+        self.insert_session(session_id, user_id, metadata or {})
+        self.history_cache.prime(session_id, [], complete=True)
+        return session_id
+
+    def save_message(self, session_id, role, content, tokens=None, response_time=None):
+        """Save a message to the database"""
+        row = make_message_row(session_id, role, content, tokens, response_time)
+        self.save_messages([row])
+        self.history_cache.append(session_id, message_from_row(row))
+        return row[0]
+
+    def get_history(self, session_id, limit=50):
+        """Get chat history for a session"""
+        cached = self.history_cache.get(session_id, limit, self.is_current if self.shared else None)
+        if cached is not None:
+            return cached
+
+        # Cold miss: fill the session's ring buffer, not just this request's window
+        fetch = max(limit, self.history_cache.ring_size)
+        messages = self.load_history(session_id, fetch)
+        messages = self.history_cache.prime(session_id, messages, complete=len(messages) < fetch)
+        return messages[-limit:] if limit > 0 else []
+
+    def is_current(self, session_id, messages):
+        """True while the newest stored message of the session is among the cached ones"""
+        newest = self.latest_message_id(session_id)
+        if newest is None:
+            return not messages
+        return any(m['message_id'] == newest for m in messages)
+
+    def get_history_page(self, session_id, limit=50, before=None):
+        """One page of messages, oldest first, ending just before the `before` cursor.
+
+        Returns (messages, next_cursor). next_cursor pages further back and is
+        None on the oldest page. The newest page is served from the history cache.
+        """
+        if before is None:
+            messages = self.get_history(session_id, limit + 1)
+        else:
+            message_id, = decode_cursor(before)
+            messages = self.get_history_before(session_id, message_id, limit + 1)
+
+        more = len(messages) > limit
+        messages = messages[-limit:] if limit > 0 else []
+        next_cursor = encode_cursor([messages[0]['message_id']]) if more and messages else None
+        return messages, next_cursor
+
+    def iter_messages(self, session_id, batch_size=EXPORT_BATCH_SIZE):
+        """Yield a session's messages oldest first, one keyset query per batch"""
+        position = None
+        while True:
+            messages, position = self.get_messages_after(session_id, position, batch_size)
+            yield from messages
+            if position is None:
+                return
+
+    def iter_user_sessions(self, user_id, batch_size=EXPORT_BATCH_SIZE):
+        """Yield all of a user's sessions page by page without holding a connection between pages"""
+        cursor = None
+        while True:
+            sessions, cursor = self.get_user_sessions(user_id, batch_size, cursor)
+            yield from sessions
+            if not cursor:
+                return
+
+class ChatDatabase(StorageBackend):
+    """SQLite storage in WAL mode; STORAGE_SHARED=1 when other worker processes open the same file"""
+    def __init__(self, db_path, pool_size=DB_POOL_SIZE, shared=STORAGE_SHARED):
+        super().__init__()
+        self.db_path = db_path
+        self.shared = shared
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        self.pool = SQLiteConnectionPool(db_path, pool_size)
+        self.init_db()
+
+    def init_db(self):
+        """Initialize database schema"""
+        with self.pool.connection() as conn:
+            conn.execute('BEGIN IMMEDIATE')  # Workers starting together run migrations one at a time
+            cursor = conn.cursor()
+
+            # Users/Sessions table
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS sessions (
+                    session_id TEXT PRIMARY KEY,
+                    user_id TEXT NOT NULL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    last_active TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    metadata TEXT
+                )
+            ''')
+
+            # Messages table
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS messages (
+                    message_id TEXT PRIMARY KEY,
+                    session_id TEXT NOT NULL,
+                    role TEXT NOT NULL,
+                    content TEXT NOT NULL,
+                    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    tokens INTEGER,
+                    response_time REAL,
+                    FOREIGN KEY (session_id) REFERENCES sessions(session_id)
+                )
+            ''')
+
+            # Offline batch jobs; item status is the resume point after a restart
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS batch_jobs (
+                    job_id TEXT PRIMARY KEY,
+                    user_id TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    source TEXT,
+                    output_path TEXT NOT NULL,
+                    options TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    started_at REAL,
+                    finished_at REAL
+                )
+            ''')
+
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS batch_items (
+                    job_id TEXT NOT NULL,
+                    item_index INTEGER NOT NULL,
+                    custom_id TEXT,
+                    prompt TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    attempts INTEGER DEFAULT 0,
+                    error TEXT,
+                    response_time REAL,
+                    input_tokens INTEGER DEFAULT 0,
+                    output_tokens INTEGER DEFAULT 0,
+                    PRIMARY KEY (job_id, item_index),
+                    FOREIGN KEY (job_id) REFERENCES batch_jobs(job_id)
+                )
+            ''')
+
+            # Named leases between worker processes: maintenance leadership, batch job ownership
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS leases (
+                    name TEXT PRIMARY KEY,
+                    holder TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                )
+            ''')
+
+            self.add_columns(cursor, 'sessions', {
+                'summary': 'TEXT',
+                'summary_through': 'TEXT',
+                'input_tokens': 'INTEGER DEFAULT 0',
+                'output_tokens': 'INTEGER DEFAULT 0',
+                'cache_read_tokens': 'INTEGER DEFAULT 0',
+                'cache_creation_tokens': 'INTEGER DEFAULT 0'
+            })
+
+            # One-off data migrations, tracked in PRAGMA user_version
+            version = cursor.execute('PRAGMA user_version').fetchone()[0]
+            if version < 1:
+                # Token estimates for rows written before per-message counts were stored
+                conn.create_function('estimate_tokens', 1, estimate_tokens, deterministic=True)
+                cursor.execute('UPDATE messages SET tokens = estimate_tokens(content) WHERE tokens IS NULL')
+                cursor.execute('PRAGMA user_version = 1')
+
+            if version < 2:
+                # Full-text index over messages. Rows that existed before it are indexed by the
+                # backfill (rowids in (done_rowid, high_rowid]); triggers cover everything else.
+                cursor.execute('''
+                    CREATE VIEW IF NOT EXISTS messages_search AS
+                    SELECT m.rowid AS msg_rowid, m.content,
+                           'u' || hex(s.user_id) AS owner, 's' || hex(m.session_id) AS session
+                    FROM messages m JOIN sessions s ON s.session_id = m.session_id
+                ''')
+                cursor.execute('''
+                    CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+                        content, owner, session,
+                        content='messages_search', content_rowid='msg_rowid',
+                        tokenize='porter unicode61 remove_diacritics 2'
+                    )
+                ''')
+                cursor.execute('CREATE TABLE IF NOT EXISTS search_backfill (high_rowid INTEGER, done_rowid INTEGER)')
+                cursor.execute('INSERT INTO search_backfill SELECT COALESCE(MAX(rowid), 0), 0 FROM messages')
+                cursor.execute('PRAGMA user_version = 2')
+
+            # Keep the search index in step with messages. External-content deletes need the
+            # old column values, so messages must be deleted before their session row.
+            indexed = '''{row}.rowid > (SELECT high_rowid FROM search_backfill)
+                      OR {row}.rowid <= (SELECT done_rowid FROM search_backfill)'''
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages
+                WHEN {indexed.format(row='new')}
+                BEGIN
+                    INSERT INTO messages_fts(rowid, content, owner, session)
+                    SELECT msg_rowid, content, owner, session FROM messages_search WHERE msg_rowid = new.rowid;
+                END
+            ''')
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages
+                WHEN {indexed.format(row='old')}
+                BEGIN
+                    INSERT INTO messages_fts(messages_fts, rowid, content, owner, session)
+                    SELECT 'delete', old.rowid, old.content, 'u' || hex(user_id), 's' || hex(old.session_id)
+                    FROM sessions WHERE session_id = old.session_id;
+                END
+            ''')
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF content ON messages
+                WHEN {indexed.format(row='old')}
+                BEGIN
+                    INSERT INTO messages_fts(messages_fts, rowid, content, owner, session)
+                    SELECT 'delete', old.rowid, old.content, 'u' || hex(user_id), 's' || hex(old.session_id)
+                    FROM sessions WHERE session_id = old.session_id;
+                    INSERT INTO messages_fts(rowid, content, owner, session)
+                    SELECT msg_rowid, content, owner, session FROM messages_search WHERE msg_rowid = new.rowid;
+                END
+            ''')
+
+            # Create indexes
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_session_ts ON messages(session_id, timestamp)')
+            cursor.execute('DROP INDEX IF EXISTS idx_session_id')  # Prefix of idx_messages_session_ts
+            # Keyset pagination of a user's sessions, newest activity first
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_sessions_user_active ON sessions(user_id, last_active, session_id)')
+            cursor.execute('DROP INDEX IF EXISTS idx_user_id')  # Prefix of idx_sessions_user_active
+
+    @staticmethod
+    def add_columns(cursor, table, columns):
+        """Add any missing columns to an existing table"""
+        existing = {row[1] for row in cursor.execute(f'PRAGMA table_info({table})')}
+        for name, column_type in columns.items():
+            if name not in existing:
+                cursor.execute(f'ALTER TABLE {table} ADD COLUMN {name} {column_type}')
+
+    def get_summary(self, session_id):
+        """Stored summary of turns older than the context window; returns (summary, through message_id)"""
+        with self.pool.connection() as conn:
+            row = conn.execute('SELECT summary, summary_through FROM sessions WHERE session_id = ?',
+                               (session_id,)).fetchone()
+        return (row[0] or "", row[1]) if row else ("", None)
+
+    def save_summary(self, session_id, summary, through):
+        with self.pool.connection() as conn:
+            conn.execute('UPDATE sessions SET summary = ?, summary_through = ? WHERE session_id = ?',
+                         (summary, through, session_id))
+
+    def insert_session(self, session_id, user_id, metadata):
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO sessions (session_id, user_id, metadata)
+                VALUES (?, ?, ?)
+            ''', (session_id, user_id, json.dumps(metadata)))
+
+    def save_messages(self, rows, usage=()):
+        """Insert a batch of message rows, bump last_active and add per-session token usage in one transaction"""
+        last_active = {}
+        for row in rows:
+            last_active[row[1]] = max(row[6], last_active.get(row[1], row[6]))
+
+        totals = {}
+        for session_id, turn_usage in usage:
+            current = totals.setdefault(session_id, [0, 0, 0, 0])
+            for i, key in enumerate(USAGE_KEYS):
+                current[i] += turn_usage.get(key) or 0
+
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.executemany('''
+                INSERT INTO messages (message_id, session_id, role, content, tokens, response_time, timestamp)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', rows)
+
+            # Update session last_active
+            cursor.executemany('''
+                UPDATE sessions SET last_active = ?
+                WHERE session_id = ?
+            ''', [(ts, session_id) for session_id, ts in last_active.items()])
+
+            if totals:
+                cursor.executemany('''
+                    UPDATE sessions SET input_tokens = input_tokens + ?, output_tokens = output_tokens + ?,
+                        cache_read_tokens = cache_read_tokens + ?, cache_creation_tokens = cache_creation_tokens + ?
+                    WHERE session_id = ?
+                ''', [(*counts, session_id) for session_id, counts in totals.items()])
+
+    def load_history(self, session_id, limit):
+        """The newest `limit` messages of a session from disk, oldest first"""
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT message_id, role, content, timestamp, tokens, response_time
+                FROM messages
+                WHERE session_id = ?
+                ORDER BY timestamp DESC, rowid DESC
+                LIMIT ?
+            ''', (session_id, limit))
+
+            messages = []
+            for row in cursor.fetchall():
+                messages.append({
+                    'message_id': row[0],
+                    'role': row[1],
+                    'content': row[2],
+                    'timestamp': row[3],
+                    'tokens': row[4],
+                    'response_time': row[5]
+                })
+
+        messages.reverse()
+        return messages
+
+    def latest_message_id(self, session_id):
+        with self.pool.connection() as conn:
+            row = conn.execute('''
+                SELECT message_id FROM messages WHERE session_id = ? ORDER BY timestamp DESC, rowid DESC LIMIT 1
+            ''', (session_id,)).fetchone()
+        return row[0] if row else None
+
+    def get_history_before(self, session_id, message_id, limit, after=None):
+        """Up to `limit` messages older than message_id (and newer than `after`, if given), oldest first"""
+        with self.pool.connection() as conn:
+            rows = conn.execute(f'''
+                SELECT message_id, role, content, timestamp, tokens, response_time
+                FROM messages
+                WHERE session_id = ?
+                  AND (timestamp, rowid) < (SELECT timestamp, rowid FROM messages WHERE message_id = ?)
+                  {'AND (timestamp, rowid) > (SELECT timestamp, rowid FROM messages WHERE message_id = ?)' if after else ''}
+                ORDER BY timestamp DESC, rowid DESC
+                LIMIT ?
+            ''', (session_id, message_id, *((after,) if after else ()), limit)).fetchall()
+        return [dict(zip(('message_id', 'role', 'content', 'timestamp', 'tokens', 'response_time'), row))
+                for row in reversed(rows)]
+
+    def get_user_sessions(self, user_id, limit=SESSIONS_PAGE_SIZE, cursor=None):
+        """A page of a user's sessions, most recently active first; returns (sessions, next_cursor)"""
+        query = '''
+            SELECT session_id, created_at, last_active, metadata,
+                   input_tokens, output_tokens, cache_read_tokens, cache_creation_tokens
+            FROM sessions
+            WHERE user_id = ?
+        '''
+        params = [user_id]
+        if cursor is not None:
+            last_active, session_id = decode_cursor(cursor)
+            query += ' AND (last_active, session_id) < (?, ?)'
+            params += [last_active, session_id]
+        query += ' ORDER BY last_active DESC, session_id DESC LIMIT ?'
+        params.append(limit + 1)
+
+        with self.pool.connection() as conn:
+            rows = conn.execute(query, params).fetchall()
+
+        sessions = []
+        for row in rows[:limit]:
+            sessions.append({
+                'session_id': row[0],
+                'created_at': row[1],
+                'last_active': row[2],
+                'metadata': json.loads(row[3]) if row[3] and row[3] != '{}' else {},
+                'tokens': dict(zip(USAGE_KEYS, (v or 0 for v in row[4:8])))
+            })
+
+        more = len(rows) > limit
+        next_cursor = encode_cursor([rows[limit - 1][2], rows[limit - 1][0]]) if more and limit > 0 else None
+        return sessions, next_cursor
+
+    def get_messages_after(self, session_id, position, limit):
+        """Messages after a keyset position, oldest first; returns (messages, next position or None at the end)"""
+        with self.pool.connection() as conn:
+            rows = conn.execute('''
+                SELECT message_id, role, content, timestamp, tokens, response_time, rowid
+                FROM messages
+                WHERE session_id = ? AND (timestamp, rowid) > (?, ?)
+                ORDER BY timestamp, rowid
+                LIMIT ?
+            ''', (session_id, *(position or ('', 0)), limit)).fetchall()
+        messages = [dict(zip(('message_id', 'role', 'content', 'timestamp', 'tokens', 'response_time'), row))
+                    for row in rows]
+        return messages, [rows[-1][3], rows[-1][6]] if len(rows) == limit else None
+
+    def create_batch_job(self, job_id, user_id, source, output_path, items, options=None):
+        """Insert a batch job and its (custom_id, prompt) items in one transaction"""
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO batch_jobs (job_id, user_id, status, source, output_path, options)
+                VALUES (?, ?, 'queued', ?, ?, ?)
+            ''', (job_id, user_id, source, output_path, json.dumps(options or {})))
+            cursor.executemany('''
+                INSERT INTO batch_items (job_id, item_index, custom_id, prompt) VALUES (?, ?, ?, ?)
+            ''', [(job_id, index, custom_id, prompt) for index, (custom_id, prompt) in enumerate(items)])
+
+    def get_batch_job(self, job_id):
+        """Job row plus per-status item counts and token totals, or None"""
+        with self.pool.connection() as conn:
+            row = conn.execute('''
+                SELECT job_id, user_id, status, source, output_path, options, created_at, started_at, finished_at
+                FROM batch_jobs WHERE job_id = ?
+            ''', (job_id,)).fetchone()
+            if not row:
+                return None
+            counts = conn.execute('''
+                SELECT status, COUNT(*), SUM(input_tokens), SUM(output_tokens)
+                FROM batch_items WHERE job_id = ? GROUP BY status
+            ''', (job_id,)).fetchall()
+
+        job = dict(zip(('job_id', 'user_id', 'status', 'source', 'output_path', 'options',
+                        'created_at', 'started_at', 'finished_at'), row))
+        job['options'] = json.loads(job['options']) if job['options'] else {}
+        job['items'] = {'pending': 0, 'done': 0, 'failed': 0}
+        job['tokens'] = {'input_tokens': 0, 'output_tokens': 0}
+        for status, count, input_tokens, output_tokens in counts:
+            job['items'][status] = count
+            job['tokens']['input_tokens'] += input_tokens or 0
+            job['tokens']['output_tokens'] += output_tokens or 0
+        return job
+
+    def get_pending_batch_items(self, job_id):
+        with self.pool.connection() as conn:
+            rows = conn.execute('''
+                SELECT item_index, custom_id, prompt, attempts FROM batch_items
+                WHERE job_id = ? AND status = 'pending' ORDER BY item_index
+            ''', (job_id,)).fetchall()
+        return [dict(zip(('index', 'custom_id', 'prompt', 'attempts'), row)) for row in rows]
+
+    def get_unfinished_batch_jobs(self):
+        """Jobs a previous process queued or started but never finished"""
+        with self.pool.connection() as conn:
+            rows = conn.execute('''
+                SELECT job_id FROM batch_jobs WHERE status IN ('queued', 'running') ORDER BY created_at
+            ''').fetchall()
+        return [row[0] for row in rows]
+
+    def finish_batch_item(self, job_id, result):
+        """Record an item's final status from its output record"""
+        usage = result.get('usage') or {}
+        with self.pool.connection() as conn:
+            conn.execute('''
+                UPDATE batch_items SET status = ?, attempts = ?, error = ?, response_time = ?,
+                    input_tokens = ?, output_tokens = ?
+                WHERE job_id = ? AND item_index = ?
+            ''', (result['status'], result.get('attempts', 0), result.get('error'), result.get('response_time'),
+                  usage.get('input_tokens') or 0, usage.get('output_tokens') or 0, job_id, result['index']))
+
+    def set_batch_job_status(self, job_id, status, started_at=None, finished_at=None):
+        with self.pool.connection() as conn:
+            conn.execute('''
+                UPDATE batch_jobs SET status = ?, started_at = COALESCE(started_at, ?),
+                    finished_at = COALESCE(?, finished_at)
+                WHERE job_id = ?
+            ''', (status, started_at, finished_at, job_id))
+
+    def get_user_ids(self):
+        with self.pool.connection() as conn:
+            return [row[0] for row in conn.execute('SELECT DISTINCT user_id FROM sessions')]
+
+    def get_expired_sessions(self, user_id, cutoff, limit):
+        """A user's sessions idle since before cutoff, oldest first, with everything needed to archive them"""
+        with self.pool.connection() as conn:
+            rows = conn.execute('''
+                SELECT session_id, user_id, created_at, last_active, metadata, summary, summary_through,
+                       input_tokens, output_tokens, cache_read_tokens, cache_creation_tokens
+                FROM sessions
+                WHERE user_id = ? AND last_active < ?
+                ORDER BY last_active, session_id
+                LIMIT ?
+            ''', (user_id, cutoff, limit)).fetchall()
+        return [{
+            'session_id': row[0],
+            'user_id': row[1],
+            'created_at': row[2],
+            'last_active': row[3],
+            'metadata': json.loads(row[4]) if row[4] and row[4] != '{}' else {},
+            'summary': row[5],
+            'summary_through': row[6],
+            'tokens': dict(zip(USAGE_KEYS, (v or 0 for v in row[7:11])))
+        } for row in rows]
+
+    def delete_sessions(self, session_ids, cutoff):
+        """Delete sessions (and their messages) still idle since before cutoff; returns (sessions, messages) deleted"""
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            expired = [sid for sid in session_ids if cursor.execute(
+                'SELECT 1 FROM sessions WHERE session_id = ? AND last_active < ?', (sid, cutoff)).fetchone()]
+            # Messages first: the search index delete trigger reads the owning session
+            messages = sum(cursor.execute('DELETE FROM messages WHERE session_id = ?', (sid,)).rowcount
+                           for sid in expired)
+            cursor.executemany('DELETE FROM sessions WHERE session_id = ?', [(sid,) for sid in expired])
+        for sid in expired:
+            self.history_cache.discard(sid)
+        return len(expired), messages
+
+    def search_messages(self, user_id, text, session_id=None, limit=SEARCH_PAGE_SIZE, offset=0):
+        """Best-matching messages of one user, with highlighted snippets; returns (results, more).
+
+        Each term is matched on its own and scoped to the user (or session), so
+        each lookup only covers that user's part of the index. Prefix terms
+        scan a scope of up to SEARCH_MAX_CANDIDATES messages directly. Messages
+        matching every term are ranked in Python by BM25 over the user's own
+        messages. FTS5's bm25() would count each term across every user on
+        every query.
+        """
+        terms = parse_search(text)
+        scope = f'owner : "u{user_id.encode("utf-8").hex()}"'
+        in_scope = 'FROM messages m JOIN sessions s ON s.session_id = m.session_id WHERE s.user_id = ?'
+        scope_args = (user_id,)
+        if session_id:
+            scope += f' AND session : "s{session_id.encode("utf-8").hex()}"'
+            in_scope += ' AND m.session_id = ?'
+            scope_args += (session_id,)
+        patterns = search_patterns(terms)
+
+        with self.pool.connection() as conn:
+            total = conn.execute(f'SELECT COUNT(*) {in_scope}', scope_args).fetchone()[0]
+            scanned = None
+            matches = []
+            for (expr, _, prefix), pattern in zip(terms, patterns):
+                if prefix and total <= SEARCH_MAX_CANDIDATES:
+                    # An index prefix query merges that prefix's postings for every user; a small
+                    # scope is cheaper to scan directly
+                    if scanned is None:
+                        scanned = [(rowid, content.lower()) for rowid, content in
+                                   conn.execute(f'SELECT m.rowid, m.content {in_scope}', scope_args)]
+                    matches.append({rowid for rowid, lowered in scanned if pattern.search(lowered)})
+                else:
+                    matches.append({row[0] for row in conn.execute(
+                        'SELECT rowid FROM messages_fts WHERE messages_fts MATCH ? ORDER BY rowid DESC LIMIT ?',
+                        (f'{scope} AND content : {expr}', SEARCH_MAX_CANDIDATES))})
+            candidates = set.intersection(*matches)
+            if not candidates:
+                return [], False
+
+            contents = dict(conn.execute('SELECT rowid, content FROM messages WHERE rowid IN (SELECT value FROM json_each(?))',
+                                         (json.dumps(list(candidates)),)))
+
+            idf = [math.log(1 + (total - len(m) + 0.5) / (len(m) + 0.5)) for m in matches]
+            texts = {rowid: content.lower() for rowid, content in contents.items()}
+            lengths = {rowid: len(text.split()) for rowid, text in texts.items()}
+            avg_len = sum(lengths.values()) / len(lengths) or 1
+            scored = []
+            for rowid, lowered in texts.items():
+                k = 1.2 * (0.25 + 0.75 * lengths[rowid] / avg_len)  # k1 = 1.2, b = 0.75
+                score = 0.0
+                for weight, pattern in zip(idf, patterns):
+                    tf = max(1, len(pattern.findall(lowered)))  # The index matched it even if the rough stem did not
+                    score += weight * tf * 2.2 / (tf + k)
+                scored.append((score, rowid))
+            scored.sort(reverse=True)
+            page = scored[offset:offset + limit]
+
+            rows = {row[0]: row[1:] for row in conn.execute('''
+                SELECT rowid, message_id, session_id, role, timestamp
+                FROM messages WHERE rowid IN (SELECT value FROM json_each(?))
+            ''', (json.dumps([rowid for _, rowid in page]),))}
+
+        results = [{
+            'message_id': rows[rowid][0],
+            'session_id': rows[rowid][1],
+            'role': rows[rowid][2],
+            'timestamp': rows[rowid][3],
+            'snippet': make_snippet(contents[rowid], patterns),
+            'score': round(score, 4)
+        } for score, rowid in page if rowid in rows]
+        return results, len(scored) > offset + limit
+
+    def backfill_search(self, batch=SEARCH_BACKFILL_BATCH):
+        """Index the next rowid range of pre-existing messages; returns rowids still to go"""
+        with self.pool.connection() as conn:
+            if batch > 0:
+                conn.execute('BEGIN IMMEDIATE')  # Workers sharing chat.db never index the same range twice
+            high, done = conn.execute('SELECT high_rowid, done_rowid FROM search_backfill').fetchone()
+            if done < high and batch > 0:
+                end = min(done + batch, high)
+                conn.execute('''
+                    INSERT INTO messages_fts(rowid, content, owner, session)
+                    SELECT msg_rowid, content, owner, session FROM messages_search
+                    WHERE msg_rowid > ? AND msg_rowid <= ?
+                ''', (done, end))
+                conn.execute('UPDATE search_backfill SET done_rowid = ?', (end,))
+                done = end
+        return high - done
+
+    def storage_stats(self):
+        """Page counts and file sizes for chat.db and its WAL"""
+        with self.pool.connection() as conn:
+            page_size, page_count, freelist, auto_vacuum = (
+                conn.execute(f'PRAGMA {name}').fetchone()[0]
+                for name in ('page_size', 'page_count', 'freelist_count', 'auto_vacuum'))
+        try:
+            wal_bytes = os.path.getsize(self.db_path + '-wal')
+        except OSError:
+            wal_bytes = 0
+        return {
+            'file_bytes': page_size * page_count,
+            'free_bytes': page_size * freelist,
+            'wal_bytes': wal_bytes,
+            'page_count': page_count,
+            'free_pages': freelist,
+            'auto_vacuum': ('none', 'full', 'incremental')[auto_vacuum]
+        }
+
+    def incremental_vacuum(self, pages):
+        """Return up to `pages` free pages to the filesystem"""
+        with self.pool.connection() as conn:
+            conn.execute(f'PRAGMA incremental_vacuum({int(pages)})').fetchall()  # Steps run as rows are fetched
+
+    def vacuum(self):
+        """Rebuild the file, switching it to incremental auto_vacuum"""
+        with self.pool.connection() as conn:
+            conn.commit()
+            conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            conn.execute('VACUUM')
+            # VACUUM may renumber rowids of tables without an INTEGER PRIMARY KEY
+            conn.execute("INSERT INTO messages_fts(messages_fts) VALUES('rebuild')")
+            conn.execute('UPDATE search_backfill SET done_rowid = high_rowid')
+
+    def optimize(self):
+        """Refresh planner statistics: a full ANALYZE the first time, PRAGMA optimize afterwards"""
+        with self.pool.connection() as conn:
+            analyzed = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'").fetchone()
+            conn.execute('PRAGMA optimize' if analyzed else 'ANALYZE')
+
+    def checkpoint(self):
+        """Fold the WAL into chat.db and truncate it (skipped while readers hold old snapshots)"""
+        with self.pool.connection() as conn:
+            conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchall()
+
+    def acquire_lease(self, name, holder, ttl):
+        """Take a free or expired lease, or extend one `holder` has; True if it now holds it for ttl seconds"""
+        now = time.time()
+        with self.pool.connection() as conn:
+            return conn.execute('''
+                INSERT INTO leases (name, holder, expires_at) VALUES (?, ?, ?)
+                ON CONFLICT(name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at
+                WHERE leases.holder = excluded.holder OR leases.expires_at < ?
+            ''', (name, holder, now + ttl, now)).rowcount > 0
+
+    def renew_leases(self, holder, ttl):
+        """Extend every lease `holder` still has; returns their names"""
+        with self.pool.connection() as conn:
+            conn.execute('UPDATE leases SET expires_at = ? WHERE holder = ?', (time.time() + ttl, holder))
+            return [row[0] for row in conn.execute('SELECT name FROM leases WHERE holder = ?', (holder,))]
+
+    def release_lease(self, name, holder):
+        with self.pool.connection() as conn:
+            conn.execute('DELETE FROM leases WHERE name = ? AND holder = ?', (name, holder))
+
+    def lease_holder(self, name):
+        """Holder of an unexpired lease, or None"""
+        with self.pool.connection() as conn:
+            row = conn.execute('SELECT holder FROM leases WHERE name = ? AND expires_at >= ?',
+                               (name, time.time())).fetchone()
+        return row[0] if row else None
+
+    def get_active_session_count(self):
+        """Get count of active sessions (last 1 hour)"""
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT COUNT(*) FROM sessions
+                WHERE last_active >= datetime('now', '-1 hour')
+            ''')
+            return cursor.fetchone()[0]
+
+class StorageUnavailable(Exception):
+    """The remote storage backend could not be reached or failed the call; safe to retry"""
+
+class RemoteChatDatabase(StorageBackend):
+    """Storage served over HTTP by app/storage_server.py (STORAGE_BACKEND=http).
+
+    Every worker and replica talks to the one server that owns chat.db, so
+    sessions, history, batch jobs and leases are shared across nodes. Each
+    STORAGE_METHODS call is a JSON POST to /storage/<method> on a keep-alive
+    pool; only connection failures are retried, since a write that reached
+    the server must not be replayed.
+    """
+    local = False
+    shared = True
+
+    def __init__(self, url=STORAGE_URL, token=STORAGE_TOKEN, timeout=STORAGE_TIMEOUT,
+                 connect_timeout=10, retries=3, backoff_factor=0.5, pool_maxsize=64):
+        super().__init__()
+        self.url = url.rstrip('/')
+        self.timeout = (connect_timeout, timeout)
+        retry = Retry(total=retries, connect=retries, read=0, status=0, other=0,
+                      backoff_factor=backoff_factor, allowed_methods=None)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize, max_retries=retry)
+        self.http = requests.Session()
+        self.http.mount('http://', adapter)
+        self.http.mount('https://', adapter)
+        if token:
+            self.http.headers['Authorization'] = f'Bearer {token}'
+
+    def call(self, method, *args, **kwargs):
+        start = time.time()
+        try:
+            response = self.http.post(f'{self.url}/storage/{method}', json={'args': args, 'kwargs': kwargs},
+                                      timeout=self.timeout)
+        except requests.RequestException as e:
+            chat_errors_total.labels(type='storage_unavailable').inc()
+            raise StorageUnavailable(f"{method}: {e}")
+        finally:
+            storage_request_time.labels(method=method).observe(time.time() - start)
+
+        try:
+            body = response.json()
+        except ValueError:
+            body = {}
+        if response.status_code == 400:
+            raise ValueError(body.get('error', 'invalid storage call'))  # Bad cursors and queries, as with SQLite
+        if response.status_code != 200:
+            chat_errors_total.labels(type='storage_unavailable').inc()
+            raise StorageUnavailable(f"{method}: HTTP {response.status_code} {body.get('error', '')}".rstrip())
+        return body['result']
+
+def _remote_method(name):
+    def method(self, *args, **kwargs):
+        return self.call(name, *args, **kwargs)
+    method.__name__ = name
+    return method
+
+for _name in STORAGE_METHODS:
+    setattr(RemoteChatDatabase, _name, _remote_method(_name))
+
+def parse_search(text):
+    """Split free text into FTS5 terms: [(MATCH expression, words, prefix)].
+
+    Words are quoted so punctuation never becomes query syntax; "quoted phrases"
+    are kept together and a trailing * makes a prefix match. Raises ValueError
+    when the text has nothing to search for.
+    """
+    terms = []
+    for phrase, word, star in re.findall(r'"([^"]*)"|(\w+)(\*?)', text):
+        words = re.findall(r'\w+', phrase) if phrase else [word] if word else []
+        if words:
+            terms.append(('"' + ' '.join(words) + '"' + ('*' if star else ''), [w.lower() for w in words], bool(star)))
+    if not terms:
+        raise ValueError('q must contain at least one word')
+    return terms[:SEARCH_MAX_TERMS]
+
+def search_stem(word):
+    """Rough suffix stripping, close enough to the index's Porter stemmer for scoring and highlights"""
+    for suffix in ('ing', 'ed', 'es', 's', 'ly'):
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            return word[:-len(suffix)]
+    return word
+
+def search_patterns(terms):
+    """One compiled regex per parse_search term, finding its words in lowercased text"""
+    patterns = []
+    for _, words, prefix in terms:
+        alternatives = [re.escape(search_stem(w)) + r'(?:s|es|ed|ing|ly)?\b' for w in (words[:-1] if prefix else words)]
+        if prefix:
+            alternatives.append(re.escape(words[-1]) + r'\w*')
+        patterns.append(re.compile(r'\b(?:' + '|'.join(alternatives) + ')'))
+    return patterns
+
+def make_snippet(content, patterns, width=SEARCH_SNIPPET_TOKENS):
+    """HTML-escaped window of `width` words around the first match, matches wrapped in <mark>"""
+    words = content.split()
+    hits = [any(p.search(word.lower()) for p in patterns) for word in words]
+    first = hits.index(True) if True in hits else 0
+    start = max(0, min(first - width // 3, len(words) - width))
+    text = ' '.join(f'<mark>{html.escape(words[i])}</mark>' if hits[i] else html.escape(words[i])
+                    for i in range(start, min(start + width, len(words))))
+    return ('…' if start > 0 else '') + text + ('…' if start + width < len(words) else '')
+
+def encode_cursor(values):
+    """Opaque pagination cursor for a list of keyset values"""
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor):
+    """Inverse of encode_cursor; raises ValueError on a malformed cursor"""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (ValueError, TypeError):
+        raise ValueError('invalid cursor')
+    if not isinstance(values, list):
+        raise ValueError('invalid cursor')
+    return values
+
+# Anthropic usage fields, in sessions.*_tokens column order
+USAGE_KEYS = ('input_tokens', 'output_tokens', 'cache_read_input_tokens', 'cache_creation_input_tokens')
+
+def add_usage(total, usage):
+    """Sum Anthropic usage dicts (one per upstream request) into total"""
+    for key in USAGE_KEYS:
+        total[key] = total.get(key, 0) + (usage.get(key) or 0)
+    return total
+
+def estimate_tokens(text):
+    """Fast local token estimate: ~4 characters per token, never fewer than whitespace-separated words"""
+    if not text:
+        return 0
+    return max((len(text) + 3) // 4, len(text.split()))
+
+def make_message_row(session_id, role, content, tokens=None, response_time=None):
+    """Build a messages row; timestamp is taken now so queued writes keep their order"""
+    timestamp = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+    if tokens is None:
+        tokens = estimate_tokens(content)
+    return (str(uuid.uuid4()), session_id, role, content, tokens, response_time, timestamp)
+
+def message_from_row(row):
+    """Convert a make_message_row tuple to the get_history dict shape"""
+    return {
+        'message_id': row[0],
+        'role': row[2],
+        'content': row[3],
+        'timestamp': row[6],
+        'tokens': row[4],
+        'response_time': row[5]
+    }
+
+class MessageWriter:
+    """Write-behind queue that batches message inserts on a background thread"""
+    _STOP = object()
+
+    def __init__(self, database, maxsize=WRITE_QUEUE_SIZE):
+        self.db = database
+        self._queue = queue.Queue(maxsize)
+        self._thread = None
+
+    def start(self):
+        """Start the writer thread and flush remaining messages at exit"""
+        if self._thread:
+            return
+        self._thread = threading.Thread(target=self._run, name='message-writer', daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self, timeout=30):
+        """Drain the queue and stop the writer thread"""
+        if not self._thread:
+            return
+        self._queue.put(self._STOP)
+        self._thread.join(timeout)
+        self._thread = None
+
+    def flush(self):
+        """Block until every queued message has been committed"""
+        if self._thread:
+            self._queue.join()
+
+    def save_message(self, session_id, role, content, tokens=None, response_time=None):
+        """Queue a message for persistence and return its message_id immediately"""
+        row = make_message_row(session_id, role, content, tokens, response_time)
+        self.db.history_cache.append(session_id, message_from_row(row))
+
+        if not self._thread:
+            self.db.save_messages([row])
+            return row[0]
+
+        try:
+            self._queue.put_nowait(row)
+        except queue.Full:
+            write_backpressure_total.labels(outcome='blocked').inc()
+            try:
+                self._queue.put(row, timeout=WRITE_ENQUEUE_TIMEOUT)
+            except queue.Full:
+                # Never drop chat history; pay the disk write inline instead
+                write_backpressure_total.labels(outcome='sync_fallback').inc()
+                self.db.save_messages([row])
+
+        write_queue_depth.set(self._queue.qsize())
+        return row[0]
+
+    def add_session_usage(self, session_id, usage):
+        """Queue a per-session token usage increment; committed with the next message batch"""
+        item = (session_id, usage)
+        if not self._thread:
+            self.db.save_messages([], [item])
+            return
+        try:
+            self._queue.put(item, timeout=WRITE_ENQUEUE_TIMEOUT)
+        except queue.Full:
+            write_backpressure_total.labels(outcome='sync_fallback').inc()
+            self.db.save_messages([], [item])
+
+    def _run(self):
+        stopping = False
+        while not (stopping and self._queue.empty()):
+            batch = []
+            usage = []
+            signals = 0
+
+            # Block for the first message, then drain whatever else is waiting into the same transaction
+            item = self._queue.get()
+            while True:
+                if item is self._STOP:
+                    stopping = True
+                    signals += 1
+                elif len(item) == 2:
+                    usage.append(item)  # (session_id, usage) from add_session_usage
+                else:
+                    batch.append(item)
+                if len(batch) + len(usage) >= WRITE_BATCH_SIZE:
+                    break
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+
+            try:
+                if batch or usage:
+                    self._write(batch, usage)
+            finally:
+                # Always account for the batch so flush() can never wedge on it
+                for _ in range(len(batch) + len(usage) + signals):
+                    self._queue.task_done()
+                write_queue_depth.set(self._queue.qsize())
+
+    def _write(self, batch, usage=()):
+        start = time.time()
+        for attempt in range(WRITE_RETRIES):
+            try:
+                self.db.save_messages(batch, usage)
+                break
+            except (sqlite3.OperationalError, StorageUnavailable) as e:
+                chat_errors_total.labels(type='db_write_retry').inc()
+                if attempt == WRITE_RETRIES - 1:
+                    chat_errors_total.labels(type='db_write_error').inc()
+                    print(f"ERROR: Dropped {len(batch)} queued messages: {e}")
+                    return
+                time.sleep(0.1 * (attempt + 1))
+            except Exception as e:
+                # Not transient (constraint violation, corrupt file, rejected by the storage server): don't retry
+                chat_errors_total.labels(type='db_write_error').inc()
+                print(f"ERROR: Dropped {len(batch)} queued messages: {e}")
+                return
+
+        write_flush_time.observe(time.time() - start)
+        write_batch_size.observe(len(batch))
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""
+CrewAI Chat Passthrough Agent - storage server
+Owns chat.db for agents running with STORAGE_BACKEND=http, so workers and
+replicas on any number of nodes share sessions, history, batch jobs and
+leases. Serves the ChatDatabase STORAGE_METHODS as JSON over HTTP and runs
+the search index backfill and database maintenance itself.
+"""
+
+import os
+import sys
+import hmac
+import sqlite3
+import threading
+from flask import Flask, request, jsonify, Response
+
+os.environ['STORAGE_BACKEND'] = 'sqlite'  # This process is the store the agents point at
+
+import main  # noqa: E402
+from main import InstanceHeartbeat, backfill_search_index, generate_latest, CONTENT_TYPE_LATEST  # noqa: E402
+from storage import STORAGE_METHODS, STORAGE_TOKEN  # noqa: E402
+
+STORAGE_PORT = int(os.environ.get('STORAGE_PORT', 8090))
+STORAGE_ALLOW_ANONYMOUS = os.environ.get('STORAGE_ALLOW_ANONYMOUS', '0') == '1'  # Serve without STORAGE_TOKEN, on 127.0.0.1 only
+
+app = Flask(__name__)
+
+
+@app.route('/storage/<method>', methods=['POST'])
+def call(method):
+    """{"args": [...], "kwargs": {...}} -> {"result": ...}; 400 carries ValueErrors back to the caller"""
+    if STORAGE_TOKEN and not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {STORAGE_TOKEN}'):
+        return jsonify({'error': 'unauthorized'}), 401
+    if method not in STORAGE_METHODS:
+        return jsonify({'error': f'unknown storage method {method}'}), 404
+
+    data = request.get_json(silent=True) or {}
+    try:
+        result = getattr(main.db, method)(*data.get('args', []), **data.get('kwargs', {}))
+    except (ValueError, TypeError) as e:
+        return jsonify({'error': str(e)}), 400
+    except sqlite3.OperationalError as e:
+        main.chat_errors_total.labels(type='storage_busy').inc()
+        return jsonify({'error': str(e)}), 503
+    return jsonify({'result': result})
+
+
+@app.route('/health', methods=['GET'])
+def health():
+    return jsonify({'status': 'healthy', 'service': 'crewai-chat-pt-air-storage'})
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(generate_latest(), mimetype=CONTENT_TYPE_LATEST)
+
+
+if __name__ == '__main__':
+    host = '0.0.0.0'
+    if not STORAGE_TOKEN:
+        if not STORAGE_ALLOW_ANONYMOUS:
+            print("ERROR: STORAGE_TOKEN is not set; refusing to serve chat.db without authentication "
+                  "(STORAGE_ALLOW_ANONYMOUS=1 serves it on 127.0.0.1 only)")
+            sys.exit(1)
+        host = '127.0.0.1'
+        print("WARNING: STORAGE_TOKEN is not set; serving chat.db without authentication on 127.0.0.1 only")
+
+    threading.Thread(target=backfill_search_index, args=(main.db,), name='search-backfill', daemon=True).start()
+    main.maintenance._update_size()
+    main.maintenance.start()
+    InstanceHeartbeat(main.db, c2=False).start()  # Keeps the maintenance leases of long runs alive
+    main.runtime_metrics.start()
+
+    print(f"Starting CrewAI Chat PT Air storage server on port {STORAGE_PORT} ({main.db.db_path})")
+    app.run(host=host, port=STORAGE_PORT, threaded=True)
@@ -0,0 +1,482 @@
+#!/usr/bin/env python3
+"""
+CrewAI Chat Passthrough Agent - resumable SSE streams
+Each upstream answer is produced once into a bounded, replayable buffer and
+fanned out to any number of readers, who can reconnect with Last-Event-ID
+"""
+
+import os
+import json
+import time
+import uuid
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict, deque
+
+from metrics import (chat_errors_total, coalesced_requests_total, stream_aborted_total, stream_buffer_bytes,
+                     stream_events_trimmed_total, stream_evictions_total, stream_resumes_total, streams_buffered)
+
+# Resumable SSE stream buffers
+STREAM_BUFFER_BYTES = int(os.environ.get('STREAM_BUFFER_BYTES', 1024 * 1024))  # Per stream; oldest events dropped beyond this
+STREAM_BUFFER_TOTAL_BYTES = int(os.environ.get('STREAM_BUFFER_TOTAL_BYTES', 64 * 1024 * 1024))
+STREAM_RETAIN_SECONDS = float(os.environ.get('STREAM_RETAIN_SECONDS', 120))
+STREAM_DETACH_GRACE = float(os.environ.get('STREAM_DETACH_GRACE', 30))
+STREAM_COALESCE_MS = float(os.environ.get('STREAM_COALESCE_MS', 0))  # Merge token events for up to N ms, 0 = off
+STREAM_COALESCE_BYTES = int(os.environ.get('STREAM_COALESCE_BYTES', 0))  # ...or until N bytes of text, 0 = no limit
+
+
+def normalize_text(text):
+    """Case- and whitespace-insensitive form of a prompt, ignoring trailing punctuation"""
+    return ' '.join((text or '').lower().split()).rstrip(' ?!.')
+
+
+def resolve_future(future):
+    if not future.done():
+        future.set_result(None)
+
+
+def sse_event(event):
+    """Serialize one stream event dict as an SSE data frame"""
+    return f"data: {json.dumps(event)}\n\n"
+
+
+# hub.attach() failures -> (HTTP status, error). Buffered streams live in one process, so a resume
+# that reaches another gunicorn worker also finds nothing: the client must restart the turn instead.
+RESUME_ERRORS = {
+    'not_found': (404, 'stream not found: it expired or is held by another worker'),
+    'gone': (410, 'resume point no longer buffered'),
+}
+
+
+class TokenCoalescer:
+    """Merges consecutive token events into one, cutting per-event framing and writes.
+
+    A merged event is released once STREAM_COALESCE_MS have passed since its
+    first token or STREAM_COALESCE_BYTES of text have built up. It is also
+    released before any other event. Checks happen as tokens arrive, so a
+    token waits at most until the next event.
+    """
+    def __init__(self, max_ms=0, max_bytes=0):
+        self.max_seconds = max_ms / 1000
+        self.max_bytes = max_bytes
+        self.enabled = bool(max_ms or max_bytes)
+        self._parts = []
+        self._size = 0
+        self._since = None
+
+    def push(self, event):
+        """Returns the events ready to publish"""
+        if not self.enabled:
+            return [event]
+        if 'token' not in event:
+            return self.flush() + [event]
+
+        if not self._parts:
+            self._since = time.monotonic()
+        self._parts.append(event['token'])
+        self._size += len(event['token'])
+        if (self.max_bytes and self._size >= self.max_bytes) or \
+                (self.max_seconds and time.monotonic() - self._since >= self.max_seconds):
+            return self.flush()
+        return []
+
+    def flush(self):
+        if not self._parts:
+            return []
+        event = {'token': ''.join(self._parts)}
+        self._parts = []
+        self._size = 0
+        return [event]
+
+
+class StreamBroadcast:
+    """Bounded, replayable buffer of one generated SSE stream.
+
+    Events are numbered from 0 and sent with an `id: <stream_id>:<seq>` line, so a
+    client can reconnect with Last-Event-ID and resume from the next event.
+    Any number of readers may be attached. Once the buffer exceeds
+    STREAM_BUFFER_BYTES the oldest events are dropped, and `base` is the
+    oldest sequence number still held.
+    """
+    def __init__(self, key=None, hub=None, max_bytes=STREAM_BUFFER_BYTES):
+        self.stream_id = uuid.uuid4().hex
+        self.key = key
+        self.hub = hub
+        self.max_bytes = max_bytes
+        self.events = deque()
+        self.base = 0
+        self.bytes = 0
+        self.done = False
+        self.finished_at = None
+        self.subscribers = 0
+        self._completions = []  # on_complete callbacks; the first belongs to the request that opened the stream
+        self._cond = threading.Condition()
+        self._waiters = []      # (loop, future) for asyncio subscribers
+
+    @property
+    def next_seq(self):
+        return self.base + len(self.events)
+
+    def subscribe(self):
+        with self._cond:
+            self.subscribers += 1
+
+    def unsubscribe(self):
+        with self._cond:
+            self.subscribers -= 1
+
+    def publish(self, event):
+        """Serialize an event once and make it visible to every reader"""
+        chunk = sse_event(event)
+        delta = len(chunk)
+        trimmed = 0
+        with self._cond:
+            self.events.append(chunk)
+            self.bytes += delta
+            while self.bytes > self.max_bytes and len(self.events) > 1:
+                size = len(self.events.popleft())
+                self.bytes -= size
+                delta -= size
+                self.base += 1
+                trimmed += 1
+            self._notify()
+        if trimmed:
+            stream_events_trimmed_total.inc(trimmed)
+        if self.hub:
+            self.hub.account(delta)
+
+    def finish(self):
+        with self._cond:
+            self.done = True
+            self.finished_at = time.time()
+            self._notify()
+
+    def _notify(self):
+        self._cond.notify_all()
+        for loop, future in self._waiters:
+            loop.call_soon_threadsafe(resolve_future, future)
+        self._waiters = []
+
+    def _frame(self, index):
+        """Events from `index` on as SSE chunks with ids, or None if `index` was already trimmed"""
+        if index < self.base:
+            return None
+        return [f"id: {self.stream_id}:{seq}\n{self.events[seq - self.base]}"
+                for seq in range(index, self.next_seq)]
+
+    def resume_index(self, last_event_id):
+        """Sequence number after a Last-Event-ID value (`<stream_id>:<seq>` or `<seq>`)"""
+        if not last_event_id:
+            return 0
+        stream_id, _, seq = str(last_event_id).rpartition(':')
+        if stream_id and stream_id != self.stream_id:
+            return 0
+        try:
+            return int(seq) + 1
+        except ValueError:
+            return 0
+
+    def iter_events(self, start=0):
+        """Framed events from `start` until the stream finishes; closing the reader releases one subscription"""
+        return BroadcastReader(self, self._events(start))
+
+    def iter_events_async(self, start=0):
+        """asyncio variant of iter_events(); iterate with `async for` and release with aclose()"""
+        return BroadcastReader(self, self._events_async(start))
+
+    def _events(self, start):
+        index = start
+        while True:
+            with self._cond:
+                while index >= self.next_seq and not self.done:
+                    self._cond.wait()
+                batch, finished = self._frame(index), self.done
+            if batch is None:
+                yield sse_event({'error': 'Stream buffer overrun; reload the conversation'})
+                return
+            index += len(batch)
+            yield from batch
+            if finished:
+                return
+
+    async def _events_async(self, start):
+        loop = asyncio.get_running_loop()
+        index = start
+        while True:
+            future = None
+            with self._cond:
+                batch, finished = self._frame(index), self.done
+                if batch == [] and not finished:
+                    future = loop.create_future()
+                    self._waiters.append((loop, future))
+            if future:
+                await future
+                continue
+            if batch is None:
+                yield sse_event({'error': 'Stream buffer overrun; reload the conversation'})
+                return
+            index += len(batch)
+            for chunk in batch:
+                yield chunk
+            if finished:
+                return
+
+
+class BroadcastReader:
+    """One subscriber's events; releases its subscription exactly once, on exhaustion or close, even if never iterated"""
+    def __init__(self, broadcast, events):
+        self.broadcast = broadcast
+        self.events = events
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.broadcast.unsubscribe()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self.events)
+        except BaseException:
+            self.release()
+            raise
+
+    def close(self):
+        try:
+            self.events.close()
+        finally:
+            self.release()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self.events.__anext__()
+        except BaseException:
+            self.release()
+            raise
+
+    async def aclose(self):
+        try:
+            await self.events.aclose()
+        finally:
+            self.release()
+
+
+class StreamProgress:
+    """Assembles the answer and usage from a stream's events on the producer side"""
+    def __init__(self):
+        self.parts = []
+        self.usage = None
+        self.detached_since = None
+
+    @property
+    def response(self):
+        return ''.join(self.parts)
+
+    def feed(self, event):
+        if 'token' in event:
+            self.parts.append(event['token'])
+        elif 'usage' in event:
+            self.usage = event['usage']
+
+    def abandoned(self, broadcast):
+        """True once every reader has been gone for longer than STREAM_DETACH_GRACE"""
+        if broadcast.subscribers:
+            self.detached_since = None
+            return False
+        now = time.time()
+        if self.detached_since is None:
+            self.detached_since = now
+        return now - self.detached_since > STREAM_DETACH_GRACE
+
+
+class StreamHub:
+    """Runs each upstream stream once in a producer and fans it out to SSE clients.
+
+    Requests with identical model, system prompt, history and prompt that arrive
+    while a stream is in flight join it instead of opening another upstream call.
+    Streams stay registered by stream_id (for Last-Event-ID resumes) until
+    STREAM_RETAIN_SECONDS after they finish, or until STREAM_BUFFER_TOTAL_BYTES
+    forces the oldest finished streams out.
+    """
+    def __init__(self, coalesce=True, max_bytes=STREAM_BUFFER_TOTAL_BYTES, retain=STREAM_RETAIN_SECONDS,
+                 token_ms=STREAM_COALESCE_MS, token_bytes=STREAM_COALESCE_BYTES):
+        self.coalesce = coalesce
+        self.max_bytes = max_bytes
+        self.retain = retain
+        self.token_ms = token_ms        # TokenCoalescer limits for published token events
+        self.token_bytes = token_bytes
+        self.bytes = 0                  # Buffered event bytes across registered streams
+        self._inflight = {}             # coalescing key -> StreamBroadcast
+        self._streams = OrderedDict()   # stream_id -> StreamBroadcast, oldest first
+        self._lock = threading.Lock()
+
+    def coalesce_key(self, llm, prompt, history, summary, use_cache):
+        if not (self.coalesce and use_cache):
+            return None
+        history = [(m['role'], normalize_text(m['content'])) for m in history or []]
+        system = [block['text'] for block in llm.system_blocks()]
+        material = json.dumps([llm.model, system, summary or '', history, normalize_text(prompt)])
+        return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+    def _join_or_create(self, key, on_complete):
+        with self._lock:
+            self._evict()
+            broadcast = self._inflight.get(key) if key else None
+            # Join only while the whole stream is still buffered, so the joiner gets the full answer
+            if broadcast and not broadcast.done and broadcast.base == 0:
+                broadcast.subscribe()
+                if on_complete:
+                    broadcast._completions.append(on_complete)
+                coalesced_requests_total.inc()
+                return broadcast, True
+            broadcast = StreamBroadcast(key, hub=self)
+            broadcast.subscribe()   # Reserved for the caller before the producer can see zero subscribers
+            if on_complete:
+                broadcast._completions.append(on_complete)
+            if key:
+                self._inflight[key] = broadcast
+            self._streams[broadcast.stream_id] = broadcast
+            self._update_gauges()
+            return broadcast, False
+
+    def open(self, llm, prompt, session_id, history=None, summary=None, use_cache=True, user_id='anonymous',
+             on_complete=None):
+        """Returns (broadcast, coalesced); iterate broadcast.iter_events() to consume it.
+
+        on_complete(response, usage) runs on the producer once the stream ends, even if the
+        client disconnected; usage is None for requests that joined another's stream.
+        """
+        key = self.coalesce_key(llm, prompt, history, summary, use_cache)
+        broadcast, coalesced = self._join_or_create(key, on_complete)
+        if not coalesced:
+            stream = llm.generate_stream(prompt, session_id, conversation_history=history, summary=summary,
+                                         use_cache=use_cache, user_id=user_id)
+            threading.Thread(target=self._produce, args=(broadcast, stream), name='stream-producer', daemon=True).start()
+        return broadcast, coalesced
+
+    def open_async(self, llm, client, prompt, session_id, history=None, summary=None, use_cache=True,
+                   user_id='anonymous', on_complete=None):
+        """asyncio variant of open(); iterate broadcast.iter_events_async()"""
+        key = self.coalesce_key(llm, prompt, history, summary, use_cache)
+        broadcast, coalesced = self._join_or_create(key, on_complete)
+        if not coalesced:
+            stream = llm.generate_stream_async(client, prompt, session_id, conversation_history=history,
+                                               summary=summary, use_cache=use_cache, user_id=user_id)
+            asyncio.get_running_loop().create_task(self._produce_async(broadcast, stream))
+        return broadcast, coalesced
+
+    def attach(self, stream_id, last_event_id=None):
+        """Subscribe to a registered stream for a resume; returns (broadcast, start, result)"""
+        with self._lock:
+            self._evict()
+            broadcast = self._streams.get(stream_id)
+            if not broadcast:
+                result, start = 'not_found', None
+            else:
+                start = broadcast.resume_index(last_event_id)
+                result = 'gone' if start < broadcast.base else 'resumed'
+                if result == 'resumed':
+                    broadcast.subscribe()
+        stream_resumes_total.labels(result=result).inc()
+        return (broadcast if result == 'resumed' else None), start, result
+
+    def _produce(self, broadcast, stream):
+        progress = StreamProgress()
+        coalescer = TokenCoalescer(self.token_ms, self.token_bytes)
+        completed = False
+        try:
+            for event in stream:
+                progress.feed(event)
+                for ready in coalescer.push(event):
+                    broadcast.publish(ready)
+                if progress.abandoned(broadcast):
+                    stream_aborted_total.inc()
+                    break   # Nobody came back; stop paying for tokens nobody reads
+            else:
+                completed = True
+        finally:
+            stream.close()
+            for ready in coalescer.flush():
+                broadcast.publish(ready)
+            self._retire(broadcast, progress if completed else None)
+
+    async def _produce_async(self, broadcast, stream):
+        progress = StreamProgress()
+        coalescer = TokenCoalescer(self.token_ms, self.token_bytes)
+        completed = False
+        try:
+            async for event in stream:
+                progress.feed(event)
+                for ready in coalescer.push(event):
+                    broadcast.publish(ready)
+                if progress.abandoned(broadcast):
+                    stream_aborted_total.inc()
+                    break
+            else:
+                completed = True
+        finally:
+            await stream.aclose()
+            for ready in coalescer.flush():
+                broadcast.publish(ready)
+            self._retire(broadcast, progress if completed else None)
+
+    def _retire(self, broadcast, progress):
+        with self._lock:
+            if broadcast.key and self._inflight.get(broadcast.key) is broadcast:
+                del self._inflight[broadcast.key]
+            completions = broadcast._completions
+        broadcast.finish()
+
+        if progress:
+            for i, on_complete in enumerate(completions):
+                try:
+                    # Upstream cost is charged to the request that opened the stream
+                    on_complete(progress.response, progress.usage if i == 0 else None)
+                except Exception as e:
+                    chat_errors_total.labels(type='stream_completion_error').inc()
+                    print(f"ERROR: Stream {broadcast.stream_id} completion failed: {e}")
+
+    def account(self, delta):
+        """Track buffered bytes; evict finished streams once over the memory cap"""
+        with self._lock:
+            self.bytes += delta
+            if self.bytes > self.max_bytes:
+                self._evict()
+            stream_buffer_bytes.set(self.bytes)
+
+    def _evict(self):
+        """Drop expired finished streams, then the oldest finished ones while over the memory cap (caller holds the lock)"""
+        now = time.time()
+        for stream_id, broadcast in list(self._streams.items()):
+            if broadcast.done and now - broadcast.finished_at > self.retain:
+                self._drop(stream_id, 'ttl')
+
+        for stream_id, broadcast in list(self._streams.items()):
+            if self.bytes <= self.max_bytes:
+                break
+            if broadcast.done:
+                self._drop(stream_id, 'memory')
+
+        stream_buffer_bytes.set(self.bytes)
+        self._update_gauges()
+
+    def _drop(self, stream_id, reason):
+        broadcast = self._streams.pop(stream_id)
+        with broadcast._cond:
+            self.bytes -= broadcast.bytes
+            broadcast.bytes = 0
+            broadcast.base = broadcast.next_seq    # Attached readers get an overrun error, not a silent gap
+            broadcast.events.clear()
+        stream_evictions_total.labels(reason=reason).inc()
+
+    def _update_gauges(self):
+        finished = sum(1 for b in self._streams.values() if b.done)
+        streams_buffered.labels(state='finished').set(finished)
+        streams_buffered.labels(state='live').set(len(self._streams) - finished)
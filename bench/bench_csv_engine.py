@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+Columnar CSV engine benchmark
+
+Generates a synthetic KMMU-style operations CSV (default 2,000,000 rows),
+builds the ColumnarTable from it in one streaming pass and reports load time,
+rows/sec, RSS growth, index size and query latencies as JSON.
+
+Usage: python3 bench/bench_csv_engine.py [--rows 2000000] [--keep FILE]
+"""
+
+import os
+import sys
+import csv
+import json
+import time
+import random
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+
+from csv_engine import ColumnarTable  # noqa: E402
+
+HEADER = ['Record_Number', 'Operation_Date_Time', 'Operation_Type', 'Rwy_Used', 'Adsb_N_Number',
+          'AC_Mfr_Name', 'AC_Model', 'Registrant_State', 'Type_Aircraft', 'Number_of_Seats',
+          'Engine_Horsepower', 'Cruising_Speed', 'AP_Wx_Category', 'Adsb_RSSI']
+MANUFACTURERS = ['PIPER', 'CESSNA', 'BOMBARDIER INC', 'DASSAULT AVIATION', 'CIRRUS DESIGN CORP',
+                 'PILATUS AIRCRAFT LTD', 'BEECH', 'TEXTRON AVIATION INC', 'GULFSTREAM AEROSPACE', 'EMBRAER']
+STATES = ['NEW JERSEY', 'DELAWARE', 'TEXAS', 'FLORIDA', 'NEW YORK', 'OHIO', 'OKLAHOMA', 'UTAH',
+          'NORTH CAROLINA', 'PENNSYLVANIA', 'CONNECTICUT', 'MASSACHUSETTS', '']
+
+
+def generate(path, rows, seed=7):
+    rng = random.Random(seed)
+    tails = [f'N{rng.randint(100, 99999)}{rng.choice("ABCDEFGH")}' for _ in range(20000)]
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(HEADER)
+        for i in range(rows):
+            minute = i * 3
+            writer.writerow([
+                100000 + i,
+                f'{1 + (minute // 43200) % 12}/{1 + (minute // 1440) % 28}/2024 {(minute // 60) % 24}:{minute % 60:02d}',
+                rng.choice(('TO', 'LA', 'TO', 'LA', 'FO')),
+                rng.choice(('5', '23', '13', '31')),
+                rng.choice(tails),
+                rng.choice(MANUFACTURERS),
+                f'MODEL-{rng.randint(1, 400)}',
+                rng.choice(STATES),
+                rng.choice(('Fixed wing single engine', 'Fixed wing multi engine', 'Rotorcraft')),
+                rng.randint(1, 19),
+                rng.choice((0, 180, 200, 310, 850)),
+                rng.randint(0, 480),
+                rng.choice(('VFR', 'VFR', 'VFR', 'MVFR', 'IFR', 'LIFR')),
+                f'{-rng.uniform(1, 30):.1f}'
+            ])
+
+
+def rss_kb():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return 0
+
+
+def timed(fn, repeat=5):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return round(best * 1000, 2), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=2000000)
+    parser.add_argument('--keep', help='write the synthetic CSV here and keep it')
+    args = parser.parse_args()
+
+    path = args.keep or os.path.join(tempfile.mkdtemp(prefix='csv-bench-'), 'synthetic.csv')
+    if not os.path.exists(path):
+        start = time.perf_counter()
+        generate(path, args.rows)
+        print(f'generated {args.rows:,} rows in {time.perf_counter() - start:.1f}s', file=sys.stderr)
+
+    rss_before = rss_kb()
+    start = time.perf_counter()
+    table = ColumnarTable.from_csv(path)
+    load = time.perf_counter() - start
+    rss_after = rss_kb()
+
+    takeoffs_rwy5 = [{'column': 'Operation_Type', 'op': 'eq', 'value': 'TO'},
+                     {'column': 'Rwy_Used', 'op': 'eq', 'value': '5'}]
+    march = [{'column': 'Operation_Date_Time', 'op': 'gte', 'value': '3/1/2024'},
+             {'column': 'Operation_Date_Time', 'op': 'lt', 'value': '4/1/2024'}]
+    queries = {
+        'count_all': lambda: table.count(),
+        'value_counts_precomputed': lambda: table.value_counts('AC_Mfr_Name', limit=10),
+        'count_takeoffs_rwy5': lambda: table.count(takeoffs_rwy5),
+        'group_by_state_filtered': lambda: table.group_by('Registrant_State', filters=takeoffs_rwy5, limit=5),
+        'mean_seats_by_mfr': lambda: table.group_by('AC_Mfr_Name', 'mean', 'Number_of_Seats', limit=5),
+        'count_march_range': lambda: table.count(march),
+        'date_range': lambda: (table.aggregate('Operation_Date_Time', 'min'), table.aggregate('Operation_Date_Time', 'max'))
+    }
+    latencies = {name: timed(fn, repeat=3)[0] for name, fn in queries.items()}
+
+    print(json.dumps({
+        'rows': table.rows,
+        'columns': len(table.names),
+        'file_mb': round(os.path.getsize(path) / 1e6, 1),
+        'load_seconds': round(load, 2),
+        'rows_per_sec': round(table.rows / load),
+        'rss_growth_mb': round((rss_after - rss_before) / 1024, 1),
+        'index_mb': round(table.memory_bytes() / 1e6, 1),
+        'query_ms': latencies,
+        'schema': {c['name']: c['type'] for c in table.schema()}
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+ChatDatabase persistence benchmark
+
+Replays the /chat/send persistence path (save user message, read history,
+save assistant message) from concurrent threads and reports messages/sec for
+the legacy connect-per-call access layer, the pooled WAL layer, and the pooled
+layer behind the write-behind MessageWriter queue.
+
+Usage: python3 bench/bench_db.py [--threads 16] [--turns 200] [--pool-size 8]
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import sqlite3
+import argparse
+import tempfile
+import threading
+
+BENCH_DIR = tempfile.mkdtemp(prefix='chat-bench-')
+os.environ.setdefault('DATA_DIR', BENCH_DIR)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+
+from storage import ChatDatabase, MessageWriter  # noqa: E402
+
+
+class LegacyChatDatabase:
+    """Connect-per-call access layer as shipped in v1.0.0 (rollback journal, no pool)"""
+    def __init__(self, db_path):
+        self.db_path = db_path
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS sessions (
+                    session_id TEXT PRIMARY KEY, user_id TEXT NOT NULL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    last_active TIMESTAMP DEFAULT CURRENT_TIMESTAMP, metadata TEXT)
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS messages (
+                    message_id TEXT PRIMARY KEY, session_id TEXT NOT NULL, role TEXT NOT NULL,
+                    content TEXT NOT NULL, timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    tokens INTEGER, response_time REAL)
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_session_id ON messages(session_id)')
+            conn.commit()
+
+    def create_session(self, user_id, metadata=None):
+        session_id = str(uuid.uuid4())
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute('INSERT INTO sessions (session_id, user_id, metadata) VALUES (?, ?, ?)',
+                         (session_id, user_id, json.dumps(metadata or {})))
+            conn.commit()
+        return session_id
+
+    def save_message(self, session_id, role, content, tokens=None, response_time=None):
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute('''
+                INSERT INTO messages (message_id, session_id, role, content, tokens, response_time)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (str(uuid.uuid4()), session_id, role, content, tokens, response_time))
+            conn.execute('UPDATE sessions SET last_active = CURRENT_TIMESTAMP WHERE session_id = ?',
+                         (session_id,))
+            conn.commit()
+
+    def get_history(self, session_id, limit=50):
+        with sqlite3.connect(self.db_path) as conn:
+            cursor = conn.execute('''
+                SELECT message_id, role, content, timestamp, tokens, response_time
+                FROM messages WHERE session_id = ? ORDER BY timestamp DESC LIMIT ?
+            ''', (session_id, limit))
+            return list(reversed(cursor.fetchall()))
+
+
+def run(db, threads, turns, writer=None):
+    """Drive the send path from `threads` workers; returns stats dict"""
+    save = writer or db
+    errors = []
+    barrier = threading.Barrier(threads + 1)
+
+    def worker():
+        session_id = db.create_session('bench')
+        barrier.wait()
+        for i in range(turns):
+            try:
+                db.get_history(session_id, limit=10)
+                save.save_message(session_id, 'user', f'question {i} ' * 8)
+                save.save_message(session_id, 'assistant', f'answer {i} ' * 64, tokens=128, response_time=0.5)
+            except sqlite3.OperationalError as e:
+                errors.append(str(e))
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for w in workers:
+        w.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for w in workers:
+        w.join()
+    request_path = time.perf_counter() - start
+    if writer:
+        writer.flush()
+    elapsed = time.perf_counter() - start
+
+    messages = threads * turns * 2
+    return {
+        'threads': threads,
+        'messages': messages,
+        'seconds': round(elapsed, 3),
+        'messages_per_sec': round(messages / elapsed, 1),
+        'request_path_messages_per_sec': round(messages / request_path, 1),
+        'lock_errors': len(errors)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--turns', type=int, default=200)
+    parser.add_argument('--pool-size', type=int, default=8)
+    args = parser.parse_args()
+
+    legacy = LegacyChatDatabase(os.path.join(BENCH_DIR, 'legacy.db'))
+    pooled = ChatDatabase(os.path.join(BENCH_DIR, 'pooled.db'), pool_size=args.pool_size)
+    queued = ChatDatabase(os.path.join(BENCH_DIR, 'write_behind.db'), pool_size=args.pool_size)
+    writer = MessageWriter(queued)
+    writer.start()
+
+    results = {
+        'legacy': run(legacy, args.threads, args.turns),
+        'pooled': run(pooled, args.threads, args.turns),
+        'write_behind': run(queued, args.threads, args.turns, writer=writer)
+    }
+    writer.stop()
+    results['pooled']['pool_size'] = args.pool_size
+    results['speedup'] = round(results['pooled']['messages_per_sec'] / results['legacy']['messages_per_sec'], 2)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+Upstream connection pool benchmark
+
+Streams N chat turns through ClaudeLLM.generate_stream against the mock
+Anthropic server (or any --url) from a few threads, first with a fresh
+connection per request (the old module-level requests.post behaviour), then
+with ClaudeLLM's shared keep-alive pool. Reports connections opened, reuse
+ratio, mean connect time and per-turn latency as JSON.
+
+Usage: python3 bench/bench_http_pool.py [--turns 200] [--threads 4] [--tokens 50] [--url URL]
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import threading
+from urllib.parse import urlparse
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+os.environ.setdefault('DATA_DIR', tempfile.mkdtemp(prefix='chat-bench-'))
+os.environ.setdefault('ANTHROPIC_API_KEY', 'bench')
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.join(BENCH_DIR, '..', 'app'))
+
+from prometheus_client import REGISTRY  # noqa: E402
+from mock_anthropic import MockAnthropic  # noqa: E402
+from main import ClaudeLLM, build_http_session  # noqa: E402
+
+
+def sample(name, host):
+    return REGISTRY.get_sample_value(name, {'host': host}) or 0.0
+
+
+def run(llm, host, turns, threads):
+    before = {
+        'requests': sample('crewai_chat_http_requests_total', host),
+        'opened': sample('crewai_chat_http_connections_opened_total', host),
+        'connect_sum': sample('crewai_chat_http_connect_seconds_sum', host)
+    }
+    latencies = []
+    lock = threading.Lock()
+
+    def worker(count):
+        for _ in range(count):
+            start = time.perf_counter()
+            for _event in llm.generate_stream('pool benchmark', 'bench'):
+                pass
+            with lock:
+                latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    workers = [threading.Thread(target=worker, args=(turns // threads,)) for _ in range(threads)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    elapsed = time.perf_counter() - start
+
+    requests_sent = sample('crewai_chat_http_requests_total', host) - before['requests']
+    opened = sample('crewai_chat_http_connections_opened_total', host) - before['opened']
+    connect_sum = sample('crewai_chat_http_connect_seconds_sum', host) - before['connect_sum']
+    latencies.sort()
+    return {
+        'turns': len(latencies),
+        'seconds': round(elapsed, 3),
+        'turns_per_sec': round(len(latencies) / elapsed, 1),
+        'latency_p50': round(latencies[len(latencies) // 2], 4),
+        'requests': int(requests_sent),
+        'connections_opened': int(opened),
+        'reuse_ratio': round(1 - opened / requests_sent, 3) if requests_sent else None,
+        'mean_connect_ms': round(1000 * connect_sum / opened, 3) if opened else None
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--turns', type=int, default=200)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--tokens', type=int, default=50)
+    parser.add_argument('--url', help='Messages API URL (default: in-process mock)')
+    args = parser.parse_args()
+
+    url = args.url
+    if not url:
+        mock = MockAnthropic(tokens=args.tokens)
+        url = f'http://127.0.0.1:{mock.start_in_thread()}/v1/messages'
+
+    llm = ClaudeLLM()
+    llm.api_url = url
+    host = urlparse(url).hostname
+    pooled = run(llm, host, args.turns, args.threads)
+
+    # Old behaviour: a new pool, and therefore a new connection, for every request
+    class FreshConnectionPerRequest:
+        def post(self, *a, **kw):
+            return build_http_session().post(*a, **kw)
+
+    llm.http = FreshConnectionPerRequest()
+    unpooled = run(llm, host, args.turns, args.threads)
+
+    print(json.dumps({'url': url, 'unpooled': unpooled, 'pooled': pooled}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
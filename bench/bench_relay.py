@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+SSE relay benchmark on long responses
+
+Two measurements on --tokens long answers (8k by default):
+
+relay: the per-token work between the upstream parser and the client. The
+legacy path serialized each token in the LLM layer, re-parsed it with
+json.loads in the route and grew the answer with +=. The current path passes
+event dicts, collects parts in a list and serializes once.
+
+end_to_end: full turns streamed from the mock Anthropic server through
+StreamHub to --readers attached clients, with token coalescing off and at a
+few STREAM_COALESCE_MS / STREAM_COALESCE_BYTES settings. Reports wall and CPU
+time, SSE events and bytes delivered per reader (one socket write each).
+
+Usage: python3 bench/bench_relay.py [--tokens 8000] [--turns 5] [--readers 4]
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import threading
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+os.environ.setdefault('DATA_DIR', tempfile.mkdtemp(prefix='chat-bench-'))
+os.environ.setdefault('ANTHROPIC_API_KEY', 'bench')
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.join(BENCH_DIR, '..', 'app'))
+
+from mock_anthropic import MockAnthropic  # noqa: E402
+from main import ClaudeLLM  # noqa: E402
+from streaming import StreamHub, StreamProgress, sse_event  # noqa: E402
+
+COALESCE_SETTINGS = [('off', 0, 0), ('10ms', 10, 0), ('50ms', 50, 0), ('256B', 0, 256)]
+
+
+def relay_legacy(tokens):
+    llm_response = ""
+    route_response = ""
+    relayed = []
+    for text in tokens:
+        chunk = f"data: {json.dumps({'token': text})}\n\n"   # LLM layer serializes...
+        llm_response += text
+        data = json.loads(chunk[6:])                            # ...and the route parses it back
+        if 'token' in data:
+            route_response += data['token']
+        relayed.append(chunk)
+    return route_response, relayed
+
+
+def relay_structured(tokens):
+    progress = StreamProgress()
+    relayed = []
+    for text in tokens:
+        event = {'token': text}
+        progress.feed(event)
+        relayed.append(sse_event(event))
+    return progress.response, relayed
+
+
+def bench_relay(count, repeats=5):
+    tokens = [f'tok{i % 97} ' for i in range(count)]
+    report = {}
+    for name, fn in (('legacy', relay_legacy), ('structured', relay_structured)):
+        best = float('inf')
+        for _ in range(repeats):
+            start = time.perf_counter()
+            fn(tokens)
+            best = min(best, time.perf_counter() - start)
+        report[name] = {'seconds': round(best, 5), 'us_per_token': round(1e6 * best / count, 3)}
+    report['speedup'] = round(report['legacy']['seconds'] / report['structured']['seconds'], 2)
+    return report
+
+
+def bench_end_to_end(llm, tokens, turns, readers, token_ms, token_bytes):
+    hub = StreamHub(coalesce=False, token_ms=token_ms, token_bytes=token_bytes)
+    delivered = {'events': 0, 'bytes': 0}
+    lock = threading.Lock()
+
+    def reader(broadcast):
+        events = size = 0
+        for chunk in broadcast.iter_events():
+            events += 1
+            size += len(chunk)
+        with lock:
+            delivered['events'] += events
+            delivered['bytes'] += size
+
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    for turn in range(turns):
+        broadcast, _ = hub.open(llm, f'relay benchmark {turn}', 'bench')
+        for _ in range(readers - 1):
+            broadcast.subscribe()
+        threads = [threading.Thread(target=reader, args=(broadcast,)) for _ in range(readers)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+
+    return {
+        'wall_seconds': round(wall, 3),
+        'cpu_seconds': round(cpu, 3),
+        'events_per_reader_turn': round(delivered['events'] / (turns * readers), 1),
+        'bytes_per_reader_turn': round(delivered['bytes'] / (turns * readers)),
+        'cpu_us_per_token': round(1e6 * cpu / (turns * tokens), 2)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tokens', type=int, default=8000)
+    parser.add_argument('--turns', type=int, default=5)
+    parser.add_argument('--readers', type=int, default=4)
+    args = parser.parse_args()
+
+    mock = MockAnthropic(tokens=args.tokens)
+    llm = ClaudeLLM()
+    llm.api_url = f'http://127.0.0.1:{mock.start_in_thread()}/v1/messages'
+
+    end_to_end = {}
+    for name, token_ms, token_bytes in COALESCE_SETTINGS:
+        end_to_end[name] = bench_end_to_end(llm, args.tokens, args.turns, args.readers, token_ms, token_bytes)
+
+    print(json.dumps({
+        'config': vars(args),
+        'relay': bench_relay(args.tokens),
+        'end_to_end': end_to_end
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""
+Full-text search benchmark
+
+Builds a chat.db with --messages messages spread over --users users (Zipf
+word frequencies, so common words match a large share of rows), indexes it
+through the insert triggers, then rebuilds the index with the backfill job
+and times /chat/search queries per kind: common, mid-frequency and rare
+words, two-word queries, prefixes, phrases and session-scoped searches.
+A LIKE scan over the same user's messages is timed as the unindexed baseline.
+
+Reports p50/p95/p99/max milliseconds per kind and whether every p95 is under
+--target-ms.
+
+Usage: python3 bench/bench_search.py [--messages 1000000] [--users 1000] [--sessions 5] [--queries 200]
+                                     [--target-ms 50] [--skip-backfill]
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import itertools
+import argparse
+import tempfile
+
+os.environ.setdefault('DATA_DIR', tempfile.mkdtemp(prefix='chat-bench-'))
+os.environ.setdefault('MAINTENANCE_STEP_DELAY', '0')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+
+from main import backfill_search_index  # noqa: E402
+from storage import ChatDatabase, make_message_row  # noqa: E402
+
+DOMAIN_WORDS = ['runway', 'arrival', 'departure', 'helicopter', 'cessna', 'piper', 'weather', 'ifr', 'vfr',
+                'touch', 'go', 'operations', 'busiest', 'month', 'morning', 'gulfstream', 'jet', 'state']
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))], 3) if ordered else None
+
+
+def build(db, args, rng, vocabulary, cum_weights):
+    """Insert sessions and messages; returns {user_id: [session_id, ...]} and rows/sec"""
+    users = {}
+    with db.pool.connection() as conn:
+        for u in range(args.users):
+            user_id = f'user-{u}'
+            users[user_id] = [f'{user_id}-s{s}' for s in range(args.sessions)]
+            conn.executemany('INSERT INTO sessions (session_id, user_id, metadata) VALUES (?, ?, ?)',
+                             [(sid, user_id, '{}') for sid in users[user_id]])
+
+    sessions = [sid for sids in users.values() for sid in sids]
+    start = time.perf_counter()
+    rows = []
+    for i in range(args.messages):
+        words = rng.choices(vocabulary, cum_weights=cum_weights, k=rng.randint(8, 40))
+        rows.append(make_message_row(sessions[i % len(sessions)], ('user', 'assistant')[i % 2], ' '.join(words)))
+        if len(rows) == 10000:
+            db.save_messages(rows)
+            rows = []
+    if rows:
+        db.save_messages(rows)
+    return users, args.messages / (time.perf_counter() - start)
+
+
+def time_queries(db, users, kinds, count, rng):
+    report = {}
+    user_ids = list(users)
+    for kind, pick in kinds.items():
+        samples = []
+        hits = 0
+        for _ in range(count):
+            user_id = rng.choice(user_ids)
+            text, session_id = pick(users[user_id])
+            start = time.perf_counter()
+            results, _ = db.search_messages(user_id, text, session_id, 20)
+            samples.append(1000 * (time.perf_counter() - start))
+            hits += len(results)
+        report[kind] = {'p50_ms': percentile(samples, 50), 'p95_ms': percentile(samples, 95),
+                        'p99_ms': percentile(samples, 99), 'max_ms': round(max(samples), 3),
+                        'mean_results': round(hits / count, 1)}
+    return report
+
+
+def time_like_baseline(db, users, word, count, rng):
+    samples = []
+    with db.pool.connection() as conn:
+        for _ in range(count):
+            user_id = rng.choice(list(users))
+            start = time.perf_counter()
+            conn.execute('''
+                SELECT m.message_id FROM messages m JOIN sessions s ON s.session_id = m.session_id
+                WHERE s.user_id = ? AND m.content LIKE ? LIMIT 21
+            ''', (user_id, f'%{word}%')).fetchall()
+            samples.append(1000 * (time.perf_counter() - start))
+    return {'p50_ms': percentile(samples, 50), 'p95_ms': percentile(samples, 95)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=1000000)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--sessions', type=int, default=5, help='sessions per user')
+    parser.add_argument('--queries', type=int, default=200, help='queries per kind')
+    parser.add_argument('--target-ms', type=float, default=50)
+    parser.add_argument('--skip-backfill', action='store_true')
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    vocabulary = DOMAIN_WORDS + [f'w{i}' for i in range(20000)]
+    weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(len(vocabulary))))
+
+    db = ChatDatabase(os.path.join(os.environ['DATA_DIR'], 'chat.db'))
+    users, insert_rate = build(db, args, rng, vocabulary, weights)
+    report = {'config': vars(args), 'insert_rows_per_sec': round(insert_rate)}
+
+    if not args.skip_backfill:
+        # Drop the trigger-built index and rebuild it the way an upgraded database is
+        with db.pool.connection() as conn:
+            conn.execute("INSERT INTO messages_fts(messages_fts) VALUES('delete-all')")
+            conn.execute('UPDATE search_backfill SET high_rowid = (SELECT MAX(rowid) FROM messages), done_rowid = 0')
+        start = time.perf_counter()
+        backfill_search_index(db)
+        report['backfill_rows_per_sec'] = round(args.messages / (time.perf_counter() - start))
+
+    with db.pool.connection() as conn:
+        conn.execute('PRAGMA optimize')
+    report['db_mb'] = round(db.storage_stats()['file_bytes'] / 2 ** 20, 1)
+
+    kinds = {
+        'common': lambda sids: ('runway', None),
+        'mid': lambda sids: (f'w{rng.randrange(100, 1000)}', None),
+        'rare': lambda sids: (f'w{rng.randrange(10000, 20000)}', None),
+        'two_words': lambda sids: (f'{rng.choice(DOMAIN_WORDS)} w{rng.randrange(10, 500)}', None),
+        'prefix': lambda sids: ('heli*', None),
+        'phrase': lambda sids: (f'"{rng.choice(DOMAIN_WORDS)} {rng.choice(DOMAIN_WORDS)}"', None),
+        'session_scoped': lambda sids: ('weather', rng.choice(sids))
+    }
+    report['queries'] = time_queries(db, users, kinds, args.queries, rng)
+    report['like_baseline_mid'] = time_like_baseline(db, users, 'w500 ', min(args.queries, 20), rng)
+    report['within_target'] = all(q['p95_ms'] <= args.target_ms for q in report['queries'].values())
+
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+"""
+Concurrent SSE stream benchmark: threaded Flask vs ASGI
+
+Starts the mock Anthropic server, launches the agent as a subprocess in each
+serving mode, opens N simultaneous /chat/send streams against it and reports
+completed streams, time-to-first-token, total latency, peak RSS, RSS per
+in-flight stream and peak thread count as JSON.
+
+Usage: python3 bench/bench_streams.py [--mode both] [--streams 500] [--tokens 100] [--token-rate 20]
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import tempfile
+import subprocess
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.join(BENCH_DIR, '..', 'app')
+sys.path.insert(0, BENCH_DIR)
+
+from mock_anthropic import MockAnthropic  # noqa: E402
+
+ENTRY_POINTS = {
+    'threaded': [os.path.join(APP_DIR, 'main.py')],
+    'asgi': [os.path.join(APP_DIR, 'asgi.py')],
+    'workers': ['-m', 'gunicorn', '-c', os.path.join(APP_DIR, 'gunicorn.conf.py')]
+}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def proc_status(pid):
+    """Return (rss_kb, threads) from /proc, summed over the process and its children (gunicorn workers)"""
+    rss = threads = 0
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                rss = int(line.split()[1])
+            elif line.startswith('Threads:'):
+                threads = int(line.split()[1])
+    try:
+        with open(f'/proc/{pid}/task/{pid}/children') as f:
+            children = [int(child) for child in f.read().split()]
+    except OSError:
+        children = []
+    for child in children:
+        try:
+            child_rss, child_threads = proc_status(child)
+        except OSError:
+            continue  # Exited meanwhile
+        rss += child_rss
+        threads += child_threads
+    return rss, threads
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * pct / 100))], 4)
+
+
+async def read_http_stream(reader):
+    """Yield body bytes from a (possibly chunked) HTTP/1.1 response"""
+    status = await reader.readline()
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip().lower()
+
+    if int(status.split()[1]) != 200:
+        raise RuntimeError(status.decode('latin-1').strip())
+
+    if headers.get('transfer-encoding') == 'chunked':
+        while True:
+            size = int((await reader.readline()).strip() or b'0', 16)
+            if size == 0:
+                return
+            yield await reader.readexactly(size)
+            await reader.readline()
+    else:
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                return
+            yield data
+
+
+async def chat_stream(port, index, results):
+    """One client: POST /chat/send and consume the SSE stream"""
+    body = json.dumps({'message': f'benchmark question {index}', 'user_id': f'bench-{index % 50}'}).encode()
+    start = time.perf_counter()
+    ttft = None
+    done = False
+    try:
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(
+            b'POST /chat/send HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\n'
+            b'Connection: close\r\nContent-Length: %d\r\n\r\n%s' % (len(body), body)
+        )
+        await writer.drain()
+
+        buffer = b''
+        async for data in read_http_stream(reader):
+            buffer += data
+            while b'\n\n' in buffer:
+                event, buffer = buffer.split(b'\n\n', 1)
+                if ttft is None and b'"token"' in event:
+                    ttft = time.perf_counter() - start
+                if b'"done"' in event:
+                    done = True
+                if b'"error"' in event:
+                    raise RuntimeError(event.decode('utf-8', 'replace')[:200])
+        writer.close()
+    except Exception as e:
+        results['errors'].append(str(e)[:200])
+        return
+
+    if done:
+        results['ttft'].append(ttft)
+        results['total'].append(time.perf_counter() - start)
+
+
+async def drive(port, pid, streams):
+    results = {'ttft': [], 'total': [], 'errors': []}
+    peak = {'rss_kb': 0, 'threads': 0}
+    finished = asyncio.Event()
+
+    async def sample():
+        while not finished.is_set():
+            rss, threads = proc_status(pid)
+            peak['rss_kb'] = max(peak['rss_kb'], rss)
+            peak['threads'] = max(peak['threads'], threads)
+            await asyncio.sleep(0.1)
+
+    sampler = asyncio.create_task(sample())
+    start = time.perf_counter()
+    await asyncio.gather(*(chat_stream(port, i, results) for i in range(streams)))
+    wall = time.perf_counter() - start
+    finished.set()
+    await sampler
+    return results, peak, wall
+
+
+def wait_healthy(port, proc, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f'agent exited with {proc.returncode}')
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1) as s:
+                s.sendall(b'GET /health HTTP/1.0\r\n\r\n')
+                if b'healthy' in s.recv(4096):
+                    return
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError('agent did not become healthy')
+
+
+def start_agent(mode, mock_port, log=False, **env_overrides):
+    """Launch the agent in a scratch directory against the mock; returns (process, port, workdir).
+
+    With log=True the agent's output is kept in <workdir>/agent.log.
+    """
+    port = free_port()
+    workdir = tempfile.mkdtemp(prefix=f'chat-bench-{mode}-')
+    env = dict(os.environ,
+               API_PORT=str(port),
+               METRICS_PORT=str(free_port()),
+               DATA_DIR=os.path.join(workdir, 'data'),
+               INPUT_DIR=os.path.join(workdir, 'input'),
+               OUTPUT_DIR=os.path.join(workdir, 'output'),
+               PIDFILE=os.path.join(workdir, 'agent.pid'),
+               ANTHROPIC_API_KEY='bench',
+               ANTHROPIC_API_URL=f'http://127.0.0.1:{mock_port}/v1/messages',
+               C2_REGISTRY_URL='http://127.0.0.1:9')
+    if mode == 'workers':
+        env['PROMETHEUS_MULTIPROC_DIR'] = os.path.join(workdir, 'metrics')
+    env.update({k: str(v) for k, v in env_overrides.items()})
+    output = open(os.path.join(workdir, 'agent.log'), 'w') if log else subprocess.DEVNULL
+    proc = subprocess.Popen([sys.executable, *ENTRY_POINTS[mode]], env=env,
+                            stdout=output, stderr=subprocess.STDOUT)
+    try:
+        wait_healthy(port, proc)
+    except Exception:
+        proc.terminate()
+        raise
+    return proc, port, workdir
+
+
+def run_mode(mode, mock_port, args):
+    proc, port, _ = start_agent(mode, mock_port,
+                                LLM_MAX_CONCURRENCY=os.environ.get('LLM_MAX_CONCURRENCY', args.streams),
+                                LLM_MAX_PER_USER=os.environ.get('LLM_MAX_PER_USER', args.streams))
+    try:
+        idle_rss, idle_threads = proc_status(proc.pid)
+        results, peak, wall = asyncio.run(drive(port, proc.pid, args.streams))
+    finally:
+        proc.terminate()
+        proc.wait(30)
+
+    completed = len(results['total'])
+    return {
+        'streams': args.streams,
+        'completed': completed,
+        'errors': len(results['errors']),
+        'sample_errors': results['errors'][:3],
+        'wall_seconds': round(wall, 3),
+        'streams_per_sec': round(completed / wall, 2),
+        'ttft_p50': percentile(results['ttft'], 50),
+        'ttft_p95': percentile(results['ttft'], 95),
+        'total_p50': percentile(results['total'], 50),
+        'total_p95': percentile(results['total'], 95),
+        'rss_idle_mb': round(idle_rss / 1024, 1),
+        'rss_peak_mb': round(peak['rss_kb'] / 1024, 1),
+        'rss_per_stream_kb': round((peak['rss_kb'] - idle_rss) / max(1, args.streams), 1),
+        'threads_idle': idle_threads,
+        'threads_peak': peak['threads']
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mode', choices=['threaded', 'asgi', 'both'], default='both')
+    parser.add_argument('--streams', type=int, default=500)
+    parser.add_argument('--tokens', type=int, default=100)
+    parser.add_argument('--token-rate', type=float, default=20.0, help='mock tokens/sec per stream')
+    args = parser.parse_args()
+
+    mock = MockAnthropic(tokens=args.tokens, token_rate=args.token_rate)
+    mock_port = mock.start_in_thread()
+
+    modes = ['threaded', 'asgi'] if args.mode == 'both' else [args.mode]
+    report = {'config': vars(args)}
+    for mode in modes:
+        report[mode] = run_mode(mode, mock_port, args)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+"""
+Mixed-workload load test
+
+Starts the mock Anthropic server (with optional fault injection) and the agent
+in a scratch directory, then drives /chat/send, /chat/history and
+/chat/sessions from --concurrency clients for --duration seconds. Reports
+per-endpoint throughput, p50/p95/p99 total latency (and TTFT for /chat/send),
+error counts, peak RSS, upstream retries and SQLite lock errors as JSON.
+
+Pass --baseline with a previous report to flag regressions beyond --tolerance;
+the exit status is 1 when any metric regressed.
+
+--mode workers runs the agent under gunicorn with --workers processes
+sharing chat.db (WORKER_CLASS selects gthread or asgi workers).
+
+Usage: python3 bench/load_test.py [--mode threaded] [--workers 4] [--concurrency 50] [--duration 30]
+                                  [--mix send=6,history=3,sessions=1] [--users 20]
+                                  [--tokens 100] [--token-rate 50] [--latency 0]
+                                  [--error-rate 0] [--stream-error-rate 0] [--disconnect-rate 0]
+                                  [--output report.json] [--baseline report.json] [--tolerance 0.15]
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import urllib.request
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+
+from mock_anthropic import MockAnthropic  # noqa: E402
+from bench_streams import start_agent, proc_status, percentile, read_http_stream  # noqa: E402
+
+ENDPOINTS = ('send', 'history', 'sessions')
+
+
+def parse_mix(text):
+    weights = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if name not in ENDPOINTS:
+            raise argparse.ArgumentTypeError(f'unknown endpoint {name!r} (expected {", ".join(ENDPOINTS)})')
+        weights[name] = float(weight or 1)
+    return weights
+
+
+def scrape(port):
+    """Prometheus samples from /metrics as {(name, frozenset(labels)): value}"""
+    with urllib.request.urlopen(f'http://127.0.0.1:{port}/metrics', timeout=10) as response:
+        text = response.read().decode('utf-8')
+    samples = {}
+    for line in text.splitlines():
+        if not line or line.startswith('#'):
+            continue
+        series, _, value = line.rpartition(' ')
+        name, _, labels = series.partition('{')
+        pairs = frozenset(tuple(p.split('=', 1)) for p in labels.rstrip('}').replace('"', '').split(',') if p)
+        samples[(name, pairs)] = float(value)
+    return samples
+
+
+def metric_delta(before, after, name, **labels):
+    """Sum of a metric's samples matching labels, after minus before"""
+    wanted = set(labels.items())
+
+    def total(samples):
+        return sum(v for (n, pairs), v in samples.items() if n == name and wanted <= set(pairs))
+    return total(after) - total(before)
+
+
+async def request(port, method, path, body=None):
+    """One HTTP/1.1 request; returns (first_event_seconds, total_seconds, SSE events or JSON)"""
+    start = time.perf_counter()
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    payload = json.dumps(body).encode() if body is not None else b''
+    writer.write(
+        f'{method} {path} HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\n'
+        f'Connection: close\r\nContent-Length: {len(payload)}\r\n\r\n'.encode('latin-1') + payload
+    )
+    await writer.drain()
+
+    first_token = None
+    data = b''
+    try:
+        async for piece in read_http_stream(reader):
+            if first_token is None and b'"token"' in piece:
+                first_token = time.perf_counter() - start
+            data += piece
+    finally:
+        writer.close()
+    elapsed = time.perf_counter() - start
+
+    if method == 'POST':
+        events = [json.loads(line[6:]) for line in data.decode('utf-8').split('\n') if line.startswith('data: ')]
+        return first_token, elapsed, events
+    return None, elapsed, json.loads(data)
+
+
+async def client(index, port, args, deadline, results):
+    rng = random.Random(index)
+    user_id = f'load-{index % args.users}'
+    session_id = None
+    names = list(args.mix)
+    weights = [args.mix[n] for n in names]
+
+    while time.perf_counter() < deadline:
+        endpoint = rng.choices(names, weights)[0]
+        if endpoint == 'history' and not session_id:
+            endpoint = 'send'
+        stats = results[endpoint]
+        try:
+            if endpoint == 'send':
+                body = {'message': f'load test question {rng.randrange(10 ** 6)}', 'user_id': user_id}
+                if session_id:
+                    body['session_id'] = session_id
+                ttft, elapsed, events = await request(port, 'POST', '/chat/send', body)
+                session_id = session_id or next((e['session_id'] for e in events if 'session_id' in e), None)
+                if any('error' in e for e in events) or not any(e.get('done') for e in events):
+                    stats['errors'] += 1
+                    continue
+                if ttft is not None:
+                    stats['ttft'].append(ttft)
+            elif endpoint == 'history':
+                _, elapsed, _ = await request(port, 'GET', f'/chat/history?session_id={session_id}&limit=50')
+            else:
+                _, elapsed, _ = await request(port, 'GET', f'/chat/sessions?user_id={user_id}')
+            stats['total'].append(elapsed)
+        except Exception as e:
+            stats['errors'] += 1
+            if len(stats['sample_errors']) < 3:
+                stats['sample_errors'].append(str(e)[:200])
+
+
+async def drive(port, pid, args):
+    results = {name: {'total': [], 'ttft': [], 'errors': 0, 'sample_errors': []} for name in ENDPOINTS}
+    peak = {'rss_kb': 0, 'threads': 0}
+    finished = asyncio.Event()
+
+    async def sample():
+        while not finished.is_set():
+            rss, threads = proc_status(pid)
+            peak['rss_kb'] = max(peak['rss_kb'], rss)
+            peak['threads'] = max(peak['threads'], threads)
+            await asyncio.sleep(0.2)
+
+    sampler = asyncio.create_task(sample())
+    start = time.perf_counter()
+    deadline = start + args.duration
+    await asyncio.gather(*(client(i, port, args, deadline, results) for i in range(args.concurrency)))
+    wall = time.perf_counter() - start
+    finished.set()
+    await sampler
+    return results, peak, wall
+
+
+def summarize(stats, wall):
+    report = {
+        'requests': len(stats['total']),
+        'errors': stats['errors'],
+        'requests_per_sec': round(len(stats['total']) / wall, 2),
+        'total_p50': percentile(stats['total'], 50),
+        'total_p95': percentile(stats['total'], 95),
+        'total_p99': percentile(stats['total'], 99)
+    }
+    if stats['ttft']:
+        report.update(ttft_p50=percentile(stats['ttft'], 50), ttft_p95=percentile(stats['ttft'], 95),
+                      ttft_p99=percentile(stats['ttft'], 99))
+    if stats['sample_errors']:
+        report['sample_errors'] = stats['sample_errors']
+    return report
+
+
+def compare(report, baseline, tolerance):
+    """Metrics that got worse than baseline by more than tolerance (throughput down, latency/RSS up)"""
+    regressions = []
+    for endpoint, current in report['endpoints'].items():
+        previous = baseline.get('endpoints', {}).get(endpoint, {})
+        for key, value in current.items():
+            old = previous.get(key)
+            if not isinstance(value, (int, float)) or not old or key in ('requests', 'errors'):
+                continue
+            higher_is_better = key == 'requests_per_sec'
+            change = (value - old) / old
+            if (-change if higher_is_better else change) > tolerance:
+                regressions.append({'metric': f'{endpoint}.{key}', 'baseline': old, 'current': value,
+                                    'change': round(change, 3)})
+    old_rss, rss = baseline.get('process', {}).get('rss_peak_mb'), report['process']['rss_peak_mb']
+    if old_rss and (rss - old_rss) / old_rss > tolerance:
+        regressions.append({'metric': 'process.rss_peak_mb', 'baseline': old_rss, 'current': rss,
+                            'change': round((rss - old_rss) / old_rss, 3)})
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mode', choices=['threaded', 'asgi', 'workers'], default='threaded')
+    parser.add_argument('--workers', type=int, default=4, help='gunicorn processes with --mode workers')
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix('send=6,history=3,sessions=1'))
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--tokens', type=int, default=100)
+    parser.add_argument('--token-rate', type=float, default=50.0, help='mock tokens/sec per stream')
+    parser.add_argument('--latency', type=float, default=0.0, help='mock seconds before response headers')
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--error-status', type=int, default=529)
+    parser.add_argument('--stream-error-rate', type=float, default=0.0)
+    parser.add_argument('--disconnect-rate', type=float, default=0.0)
+    parser.add_argument('--output', help='also write the report to this file')
+    parser.add_argument('--baseline', help='previous report to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.15)
+    args = parser.parse_args()
+
+    mock = MockAnthropic(tokens=args.tokens, token_rate=args.token_rate, latency=args.latency,
+                         error_rate=args.error_rate, error_status=args.error_status,
+                         stream_error_rate=args.stream_error_rate, disconnect_rate=args.disconnect_rate, seed=0)
+    mock_port = mock.start_in_thread()
+
+    proc, port, workdir = start_agent(args.mode, mock_port, log=True,
+                                LLM_MAX_CONCURRENCY=os.environ.get('LLM_MAX_CONCURRENCY', args.concurrency),
+                                LLM_MAX_PER_USER=os.environ.get('LLM_MAX_PER_USER', args.concurrency),
+                                WORKERS=args.workers)
+    try:
+        idle_rss, _ = proc_status(proc.pid)
+        before = scrape(port)
+        results, peak, wall = asyncio.run(drive(port, proc.pid, args))
+        time.sleep(1)   # Let the write-behind queue drain before reading its error counters
+        after = scrape(port)
+    finally:
+        proc.terminate()
+        proc.wait(30)
+
+    with open(os.path.join(workdir, 'agent.log'), errors='replace') as f:
+        locked_lines = sum('database is locked' in line for line in f)
+
+    report = {
+        'config': {k: v for k, v in vars(args).items() if k not in ('output', 'baseline')},
+        'wall_seconds': round(wall, 3),
+        'endpoints': {name: summarize(results[name], wall) for name in ENDPOINTS if name in args.mix},
+        'process': {
+            'rss_idle_mb': round(idle_rss / 1024, 1),
+            'rss_peak_mb': round(peak['rss_kb'] / 1024, 1),
+            'threads_peak': peak['threads']
+        },
+        'sqlite': {
+            'write_retries': int(metric_delta(before, after, 'crewai_chat_errors_total', type='db_write_retry')),
+            'write_errors': int(metric_delta(before, after, 'crewai_chat_errors_total', type='db_write_error')),
+            'locked_log_lines': locked_lines,
+            'pool_wait_mean_ms': round(1000 * metric_delta(before, after, 'crewai_chat_db_pool_wait_seconds_sum')
+                                         / max(1, metric_delta(before, after, 'crewai_chat_db_pool_wait_seconds_count')), 3)
+        },
+        'upstream': {
+            'requests': mock.requests,
+            'retries': int(metric_delta(before, after, 'crewai_chat_http_retries_total')),
+            'injected_faults': mock.faults
+        }
+    }
+
+    regressions = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        report['regressions'] = regressions
+
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+"""
+Mock Anthropic Messages API
+
+Asyncio HTTP/1.1 server that answers POST /v1/messages with a Claude-shaped
+SSE stream (message_start, content_block_delta..., message_delta, message_stop).
+With --tool-input, requests that offer tools first get a tool_use turn
+calling the first tool with that input; the follow-up request carrying the
+tool_result is answered with text.
+Faults can be injected per request: an HTTP error status (--error-rate,
+--error-status), an overloaded_error event halfway through the stream
+(--stream-error-rate) or a dropped connection mid-stream (--disconnect-rate).
+Keep-alive and chunked transfer encoding are supported so connection reuse can
+be measured. Point the agent at it with
+ANTHROPIC_API_URL=http://127.0.0.1:<port>/v1/messages.
+
+Usage: python3 bench/mock_anthropic.py [--port 8765] [--tokens 200] [--token-rate 0] [--latency 0] [--tool-input JSON]
+                                     [--error-rate 0] [--error-status 529] [--stream-error-rate 0] [--disconnect-rate 0]
+"""
+
+import json
+import time
+import random
+import asyncio
+import argparse
+import threading
+
+
+class MockAnthropic:
+    """Configurable fake /v1/messages SSE endpoint"""
+    def __init__(self, tokens=200, token_rate=0.0, latency=0.0, token_text='tok ', tool_input=None,
+                 error_rate=0.0, error_status=529, stream_error_rate=0.0, disconnect_rate=0.0, seed=None):
+        self.tokens = tokens            # text_delta events per response
+        self.token_rate = token_rate    # tokens/sec per stream, 0 = as fast as possible
+        self.latency = latency          # seconds before response headers
+        self.token_text = token_text
+        self.tool_input = tool_input    # dict: answer tool-enabled requests with a tool_use first
+        self.tool_results = []          # tool_result blocks received, for inspection
+        self.error_rate = error_rate                # fraction of requests answered with error_status
+        self.error_status = error_status
+        self.stream_error_rate = stream_error_rate  # fraction ending in an error event halfway through
+        self.disconnect_rate = disconnect_rate      # fraction whose connection drops halfway through
+        self.faults = {'status': 0, 'stream_error': 0, 'disconnect': 0}
+        self._random = random.Random(seed)
+        self.requests = 0
+        self.connections = 0
+        self._cached_prefixes = set()
+        self.port = None
+        self._server = None
+
+    async def start(self, host='127.0.0.1', port=0):
+        self._server = await asyncio.start_server(self._handle, host, port, backlog=4096)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self.port
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    def start_in_thread(self, host='127.0.0.1', port=0):
+        """Run the server on a private event loop thread; returns the bound port"""
+        ready = threading.Event()
+
+        def run():
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            loop.run_until_complete(self.start(host, port))
+            ready.set()
+            loop.run_forever()
+
+        threading.Thread(target=run, name='mock-anthropic', daemon=True).start()
+        ready.wait()
+        return self.port
+
+    async def _handle(self, reader, writer):
+        self.connections += 1
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode('latin-1').split(' ', 2)
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                keep_alive = headers.get('connection', '').lower() != 'close'
+
+                if method == 'POST' and path.startswith('/v1/messages'):
+                    await self._messages(writer, body)
+                else:
+                    await self._reply(writer, 404, b'{"error": "not found"}')
+
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _reply(self, writer, status, body, content_type='application/json'):
+        writer.write(
+            f'HTTP/1.1 {status} MOCK\r\nContent-Type: {content_type}\r\n'
+            f'Content-Length: {len(body)}\r\n\r\n'.encode('latin-1') + body
+        )
+        await writer.drain()
+
+    def _input_usage(self, payload):
+        """Approximate input token usage, emulating prompt caching of cache_control system blocks"""
+        usage = {'input_tokens': 0, 'cache_creation_input_tokens': 0, 'cache_read_input_tokens': 0, 'output_tokens': 1}
+        system = payload.get('system') or []
+        if isinstance(system, str):
+            system = [{'type': 'text', 'text': system}]
+        for block in system:
+            tokens = max(1, len(block.get('text', '')) // 4)
+            if block.get('cache_control'):
+                key = block.get('text', '')
+                if key in self._cached_prefixes:
+                    usage['cache_read_input_tokens'] += tokens
+                else:
+                    self._cached_prefixes.add(key)
+                    usage['cache_creation_input_tokens'] += tokens
+            else:
+                usage['input_tokens'] += tokens
+        usage['input_tokens'] += max(1, len(json.dumps(payload.get('messages', []))) // 4)
+        return usage
+
+    async def _messages(self, writer, body):
+        self.requests += 1
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            await self._reply(writer, 400, b'{"error": "invalid json"}')
+            return
+
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        fault = self._pick_fault()
+        if fault == 'status':
+            error_type = 'overloaded_error' if self.error_status == 529 else 'api_error'
+            body = json.dumps({'type': 'error', 'error': {'type': error_type, 'message': 'Injected fault'}})
+            await self._reply(writer, self.error_status, body.encode('utf-8'))
+            return
+
+        writer.write(
+            b'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n'
+            b'Cache-Control: no-cache\r\nTransfer-Encoding: chunked\r\n\r\n'
+        )
+
+        async def event(name, data):
+            chunk = f'event: {name}\ndata: {json.dumps(data)}\n\n'.encode('utf-8')
+            writer.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+            await writer.drain()
+
+        await event('message_start', {
+            'type': 'message_start',
+            'message': {
+                'id': f'msg_mock_{self.requests}', 'type': 'message', 'role': 'assistant',
+                'model': payload.get('model'), 'content': [],
+                'usage': self._input_usage(payload)
+            }
+        })
+        if self._wants_tool(payload):
+            await self._tool_use(event, payload['tools'][0]['name'])
+            return await self._finish(writer)
+
+        await event('content_block_start', {'type': 'content_block_start', 'index': 0,
+                                            'content_block': {'type': 'text', 'text': ''}})
+
+        interval = 1.0 / self.token_rate if self.token_rate else 0
+        started = time.monotonic()
+        for i in range(self.tokens):
+            if interval:
+                delay = started + i * interval - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            if fault and i == self.tokens // 2:
+                if fault == 'disconnect':
+                    writer.transport.abort()
+                    raise ConnectionError('injected disconnect')
+                await event('error', {'type': 'error', 'error': {'type': 'overloaded_error', 'message': 'Overloaded'}})
+                return await self._finish(writer)
+            await event('content_block_delta', {'type': 'content_block_delta', 'index': 0,
+                                                'delta': {'type': 'text_delta', 'text': self.token_text}})
+
+        await event('content_block_stop', {'type': 'content_block_stop', 'index': 0})
+        await event('message_delta', {'type': 'message_delta',
+                                      'delta': {'stop_reason': 'end_turn', 'stop_sequence': None},
+                                      'usage': {'output_tokens': self.tokens}})
+        await event('message_stop', {'type': 'message_stop'})
+        await self._finish(writer)
+
+    async def _finish(self, writer):
+        writer.write(b'0\r\n\r\n')
+        await writer.drain()
+
+    def _pick_fault(self):
+        """None, or which fault to inject into this request"""
+        roll = self._random.random()
+        for fault, rate in (('status', self.error_rate), ('stream_error', self.stream_error_rate),
+                            ('disconnect', self.disconnect_rate)):
+            if roll < rate:
+                self.faults[fault] += 1
+                return fault
+            roll -= rate
+        return None
+
+    def _wants_tool(self, payload):
+        """Call a tool unless this request already carries tool results (or tools are off)"""
+        if self.tool_input is None or not payload.get('tools'):
+            return False
+        if (payload.get('tool_choice') or {}).get('type') == 'none':
+            return False
+        last = (payload.get('messages') or [{}])[-1].get('content')
+        if isinstance(last, list):
+            results = [b for b in last if isinstance(b, dict) and b.get('type') == 'tool_result']
+            if results:
+                self.tool_results.extend(results)
+                return False
+        return True
+
+    async def _tool_use(self, event, name):
+        await event('content_block_start', {'type': 'content_block_start', 'index': 0,
+                                            'content_block': {'type': 'text', 'text': ''}})
+        await event('content_block_delta', {'type': 'content_block_delta', 'index': 0,
+                                            'delta': {'type': 'text_delta', 'text': 'Checking the data. '}})
+        await event('content_block_stop', {'type': 'content_block_stop', 'index': 0})
+        await event('content_block_start', {'type': 'content_block_start', 'index': 1,
+                                            'content_block': {'type': 'tool_use', 'id': f'toolu_mock_{self.requests}',
+                                                              'name': name, 'input': {}}})
+        raw = json.dumps(self.tool_input)
+        for i in range(0, len(raw), 16):  # Input JSON arrives in fragments, as upstream
+            await event('content_block_delta', {'type': 'content_block_delta', 'index': 1,
+                                                'delta': {'type': 'input_json_delta', 'partial_json': raw[i:i + 16]}})
+        await event('content_block_stop', {'type': 'content_block_stop', 'index': 1})
+        await event('message_delta', {'type': 'message_delta',
+                                      'delta': {'stop_reason': 'tool_use', 'stop_sequence': None},
+                                      'usage': {'output_tokens': 20}})
+        await event('message_stop', {'type': 'message_stop'})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--tokens', type=int, default=200)
+    parser.add_argument('--token-rate', type=float, default=0.0)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--tool-input', type=json.loads, help='JSON input for a tool_use turn, e.g. \'{"group_by": "Rwy_Used"}\'')
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--error-status', type=int, default=529)
+    parser.add_argument('--stream-error-rate', type=float, default=0.0)
+    parser.add_argument('--disconnect-rate', type=float, default=0.0)
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+
+    mock = MockAnthropic(tokens=args.tokens, token_rate=args.token_rate, latency=args.latency,
+                         tool_input=args.tool_input, error_rate=args.error_rate, error_status=args.error_status,
+                         stream_error_rate=args.stream_error_rate, disconnect_rate=args.disconnect_rate,
+                         seed=args.seed)
+
+    async def serve():
+        port = await mock.start(args.host, args.port)
+        print(f"Mock Anthropic API on http://{args.host}:{port}/v1/messages")
+        await asyncio.Event().wait()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
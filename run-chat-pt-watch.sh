@@ -13,6 +13,8 @@ MODEL_VERSION="${MODEL_VERSION:-sonnet4}"
 ENVIRONMENT="${ENVIRONMENT:-prod}"
 INSTANCE_ID="${INSTANCE_ID:-002}"
 IMAGE_TAG="${IMAGE_TAG:-latest}"
+SERVER_MODE="${SERVER_MODE:-threaded}"
+INPUT_WATCH_PATTERN="${INPUT_WATCH_PATTERN:-KMMU_OPS_Data_10-24-25.csv}"
 
 # Generate rigorous container name
 CONTAINER_NAME="crewai-chat-pt-air-${MODEL}-${MODEL_VERSION}-${ENVIRONMENT}-${INSTANCE_ID}"
@@ -123,6 +125,8 @@ start_container() {
         -e INSTANCE_ID="$INSTANCE_ID" \
         -e API_PORT=8080 \
         -e METRICS_PORT=9090 \
+        -e SERVER_MODE="$SERVER_MODE" \
+        -e INPUT_WATCH_PATTERN="$INPUT_WATCH_PATTERN" \
         -e C2_REGISTRY_URL="$C2_REGISTRY_URL" \
         --restart unless-stopped \
         --security-opt no-new-privileges:true \
@@ -224,8 +228,10 @@ case "${1:-}" in
         echo "  ENVIRONMENT       - Environment (default: prod)"
         echo "  INSTANCE_ID       - Instance ID (default: 001)"
         echo "  API_PORT          - API port (default: 8087)"
-        echo "  METRICS_PORT      - Metrics port (default: 9097)"
+        echo "  METRICS_PORT      - Metrics port (default: 9099)"
         echo "  C2_REGISTRY_URL   - C2 registry URL"
+        echo "  SERVER_MODE       - threaded (Flask) or asgi (asyncio streaming)"
+        echo "  INPUT_WATCH_PATTERN - CSV glob to serve, newest wins (e.g. 'KMMU_OPS_Data_*.csv')"
         exit 1
         ;;
 esac
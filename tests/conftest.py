@@ -0,0 +1,33 @@
+"""Shared test setup: import the app modules against a scratch data directory"""
+
+import os
+import sys
+import tempfile
+
+APP_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app')
+sys.path.insert(0, APP_DIR)
+
+# main opens chat.db and reads its settings at import time
+_scratch = tempfile.mkdtemp(prefix='crewai-chat-tests-')
+for name in ('data', 'output', 'input'):
+    os.makedirs(os.path.join(_scratch, name), exist_ok=True)
+os.environ.update({
+    'DATA_DIR': os.path.join(_scratch, 'data'),
+    'OUTPUT_DIR': os.path.join(_scratch, 'output'),
+    'INPUT_DIR': os.path.join(_scratch, 'input'),
+    'PIDFILE': os.path.join(_scratch, 'agent.pid'),
+    'ANTHROPIC_API_KEY': 'test',
+    'C2_REGISTRY_URL': 'http://127.0.0.1:9',
+    'METRICS_PORT': '0',
+})
+
+import pytest  # noqa: E402
+
+
+@pytest.fixture
+def database(tmp_path):
+    """A fresh ChatDatabase in its own file"""
+    import storage
+    db = storage.ChatDatabase(str(tmp_path / 'chat.db'), pool_size=2, shared=False)
+    yield db
+    db.pool.close()
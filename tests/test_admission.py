@@ -0,0 +1,37 @@
+from main import AdmissionController
+
+
+def test_big_prompts_only_hold_back_their_sender():
+    # 6000 tokens/minute per user: a drained bucket needs about a second per 100 tokens
+    admission = AdmissionController(max_concurrency=8, per_user=8, token_rate=0, timeout=5, user_token_rate=6000)
+
+    first = admission.enter('heavy', 6000)
+    assert first.granted
+    admission.leave(first)
+
+    queued = admission.enter('heavy', 6000)
+    assert not queued.granted
+
+    light = admission.enter('light', 200)
+    assert light.granted
+    admission.leave(light)
+
+    assert admission.position(queued)['position'] == 1
+    admission.leave(queued)
+
+
+def test_drained_user_bucket_is_granted_after_refill():
+    admission = AdmissionController(max_concurrency=8, per_user=8, token_rate=0, timeout=5, user_token_rate=60000)
+
+    admission.leave(admission.enter('heavy', 500))
+    waiting = admission.enter('heavy', 60000)  # Capped at the bucket size, needs ~0.5 s of refill
+    assert not waiting.granted
+    assert admission.wait(waiting, timeout=3)
+    admission.leave(waiting)
+
+
+def test_global_rate_still_applies_to_every_user():
+    admission = AdmissionController(max_concurrency=8, per_user=8, token_rate=1000, timeout=5, user_token_rate=1000)
+
+    admission.leave(admission.enter('heavy', 1000))
+    assert not admission.enter('light', 100).granted
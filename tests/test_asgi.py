@@ -0,0 +1,71 @@
+import asyncio
+import threading
+
+import httpx
+from prometheus_client import REGISTRY
+
+import asgi
+import main
+
+
+def retries_counted(reason):
+    return REGISTRY.get_sample_value('crewai_chat_http_retries_total', {'host': 'upstream.test', 'reason': reason}) or 0
+
+
+def test_async_upstream_retries_overloaded_responses(monkeypatch):
+    monkeypatch.setattr(main, 'HTTP_BACKOFF_FACTOR', 0)
+    monkeypatch.setattr(main, 'HTTP_BACKOFF_JITTER', 0)
+    statuses = [529, 503, 200]
+
+    def handler(request):
+        return httpx.Response(statuses.pop(0), text='data: {}\n\n')
+
+    llm = main.ClaudeLLM(csv_loader=None)
+    llm.api_url = 'http://upstream.test/v1/messages'
+    before = retries_counted('529') + retries_counted('503')
+
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            response = await llm.open_stream_async(client, {'messages': []})
+            await response.aclose()
+            return response.status_code
+
+    assert asyncio.run(run()) == 200
+    assert retries_counted('529') + retries_counted('503') - before == 2
+
+
+def test_async_upstream_gives_up_after_max_retries(monkeypatch):
+    monkeypatch.setattr(main, 'HTTP_BACKOFF_FACTOR', 0)
+    monkeypatch.setattr(main, 'HTTP_BACKOFF_JITTER', 0)
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        return httpx.Response(429, headers={'retry-after': '0'}, text='slow down')
+
+    llm = main.ClaudeLLM(csv_loader=None)
+
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            response = await llm.open_stream_async(client, {'messages': []})
+            await response.aclose()
+            return response.status_code
+
+    assert asyncio.run(run()) == 429
+    assert len(calls) == main.HTTP_MAX_RETRIES + 1
+
+
+def test_turn_completion_runs_off_the_event_loop(monkeypatch):
+    threads = []
+    monkeypatch.setattr(asgi, 'complete_turn', lambda *args: threads.append(threading.current_thread()))
+
+    async def run():
+        asgi.complete_in_thread(asyncio.get_running_loop(), 'session', 'user', 'answer', 0.0, None)
+        for _ in range(100):
+            if threads:
+                break
+            await asyncio.sleep(0.01)
+        return threading.current_thread()
+
+    loop_thread = asyncio.run(run())
+    assert threads and threads[0] is not loop_thread
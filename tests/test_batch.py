@@ -0,0 +1,61 @@
+import json
+import time
+
+import main
+from main import BatchRunner
+
+
+class FakeLLM:
+    def generate_stream(self, prompt, session_id, use_cache=True, user_id='anonymous'):
+        yield {'token': prompt.upper()}
+        yield {'done': True, 'usage': {}}
+
+
+def wait_for(predicate, timeout=5):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+def test_job_with_pending_items_is_released_and_retried(database, tmp_path, monkeypatch):
+    monkeypatch.setattr(main, 'llm', FakeLLM())
+    finish = database.finish_batch_item
+    failures = []
+
+    def flaky_finish(job_id, result):
+        if not failures:
+            failures.append(result['index'])
+            raise main.sqlite3.OperationalError('database is locked')
+        finish(job_id, result)
+
+    monkeypatch.setattr(database, 'finish_batch_item', flaky_finish)
+    runner = BatchRunner(database, workers=1, output_dir=str(tmp_path))
+    runner.start()
+    job_id = runner.submit([('a', 'first'), ('b', 'second')])
+
+    assert wait_for(lambda: database.lease_holder(f'batch:{job_id}') is None)
+    assert runner.status(job_id)['items']['pending'] == 1
+
+    runner.resume()  # What the next heartbeat does
+    assert wait_for(lambda: runner.status(job_id)['status'] == 'completed')
+    assert runner.status(job_id)['items']['done'] == 2
+
+
+def test_single_line_jsonl_body_with_json_content_type():
+    client = main.app.test_client()
+    response = client.post('/batch', data=json.dumps({'custom_id': 'one', 'prompt': 'Hello'}),
+                           content_type='application/json')
+
+    assert response.status_code == 202
+    assert response.get_json()['total'] == 1
+
+
+def test_prompts_object_without_json_content_type():
+    client = main.app.test_client()
+    response = client.post('/batch', data=json.dumps({'prompts': ['a', 'b']}), content_type='text/plain')
+
+    assert response.status_code == 202
+    assert response.get_json()['total'] == 2
@@ -0,0 +1,50 @@
+from main import ContextBuilder, CONTEXT_MAX_MESSAGES
+
+
+def add_messages(db, session_id, count, start=0):
+    for i in range(start, start + count):
+        db.save_message(session_id, 'user' if i % 2 == 0 else 'assistant', f'msg{i:02d} ' + 'x' * 35)
+
+
+def summary_ids(summary):
+    return [line.split(': ')[1].split()[0] for line in summary.split('\n') if line]
+
+
+def prompt_of(tokens):
+    return 'y' * (4 * tokens)
+
+
+def test_messages_leaving_the_window_are_summarized(database):
+    session_id = database.create_session('alice')
+    add_messages(database, session_id, CONTEXT_MAX_MESSAGES + 20)
+    builder = ContextBuilder(database, budget=100000, summary_tokens=10000)
+
+    history = database.get_history(session_id, CONTEXT_MAX_MESSAGES)
+    packed, summary = builder.build(session_id, history, 'next question')
+
+    assert len(packed) == CONTEXT_MAX_MESSAGES
+    assert summary_ids(summary) == [f'msg{i:02d}' for i in range(20)]
+
+    # The next turn moves two more messages out of the window; each is summarized once
+    add_messages(database, session_id, 2, start=CONTEXT_MAX_MESSAGES + 20)
+    history = database.get_history(session_id, CONTEXT_MAX_MESSAGES)
+    _, summary = builder.build(session_id, history, 'another question')
+    assert summary_ids(summary) == [f'msg{i:02d}' for i in range(22)]
+
+
+def test_smaller_drop_does_not_resummarize(database):
+    session_id = database.create_session('alice')
+    add_messages(database, session_id, 10)
+    builder = ContextBuilder(database, budget=100, summary_tokens=10000)
+
+    # 11 tokens per message: a 67-token prompt leaves room for the newest 3
+    _, summary = builder.build(session_id, database.get_history(session_id, 50), prompt_of(67))
+    assert summary_ids(summary) == [f'msg{i:02d}' for i in range(7)]
+
+    # A short prompt drops only 3, all of them already summarized
+    _, summary = builder.build(session_id, database.get_history(session_id, 50), prompt_of(23))
+    assert summary_ids(summary) == [f'msg{i:02d}' for i in range(7)]
+
+    add_messages(database, session_id, 2, start=10)
+    _, summary = builder.build(session_id, database.get_history(session_id, 50), prompt_of(67))
+    assert summary_ids(summary) == [f'msg{i:02d}' for i in range(9)]
@@ -0,0 +1,42 @@
+from csv_engine import ColumnarTable
+
+
+def write(path, data):
+    path.write_bytes(data)
+    return str(path)
+
+
+def test_full_load_reads_last_line_without_newline(tmp_path):
+    path = write(tmp_path / 'ops.csv', b'a,b\n1,x\n2,y\n3,z')
+    table = ColumnarTable.from_csv(path)
+
+    assert table.rows == 3
+    assert table.aggregate('a', 'sum') == 6
+    assert table.bytes_read == len(b'a,b\n1,x\n2,y\n3,z')
+
+
+def test_tail_defers_partial_last_line(tmp_path):
+    path = write(tmp_path / 'ops.csv', b'a,b\n1,x\n')
+    table = ColumnarTable.from_csv(path)
+    with open(path, 'ab') as f:
+        f.write(b'2,y\n3,')
+
+    table.ingest(path, table.bytes_read)
+    assert table.rows == 2
+
+    with open(path, 'ab') as f:
+        f.write(b'z\n')
+    table.ingest(path, table.bytes_read)
+    assert table.rows == 3
+    assert table.aggregate('a', 'sum') == 6
+
+
+def test_append_after_unterminated_last_line(tmp_path):
+    path = write(tmp_path / 'ops.csv', b'a,b\n1,x\n2,y')
+    table = ColumnarTable.from_csv(path)
+    with open(path, 'ab') as f:
+        f.write(b'\n3,z\n')
+
+    table.ingest(path, table.bytes_read)
+    assert table.rows == 3
+    assert table.aggregate('a', 'count') == 3
@@ -0,0 +1,65 @@
+from prometheus_client import REGISTRY
+
+import main
+import storage
+
+
+def cache_count(result):
+    return REGISTRY.get_sample_value('crewai_chat_history_cache_requests_total', {'result': result}) or 0
+
+
+def test_history_pages_walk_back_to_the_first_message(database):
+    session_id = database.create_session('alice')
+    for i in range(120):
+        database.save_message(session_id, 'user', f'message {i}')
+
+    pages, cursor = [], None
+    while True:
+        messages, cursor = database.get_history_page(session_id, before=cursor)
+        pages.append([m['content'] for m in messages])
+        if cursor is None:
+            break
+
+    assert [len(page) for page in pages] == [50, 50, 20]
+    assert pages[0][-1] == 'message 119'
+    assert pages[-1][0] == 'message 0'
+
+
+def test_default_history_page_is_served_from_cache(database):
+    session_id = database.create_session('alice')
+    for i in range(storage.HISTORY_CACHE_MESSAGES + 10):
+        database.save_message(session_id, 'user', f'message {i}')
+
+    # Cold start on the same file: the first page fills the ring, later ones hit it
+    reopened = storage.ChatDatabase(database.db_path, pool_size=1, shared=False)
+    reopened.get_history_page(session_id)
+
+    hits, misses = cache_count('hit'), cache_count('miss')
+    messages, cursor = reopened.get_history_page(session_id)
+    assert cache_count('hit') - hits == 1
+    assert cache_count('miss') - misses == 0
+    assert len(messages) == 50 and cursor is not None
+    reopened.pool.close()
+
+
+def test_paging_routes_reject_non_integer_limit(database, monkeypatch):
+    monkeypatch.setattr(main, 'db', database)
+    session_id = database.create_session('alice')
+    client = main.app.test_client()
+
+    for path in (f'/chat/history?session_id={session_id}', '/chat/sessions?user_id=alice', '/chat/search?user_id=alice&q=hello'):
+        response = client.get(path + '&limit=ten')
+        assert response.status_code == 400, path
+        assert response.get_json() == {'error': 'limit must be an integer'}
+        assert client.get(path + '&limit=5').status_code == 200, path
+
+
+def test_search_rejects_malformed_cursor(database, monkeypatch):
+    monkeypatch.setattr(main, 'db', database)
+    client = main.app.test_client()
+
+    for values in (['0'], [-3], [1.5], [True]):
+        response = client.get(f'/chat/search?user_id=alice&q=hello&cursor={storage.encode_cursor(values)}')
+        assert response.status_code == 400, values
+        assert response.get_json() == {'error': 'invalid cursor'}
+    assert client.get(f'/chat/search?user_id=alice&q=hello&cursor={storage.encode_cursor([0])}').status_code == 200
@@ -0,0 +1,8 @@
+from main import parse_retention_policies
+
+
+def test_malformed_retention_policies_are_skipped(capsys):
+    policies = parse_retention_policies('alice=abc, vip-*=0,=5,bob,load-*=1,carol=-3')
+
+    assert policies == [('vip-*', 0.0), ('load-*', 1.0)]
+    assert capsys.readouterr().out.count('WARNING: Ignoring retention policy') == 4
@@ -0,0 +1,44 @@
+import sqlite3
+import threading
+
+from prometheus_client import REGISTRY
+
+import storage
+
+
+def write_errors():
+    return REGISTRY.get_sample_value('crewai_chat_errors_total', {'type': 'db_write_error'}) or 0
+
+
+def test_writer_survives_a_non_transient_write_error(database, monkeypatch):
+    session_id = database.create_session('alice')
+    save_messages = database.save_messages
+    failures = [sqlite3.IntegrityError('UNIQUE constraint failed'), ValueError('rejected by storage server')]
+
+    def flaky(batch, usage=()):
+        if failures:
+            raise failures.pop(0)
+        save_messages(batch, usage)
+
+    monkeypatch.setattr(database, 'save_messages', flaky)
+    writer = storage.MessageWriter(database)
+    writer.start()
+    errors = write_errors()
+    try:
+        for text in ('lost', 'also lost'):
+            writer.save_message(session_id, 'user', text)
+            flushed = threading.Thread(target=writer.flush, daemon=True)
+            flushed.start()
+            flushed.join(5)
+            assert not flushed.is_alive()
+        assert write_errors() - errors == 2
+
+        writer.save_message(session_id, 'user', 'kept')
+        writer.flush()
+    finally:
+        writer.stop()
+
+    # The history cache still holds what was queued; the file holds what was committed
+    reopened = storage.ChatDatabase(database.db_path, pool_size=1, shared=False)
+    assert [m['content'] for m in reopened.get_history(session_id)] == ['kept']
+    reopened.pool.close()
@@ -0,0 +1,15 @@
+import os
+import subprocess
+import sys
+
+from conftest import APP_DIR
+
+
+def test_refuses_to_start_without_token():
+    env = {k: v for k, v in os.environ.items() if k != 'STORAGE_TOKEN'}
+    env.pop('STORAGE_ALLOW_ANONYMOUS', None)
+    result = subprocess.run([sys.executable, os.path.join(APP_DIR, 'storage_server.py')], env=env,
+                            capture_output=True, text=True, timeout=60)
+
+    assert result.returncode == 1
+    assert 'refusing to serve chat.db' in result.stdout
@@ -0,0 +1,51 @@
+import asyncio
+
+from werkzeug.test import EnvironBuilder
+
+import main
+import streaming
+
+
+def finished_stream(hub):
+    broadcast, _ = hub._join_or_create(None, None)
+    broadcast.publish({'token': 'hi'})
+    broadcast.finish()
+    broadcast.unsubscribe()  # Drop the opener's reservation; only readers remain
+    return broadcast
+
+
+def test_resume_released_when_client_leaves_before_first_chunk(monkeypatch):
+    hub = streaming.StreamHub(coalesce=False)
+    monkeypatch.setattr(main, 'hub', hub)
+    broadcast = finished_stream(hub)
+
+    statuses = []
+    environ = EnvironBuilder(path=f'/chat/stream/{broadcast.stream_id}').get_environ()
+    body = main.app(environ, lambda status, headers: statuses.append(status))
+    assert statuses == ['200 OK']
+    assert broadcast.subscribers == 1
+    body.close()  # The server gives up before pulling the first chunk
+    assert broadcast.subscribers == 0
+
+
+def test_reader_releases_once():
+    hub = streaming.StreamHub(coalesce=False)
+    broadcast = finished_stream(hub)
+
+    broadcast.subscribe()
+    reader = broadcast.iter_events()
+    assert len(list(reader)) == 1
+    reader.close()
+    assert broadcast.subscribers == 0
+
+    broadcast.subscribe()
+    asyncio.run(broadcast.iter_events_async().aclose())
+    assert broadcast.subscribers == 0
+
+
+def test_unknown_stream_tells_client_to_restart_the_turn(monkeypatch):
+    monkeypatch.setattr(main, 'hub', streaming.StreamHub(coalesce=False))
+
+    response = main.app.test_client().get('/chat/stream/held-by-another-worker')
+    assert response.status_code == 404
+    assert response.get_json()['restart_turn'] is True